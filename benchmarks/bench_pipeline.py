@@ -0,0 +1,131 @@
+'''
+Run run_pipeline over synthetic glaciers against the in-process Earth
+Engine and Drive stand-ins (GlaciersGEE.fakes) and report round trips,
+wall time and exports per glacier for each sensor.
+
+    python benchmarks/bench_pipeline.py --glaciers 20 --ee-latency 0.05 --drive-latency 0.05 --pool 4
+'''
+import argparse
+import collections
+import functools
+import json
+import os
+import tempfile
+import time
+import numpy as np
+import geopandas as gpd
+from shapely.geometry import box
+
+from GlaciersGEE import fakes, ratelimit
+from GlaciersGEE import main as pipeline
+
+
+def synthetic_joined(n_glaciers, seed=0, extent=None):
+    '''
+    Joined-like GeoDataFrame of small square glaciers, spread over the
+    world or, if `extent` is given, over a square of that many degrees
+    '''
+    rng = np.random.RandomState(seed)
+    if extent is None:
+        x = rng.uniform(-150, 150, n_glaciers)
+        y = rng.uniform(-60, 70, n_glaciers)
+    else:
+        x = rng.uniform(7., 7. + extent, n_glaciers)
+        y = rng.uniform(46., 46. + extent, n_glaciers)
+    size = rng.uniform(0.005, 0.05, n_glaciers)
+    return gpd.GeoDataFrame(
+        {
+            'glac_id': ['G%06dE%05dN' % (k, k) for k in range(n_glaciers)],
+            'glac_name': ['glacier %d' % k for k in range(n_glaciers)],
+            'GLIMS_ID': ['G%06dE%05dN' % (k, k) for k in range(n_glaciers)],
+            'WGMS_ID': np.arange(n_glaciers),
+        },
+        geometry=[box(a, b, a + s, b + s) for (a, b, s) in zip(x, y, size)],
+        crs={'init': 'epsg:4326'}
+    )
+
+
+def run(n_glaciers, ee_params, pool, ee_latency, drive_latency, scenes_per_year, phases_fp=None,
+        extent=None, cluster=False):
+    fake_ee = fakes.FakeEE(latency=ee_latency, scenes_per_year=scenes_per_year)
+    fake_drive = fakes.FakeDrive(latency=drive_latency)
+    restore = fakes.install_fake_ee(fake_ee)
+
+    joined = synthetic_joined(n_glaciers, extent=extent)
+    patched = {
+        'start_service': lambda: fake_drive,
+        'prep_joined': lambda ids, datadir: joined[joined.glac_id.isin(ids)],
+        'ExportScheduler': functools.partial(pipeline.ExportScheduler, poll_interval=0.2, max_poll_interval=1.),
+    }
+    originals = {k: getattr(pipeline, k) for k in patched}
+    for k, v in patched.items():
+        setattr(pipeline, k, v)
+
+    cwd = os.getcwd()
+    if phases_fp:
+        phases_fp = os.path.abspath(phases_fp)
+    os.chdir(tempfile.mkdtemp())
+    try:
+        start = time.time()
+        results = pipeline.run_pipeline(
+            list(joined.glac_id), '', 'glaciers', ee_params=ee_params, pool=pool,
+            report_fp=phases_fp, cluster=cluster,
+            # the fakes have no quotas; only the latency options slow calls down
+            rates={name: (1e6, 1e6) for name in ratelimit.RATES}
+        )
+        wall = time.time() - start
+    finally:
+        os.chdir(cwd)
+        for k, v in originals.items():
+            setattr(pipeline, k, v)
+        restore()
+
+    exports = collections.Counter()
+    for task in fake_ee.tasks.tasks.values():
+        image = task.config['image']
+        sensor = image.props.get('SPACECRAFT_ID', 'DEM')
+        exports[sensor] += 1
+
+    ee_calls = collections.Counter(name for (name, _) in fake_ee.recorder.calls)
+    drive_calls = collections.Counter(name for (name, _) in fake_drive.recorder.calls)
+    return {
+        'glaciers': n_glaciers,
+        'failed': sum(1 for v in results.values() if v is not None),
+        'wall_s': round(wall, 3),
+        'wall_s_per_glacier': round(wall / max(n_glaciers, 1), 4),
+        'ee_round_trips': sum(ee_calls[k] for k in ('getInfo', 'startTask', 'listOperations')),
+        'ee_calls': dict(ee_calls),
+        'drive_round_trips': drive_calls['execute'] + drive_calls['batch'],
+        'drive_calls': dict(drive_calls),
+        'exports': sum(exports.values()),
+        'exports_per_glacier': {k: round(v / max(n_glaciers, 1), 2) for (k, v) in sorted(exports.items())},
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--glaciers', type=int, default=10)
+    parser.add_argument('--pool', type=int, default=0, help='worker threads, 0 for serial')
+    parser.add_argument('--ee-latency', type=float, default=0., help='seconds per Earth Engine round trip')
+    parser.add_argument('--drive-latency', type=float, default=0., help='seconds per Drive round trip')
+    parser.add_argument('--scenes-per-year', type=int, default=12)
+    parser.add_argument('--ee-params', type=str, default='{"gmted": false}', help='json of ee_download parameters')
+    parser.add_argument('--output', type=str, default=None, help='write the report as json')
+    parser.add_argument('--extent', type=float, default=None, help='scatter glaciers over a square of this many degrees')
+    parser.add_argument('--cluster', type=float, default=0, help='cluster cell size in degrees, 0 to export glaciers alone')
+    parser.add_argument('--phases', type=str, default=None, help='write the per-phase timing report (.json or .csv)')
+    args = parser.parse_args()
+
+    report = run(
+        args.glaciers, json.loads(args.ee_params), args.pool or False,
+        args.ee_latency, args.drive_latency, args.scenes_per_year, args.phases,
+        args.extent, {'cell_size': args.cluster} if args.cluster else False
+    )
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, 'w') as fh:
+            json.dump(report, fh, indent=2)
+
+
+if __name__ == '__main__':
+    main()
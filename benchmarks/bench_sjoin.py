@@ -0,0 +1,77 @@
+'''
+Compare the partitioned STRtree join (sjoin_partitioned) with a single
+gpd.sjoin call on synthetic data at GLIMS scale, and check that both
+engines of query.sjoin give the same drop_duplicates('glac_id') result.
+
+    python benchmarks/bench_sjoin.py --glaciers 200000 --points 5000 --workers 4
+'''
+import argparse
+import time
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+from shapely.geometry import Point, box
+from GlaciersGEE.query import sjoin, gpd_sjoin
+
+
+def synthetic_data(n_glaciers, n_points, seed=0):
+    '''
+    Random small square glaciers and wgms points, about half of which fall
+    inside a glacier
+    '''
+    rng = np.random.RandomState(seed)
+    x = rng.uniform(-180, 179.9, n_glaciers)
+    y = rng.uniform(-80, 79.9, n_glaciers)
+    size = rng.uniform(0.001, 0.05, n_glaciers)
+    glims = gpd.GeoDataFrame(
+        {'glac_id': ['G%07d' % k for k in range(n_glaciers)]},
+        geometry=[box(a, b, a + s, b + s) for (a, b, s) in zip(x, y, size)],
+        crs='epsg:4326'
+    )
+
+    hit = rng.choice(n_glaciers, n_points // 2, replace=False)
+    px = np.concatenate([x[hit] + size[hit] / 2, rng.uniform(-180, 180, n_points - len(hit))])
+    py = np.concatenate([y[hit] + size[hit] / 2, rng.uniform(-80, 80, n_points - len(hit))])
+    wgms = gpd.GeoDataFrame(
+        {'WGMS_ID': np.arange(n_points), 'NAME': ['W%d' % k for k in range(n_points)]},
+        geometry=[Point(xy) for xy in zip(px, py)],
+        crs='epsg:4326'
+    )
+    return glims, wgms
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--glaciers', type=int, default=200000)
+    parser.add_argument('--points', type=int, default=5000)
+    parser.add_argument('--workers', type=int, default=None)
+    args = parser.parse_args()
+
+    glims, wgms = synthetic_data(args.glaciers, args.points)
+    print('%d glaciers, %d points' % (len(glims), len(wgms)))
+
+    start = time.time()
+    gpd_sjoin(glims, wgms)
+    t_raw = time.time() - start
+    print('gpd.sjoin alone:   %.2fs' % t_raw)
+
+    start = time.time()
+    current = sjoin(glims, wgms, engine='geopandas')
+    t_current = time.time() - start
+    print('gpd.sjoin:         %.2fs, %d rows' % (t_current, len(current)))
+
+    start = time.time()
+    partitioned = sjoin(glims, wgms, engine='strtree', workers=args.workers)
+    t_partitioned = time.time() - start
+    print('sjoin_partitioned: %.2fs, %d rows' % (t_partitioned, len(partitioned)))
+    print('speedup: %.1fx' % (t_current / t_partitioned))
+
+    pd.testing.assert_frame_equal(
+        pd.DataFrame(current.drop(columns='geometry')), pd.DataFrame(partitioned.drop(columns='geometry')),
+        check_dtype=False)
+    assert current.geometry.geom_equals(partitioned.geometry).all()
+    print('results equal')
+
+
+if __name__ == '__main__':
+    main()
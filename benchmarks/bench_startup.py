@@ -0,0 +1,81 @@
+'''
+Measure the startup time of the package and the CLI in fresh interpreters,
+and which heavy dependencies each entry point loads.
+
+    python benchmarks/bench_startup.py --repeat 5
+'''
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+HEAVY = ['pandas', 'numpy', 'geopandas', 'fiona', 'shapely', 'ee', 'googleapiclient', 'oauth2client', 'httplib2']
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+CASES = {
+    'import GlaciersGEE.main': ['-c', 'import GlaciersGEE.main'],
+    'import GlaciersGEE.gee': ['-c', 'import GlaciersGEE.gee'],
+    'run.py help': [os.path.join(ROOT, 'run.py'), 'help'],
+    'run.py validate': [os.path.join(ROOT, 'run.py'), 'validate'],
+    # what every entry point paid when the package imported its dependencies eagerly
+    'eager dependencies': ['-c', 'import pandas, geopandas, fiona, shapely.geometry, ee, googleapiclient.discovery'],
+}
+
+LOADED = '''
+import runpy, sys, json, atexit
+atexit.register(lambda: sys.__stdout__.write('\\n' + json.dumps([m for m in %r if m in sys.modules])))
+sys.argv = %r
+%s
+'''
+
+
+def run_case(args, cwd):
+    start = time.perf_counter()
+    subprocess.run([sys.executable] + args, cwd=cwd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=False)
+    return time.perf_counter() - start
+
+
+def loaded_modules(args, cwd):
+    if args[0] == '-c':
+        code = LOADED % (HEAVY, ['-c'], args[1])
+    else:
+        code = LOADED % (HEAVY, args, 'runpy.run_path(%r, run_name="__main__")' % args[0])
+    out = subprocess.run([sys.executable, '-c', code], cwd=cwd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL).stdout
+    lines = out.decode().strip().splitlines()
+    return json.loads(lines[-1]) if lines else None
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--output', type=str, default=None, help='write the report as json')
+    args = parser.parse_args()
+
+    # run.py reads config/all-params.json from the working directory
+    cwd = tempfile.mkdtemp()
+    os.makedirs(os.path.join(cwd, 'config'))
+    with open(os.path.join(cwd, 'config', 'all-params.json'), 'w') as fh:
+        json.dump({'id_fp': 'ids.txt', 'data_dir': cwd, 'folder_name': 'glaciers', 'delimiter': None}, fh)
+
+    report = {}
+    for name, case in CASES.items():
+        times = [run_case(case, cwd) for _ in range(args.repeat)]
+        report[name] = {
+            'median_s': round(statistics.median(times), 3),
+            'min_s': round(min(times), 3),
+            'heavy_modules': loaded_modules(case, cwd),
+        }
+
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, 'w') as fh:
+            json.dump(report, fh, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,17 +1,69 @@
-from GlaciersGEE.main import *
 import json
+import os
 import sys
 
+CONFIG = 'config/all-params.json'
+REQUIRED_KEYS = ['id_fp', 'data_dir', 'folder_name', 'delimiter']
+
+USAGE = '''usage: python run.py [target ...]
+
+targets:
+	all        run the pipeline with config/all-params.json
+	dry-run    compile every glacier's export plan without creating folders,
+	           storing metadata or starting exports
+	validate   check config/all-params.json and exit
+	help       show this message
+'''
+
+def load_config(fp=CONFIG):
+	'''
+	Load and check the run configuration
+	:returns: tuple of (config dictionary, list of problems found)
+	'''
+	try:
+		with open(fp) as fh:
+			config = json.load(fh)
+	except IOError as e:
+		return {}, ['cannot read %s: %s' % (fp, e.strerror or e)]
+	except ValueError as e:
+		return {}, ['%s is not valid json: %s' % (fp, e)]
+	if not isinstance(config, dict):
+		return {}, ['%s does not hold a json object' % fp]
+	problems = ['missing key: %s' % k for k in REQUIRED_KEYS if k not in config]
+	if 'id_fp' in config and config.get('delimiter') and not os.path.exists(config['id_fp']):
+		problems.append('id_fp not found: %s' % config['id_fp'])
+	if 'data_dir' in config and not os.path.isdir(config['data_dir']):
+		problems.append('data_dir not found: %s' % config['data_dir'])
+	return config, problems
+
 def main(targets):
-	all_config = json.load(open('config/all-params.json'))
+	if not targets or 'help' in targets:
+		print(USAGE)
+		return
+
+	all_config, problems = load_config()
+	if problems or 'validate' in targets:
+		for p in problems:
+			print('config error:', p)
+		if not problems:
+			print('config ok')
+		return
+
+	if 'all' in targets or 'dry-run' in targets:
+		# the pipeline (and its geo, Earth Engine and Drive dependencies)
+		# is only imported once a target needs it
+		from GlaciersGEE.main import run_pipeline
 
-	if 'all' in targets:
 		id_fp = all_config['id_fp']
 		data_dir = all_config['data_dir']
 		folder_name = all_config['folder_name']
 		delimiter = all_config['delimiter']
-		run_pipeline(id_fp, data_dir, folder_name, delim=delimiter)
+		pool = all_config.get('pool', False)
+		ee_params = dict(all_config.get('ee_params', {}))
+		if 'dry-run' in targets:
+			ee_params['dry_run'] = True
+		run_pipeline(id_fp, data_dir, folder_name, delim=delimiter, pool=pool, ee_params=ee_params)
 
 if __name__ == '__main__':
 	targets = sys.argv[1:]
-	main(targets)
\ No newline at end of file
+	main(targets)
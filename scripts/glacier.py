@@ -1,5 +1,4 @@
 import argparse
-from GlacierProject.main import *
 
 parser = argparse.ArgumentParser()
 parser.add_argument('-d', '--datadir', help='data directory', type=str)
@@ -10,5 +9,3 @@ glimsid_list = args.list.split(',')
 
 print(args.datadir)
 print(glimsid_list)
-
-# run_pipeline(glimsid_list, args.datadir)
\ No newline at end of file
@@ -8,9 +8,12 @@ with open('requirements.txt') as fid:
 
 setup(
     name = 'GlaciersGEE',
-    packages = ['src'],
+    packages = ['GlaciersGEE'],
+    package_dir = {'GlaciersGEE': 'src'},
     version = '0.1.0',
     install_requires = install_requires,
+    # the datacube, tile mosaic and cluster cutting stages read rasters
+    extras_require = {'raster': ['rasterio==1.1.0']},
     description = 'Researching and predicting glacier recession',
     author = 'Darren Liu',
     author_email = '',
@@ -0,0 +1,208 @@
+import hashlib
+import json
+import os
+from collections import defaultdict
+
+# Glaciers are grouped by the grid cell (in degrees) holding the centre of
+# their bounding box; one cluster region covers the bboxes of its members.
+# Glaciers wider than a cell, or alone in their cell, are exported on their own.
+# A cluster is named after its cell and a hash of its members, so a cell whose
+# membership changes between runs gives a new cluster.
+
+CELL_SIZE = 0.25
+MAX_MEMBERS = 50
+
+# Cluster -> member bounds mapping written next to the pipeline outputs
+CLUSTERS = 'clusters.json'
+
+# ---------------------------------------------------------------------
+#
+# ---------------------------------------------------------------------
+
+
+def bbox_bounds(bbox):
+    '''
+    (minx, miny, maxx, maxy) of a bbox ring as returned by id_query
+    '''
+    xs = [p[0] for p in bbox]
+    ys = [p[1] for p in bbox]
+    return [min(xs), min(ys), max(xs), max(ys)]
+
+
+def bounds_ring(bounds):
+    '''
+    Closed ring of a bounds tuple, in the vertex order of build_lookup bboxes
+    '''
+    x0, y0, x1, y1 = bounds
+    return [(x0, y0), (x1, y0), (x1, y1), (x0, y1), (x0, y0)]
+
+
+def union_bounds(bounds_list):
+    return [
+        min(b[0] for b in bounds_list), min(b[1] for b in bounds_list),
+        max(b[2] for b in bounds_list), max(b[3] for b in bounds_list)
+    ]
+
+
+def _coord(value, pos, neg, decimals=2):
+    return '%0*.*f%s' % (decimals + 4, decimals, abs(value), pos if value >= 0 else neg)
+
+
+def _decimals(cell_size):
+    '''
+    Decimals needed to write every multiple of cell_size
+    '''
+    return len(('%.10f' % cell_size).rstrip('0').split('.')[1])
+
+
+def cluster_id(cell, members, cell_size=CELL_SIZE):
+    '''
+    Name of a cluster: the south-west corner of its cell, at cell
+    resolution, and a hash of its sorted member ids
+    '''
+    i, j = cell
+    decimals = _decimals(cell_size)
+    digest = hashlib.sha1(','.join(sorted(members)).encode()).hexdigest()[:10]
+    return 'cluster_%s_%s_%s' % (
+        _coord(i * cell_size, 'E', 'W', decimals), _coord(j * cell_size, 'N', 'S', decimals), digest)
+
+
+def cluster_glaciers(lookup, cell_size=CELL_SIZE, max_members=MAX_MEMBERS):
+    '''
+    Group nearby glaciers by grid cell.
+    :param lookup: dictionary of glac_id -> glacier dictionary with a 'bbox'
+    (output of build_lookup)
+    :param cell_size: grid cell size in degrees; also the largest bbox side
+    a glacier may have to be clustered
+    :param max_members: largest number of glaciers in one cluster; fuller
+    cells are split in order of longitude
+    :returns: dictionary of cluster id -> list of glac_ids, for cells holding
+    more than one glacier
+    '''
+    cells = defaultdict(list)
+    for glac_id, glacier in lookup.items():
+        x0, y0, x1, y1 = bbox_bounds(glacier['bbox'])
+        if x1 - x0 > cell_size or y1 - y0 > cell_size:
+            continue
+        cell = (int((x0 + x1) / 2 // cell_size), int((y0 + y1) / 2 // cell_size))
+        cells[cell].append(((x0 + x1) / 2, glac_id))
+
+    clusters = {}
+    for (i, j), members in sorted(cells.items()):
+        if len(members) < 2:
+            continue
+        members = [glac_id for (_, glac_id) in sorted(members)]
+        chunks = [members[k:k + max_members] for k in range(0, len(members), max_members)]
+        for chunk in chunks:
+            if len(chunk) > 1:
+                clusters[cluster_id((i, j), chunk, cell_size)] = chunk
+    return clusters
+
+
+def cluster_lookup(lookup, cell_size=CELL_SIZE, max_members=MAX_MEMBERS):
+    '''
+    Replace clustered glaciers in a lookup by one entry per cluster. A
+    cluster entry has the union bbox of its members as 'bbox' and 'coords',
+    the cluster id as 'glac_id', and the member glacier dictionaries as
+    'members'; ee_download exports it like a glacier, once per scene.
+    :returns: tuple of (lookup of clusters and unclustered glaciers, cluster
+    id -> {'bounds', 'members': glac_id -> bounds} mapping used to cut the
+    glaciers back out of the cluster rasters)
+    '''
+    groups = cluster_glaciers(lookup, cell_size=cell_size, max_members=max_members)
+    clustered = set(glac_id for members in groups.values() for glac_id in members)
+
+    out = {k: v for (k, v) in lookup.items() if k not in clustered}
+    mapping = {}
+    for cluster_id, members in groups.items():
+        member_bounds = {glac_id: bbox_bounds(lookup[glac_id]['bbox']) for glac_id in members}
+        bounds = union_bounds(list(member_bounds.values()))
+        ring = bounds_ring(bounds)
+        out[cluster_id] = {
+            'glac_id': cluster_id,
+            'coords': ring,
+            'bbox': ring,
+            'members': [lookup[glac_id] for glac_id in members],
+        }
+        mapping[cluster_id] = {'bounds': bounds, 'members': member_bounds}
+    return out, mapping
+
+
+def member_records(cluster):
+    '''
+    Glacier records of a cluster's members after its export, carrying the
+    cluster's scene dates and drive location and the cluster id.
+    '''
+    shared = {k: v for (k, v) in cluster.items() if k not in ('glac_id', 'coords', 'bbox', 'members')}
+    records = []
+    for member in cluster['members']:
+        record = dict(member)
+        record.update(shared)
+        record['cluster'] = cluster['glac_id']
+        records.append(record)
+    return records
+
+
+def write_clusters(mapping, fp=CLUSTERS, merge=True):
+    '''
+    Write the cluster mapping as json, atomically. With `merge`, the
+    clusters of earlier runs already in the file are kept.
+    '''
+    if merge and os.path.exists(fp):
+        mapping = dict(read_clusters(fp), **mapping)
+    tmp = fp + '.tmp'
+    with open(tmp, 'w') as fh:
+        json.dump(mapping, fh)
+    os.replace(tmp, fp)
+    return fp
+
+
+def read_clusters(fp=CLUSTERS):
+    with open(fp) as fh:
+        return json.load(fh)
+
+
+def cut_glacier(src_fp, bounds, dst_fp):
+    '''
+    Cut the window covering `bounds` (minx, miny, maxx, maxy, in lon/lat)
+    out of a downloaded cluster raster. Exports keep the projection of
+    their images (UTM for Landsat), so the bounds are projected to the
+    raster's crs first. Needs rasterio.
+    '''
+    import rasterio
+    from rasterio.warp import transform_bounds
+    from rasterio.windows import Window, from_bounds
+
+    with rasterio.open(src_fp) as src:
+        if src.crs is not None:
+            bounds = transform_bounds('EPSG:4326', src.crs, *bounds)
+        window = from_bounds(*bounds, transform=src.transform).round_offsets().round_lengths()
+        window = window.intersection(Window(0, 0, src.width, src.height))
+        profile = src.profile.copy()
+        profile.update(
+            width=window.width, height=window.height,
+            transform=src.window_transform(window)
+        )
+        data = src.read(window=window)
+
+    with rasterio.open(dst_fp, 'w', **profile) as dst:
+        dst.write(data)
+    return dst_fp
+
+
+def cut_cluster(cluster_dir, cluster, dest):
+    '''
+    Cut every glacier of a cluster out of each raster downloaded for it,
+    writing dest/<glac_id>/<raster name>, the layout of unclustered exports.
+    :param cluster_dir: directory holding the cluster's downloaded rasters
+    :param cluster: entry of the cluster mapping (see cluster_lookup)
+    :returns: list of files written
+    '''
+    rasters = sorted(f for f in os.listdir(cluster_dir) if f.lower().endswith(('.tif', '.tiff')))
+    written = []
+    for glac_id, bounds in cluster['members'].items():
+        out_dir = os.path.join(dest, glac_id)
+        os.makedirs(out_dir, exist_ok=True)
+        for name in rasters:
+            written.append(cut_glacier(os.path.join(cluster_dir, name), bounds, os.path.join(out_dir, name)))
+    return written
@@ -0,0 +1,240 @@
+import json
+import os
+import re
+
+from GlaciersGEE.gee import SENSORS, SENSOR_BANDS, BAND_NAMES, COMPOSITE
+from GlaciersGEE.tiles import is_tile
+
+# A glacier's scenes stacked into one array (time x band x y x x) stored as
+# .npy, so it can be memory mapped, plus a json index of dates and sensors
+
+CUBE = 'cube.npy'
+CUBE_INDEX = 'cube.json'
+
+# Sensor tag of the system:index appended to duplicate-date exports
+INDEX_PREFIXES = {'LC08': 'L8', 'LE07': 'L7', 'LT05': 'L5'}
+
+_SCENE_NAME = re.compile(r'^(\d{4}-\d{2}-\d{2})(?:_(.+))?\.tiff?$', re.IGNORECASE)
+
+# ---------------------------------------------------------------------
+#
+# ---------------------------------------------------------------------
+
+
+def scene_sensor(name, descriptions=None, record=None):
+    '''
+    Sensor of a downloaded scene, from the system:index in its file name,
+    its band names, or the date lists of the glacier record, in that order.
+    Composites (see gee.ee_download) are COMPOSITE.
+    '''
+    match = _SCENE_NAME.match(name)
+    date, index = match.groups()
+    if record is not None and os.path.splitext(name)[0] in (record.get('composites') or []):
+        return COMPOSITE
+    if index:
+        for prefix, sensor in INDEX_PREFIXES.items():
+            if prefix in index:
+                return sensor
+    if descriptions and all(descriptions):
+        for sensor in SENSORS:
+            if list(descriptions) == SENSOR_BANDS[sensor]:
+                return sensor
+        if list(descriptions) == BAND_NAMES:
+            return COMPOSITE
+    if record is not None:
+        for sensor in SENSORS:
+            if date in (record.get(sensor + 'Dates') or []):
+                return sensor
+    return None
+
+
+def list_scenes(folder, record=None):
+    '''
+    Scenes downloaded to a glacier folder, sorted by date then sensor.
+    Files not named by acquisition date, such as the DEM, and tiles not yet
+    mosaicked (see tiles.mosaic_tiles) are skipped.
+    :param record: glacier record (as stored by ee_download) used to tell
+    the sensor of scenes whose rasters carry no band names
+    :returns: list of dictionaries with name, date, sensor, size, mtime
+    '''
+    import rasterio
+
+    scenes = []
+    for name in sorted(os.listdir(folder)):
+        if not _SCENE_NAME.match(name) or is_tile(name):
+            continue
+        fp = os.path.join(folder, name)
+        with rasterio.open(fp) as src:
+            descriptions = src.descriptions
+        sensor = scene_sensor(name, descriptions, record)
+        if sensor is None:
+            print('Unknown sensor of %s, skipped' % fp)
+            continue
+        stat = os.stat(fp)
+        scenes.append({
+            'name': name, 'date': name[:10], 'sensor': sensor,
+            'size': stat.st_size, 'mtime': stat.st_mtime
+        })
+    order = SENSORS + [COMPOSITE]
+    scenes.sort(key=lambda s: (s['date'], order.index(s['sensor'])))
+    return scenes
+
+
+def build_datacube(folder, out=None, record=None, dtype='float32', force=False):
+    '''
+    Stack the scenes of a glacier folder into a memory-mapped datacube of
+    shape (time, band, y, x), bands named BAND_NAMES for every sensor.
+    Scenes are written one at a time, so the stack is never held in memory;
+    scenes on a different grid than the first are resampled onto it
+    (nearest neighbour), and missing pixels are NaN.
+    :param folder: directory of the glacier's downloaded GeoTIFFs
+    :param out: directory to write cube.npy and cube.json to, default `folder`
+    :param record: glacier record, see list_scenes
+    :param force: rebuild even if the cube is up to date with the scenes
+    :returns: filepath of the cube index, or None if there are no scenes
+    '''
+    import numpy as np
+    import rasterio
+    from rasterio.warp import reproject, Resampling
+
+    out = out or folder
+    index_fp = os.path.join(out, CUBE_INDEX)
+    scenes = list_scenes(folder, record=record)
+    if not scenes:
+        return None
+
+    sources = [[s['name'], s['size'], s['mtime']] for s in scenes]
+    if not force and os.path.exists(index_fp):
+        with open(index_fp) as fh:
+            if json.load(fh).get('sources') == sources:
+                return index_fp
+
+    with rasterio.open(os.path.join(folder, scenes[0]['name'])) as ref:
+        crs, transform, height, width = ref.crs, ref.transform, ref.height, ref.width
+
+    os.makedirs(out, exist_ok=True)
+    cube_fp = os.path.join(out, CUBE)
+    tmp = cube_fp + '.tmp.npy'
+    cube = np.lib.format.open_memmap(
+        tmp, mode='w+', dtype=dtype, shape=(len(scenes), len(BAND_NAMES), height, width))
+
+    for t, scene in enumerate(scenes):
+        with rasterio.open(os.path.join(folder, scene['name'])) as src:
+            bands = min(src.count, len(BAND_NAMES))
+            if (src.crs, src.transform, src.height, src.width) == (crs, transform, height, width):
+                cube[t, :bands] = src.read(list(range(1, bands + 1))).astype(dtype)
+            else:
+                for b in range(bands):
+                    dst = np.full((height, width), np.nan, dtype=dtype)
+                    reproject(
+                        rasterio.band(src, b + 1), dst,
+                        dst_transform=transform, dst_crs=crs, dst_nodata=np.nan,
+                        resampling=Resampling.nearest)
+                    cube[t, b] = dst
+            cube[t, bands:] = np.nan
+            if src.nodata is not None and not np.isnan(src.nodata):
+                cube[t][cube[t] == src.nodata] = np.nan
+    cube.flush()
+    del cube
+    os.replace(tmp, cube_fp)
+
+    index = {
+        'dates': [s['date'] for s in scenes],
+        'sensors': [s['sensor'] for s in scenes],
+        'bands': BAND_NAMES,
+        'crs': crs.to_string() if crs else None,
+        'transform': list(transform)[:6],
+        'shape': [len(scenes), len(BAND_NAMES), height, width],
+        'dtype': dtype,
+        'sources': sources,
+    }
+    tmp = index_fp + '.tmp'
+    with open(tmp, 'w') as fh:
+        json.dump(index, fh)
+    os.replace(tmp, index_fp)
+    return index_fp
+
+
+def build_datacubes(root, records=None, glac_ids=None, workers=1, force=False):
+    '''
+    Build the datacube of every glacier folder under `root` (as written by
+    download_files, one folder per glacier).
+    :param records: glacier records by glac_id, e.g. from MetadataStore.records()
+    :param glac_ids: glaciers to build, default every folder under root
+    :param workers: number of glaciers built at once
+    :returns: dictionary of glac_id -> cube index filepath, None, or the exception raised
+    '''
+    from concurrent.futures import ThreadPoolExecutor
+
+    records = records or {}
+    if glac_ids is None:
+        glac_ids = sorted(d for d in os.listdir(root) if os.path.isdir(os.path.join(root, d)))
+
+    def build(glac_id):
+        try:
+            return glac_id, build_datacube(
+                os.path.join(root, glac_id), record=records.get(glac_id), force=force)
+        except Exception as e:
+            print('Failed to build the datacube of %s: %r' % (glac_id, e))
+            return glac_id, e
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return dict(executor.map(build, glac_ids))
+
+
+class Datacube(object):
+    '''
+    Read-only view of a glacier datacube. `data` is memory mapped, so
+    slicing a time range or band reads only that part from disk.
+    '''
+
+    def __init__(self, path):
+        import numpy as np
+
+        folder = path if os.path.isdir(path) else os.path.dirname(path)
+        with open(os.path.join(folder, CUBE_INDEX)) as fh:
+            self.index = json.load(fh)
+        self.data = np.load(os.path.join(folder, CUBE), mmap_mode='r')
+        self.dates = np.array(self.index['dates'], dtype='datetime64[D]')
+        self.sensors = np.array(self.index['sensors'])
+        self.bands = list(self.index['bands'])
+        self.transform = self.index['transform']
+        self.crs = self.index['crs']
+
+    def __len__(self):
+        return len(self.dates)
+
+    @property
+    def shape(self):
+        return self.data.shape
+
+    def band(self, name):
+        '''
+        Time series of one band, shape (time, y, x)
+        '''
+        return self.data[:, self.bands.index(name)]
+
+    def between(self, start=None, end=None):
+        '''
+        Slice of the scenes acquired from `start` to `end` (inclusive);
+        a view, since scenes are sorted by date.
+        '''
+        import numpy as np
+
+        lo = 0 if start is None else int(np.searchsorted(self.dates, np.datetime64(start, 'D'), 'left'))
+        hi = len(self) if end is None else int(np.searchsorted(self.dates, np.datetime64(end, 'D'), 'right'))
+        return slice(lo, hi)
+
+    def select(self, start=None, end=None, bands=None, sensors=None):
+        '''
+        Scenes of a date range, optionally restricted to some bands and
+        sensors. Only the selected scenes and bands are read.
+        :returns: tuple of (array of shape (time, band, y, x), dates, sensors)
+        '''
+        import numpy as np
+
+        t = np.arange(len(self))[self.between(start, end)]
+        if sensors is not None:
+            t = t[np.isin(self.sensors[t], list(sensors))]
+        b = range(len(self.bands)) if bands is None else [self.bands.index(name) for name in bands]
+        return self.data[np.ix_(t, list(b))], self.dates[t], self.sensors[t]
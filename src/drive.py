@@ -1,9 +1,10 @@
 from __future__ import print_function
-from googleapiclient.discovery import build
-from httplib2 import Http
-from googleapiclient.http import MediaIoBaseDownload
-import io
+import json
 import os
+import threading
+import time
+
+from GlaciersGEE import ratelimit
 
 # tokens, credentials, etc
 
@@ -17,6 +18,30 @@ SCOPES = 'https://www.googleapis.com/auth/drive'
 
 PARENT_FOLDER_NAME = 'glaciers'
 
+# Local name -> ID index of the folders under the root folder (by default
+# PARENT_FOLDER_NAME), how long (seconds) it is trusted before being
+# re-crawled, and how many folders are recorded between writes to disk.
+
+FOLDER_INDEX = 'folder_index.json'
+FOLDER_INDEX_TTL = 24 * 60 * 60
+FOLDER_INDEX_SAVE_EVERY = 100
+
+FOLDER_MIMETYPE = 'application/vnd.google-apps.folder'
+
+# Maximum number of calls in one drive batch request, and how many times
+# items that failed inside a batch are retried.
+
+BATCH_SIZE = 100
+BATCH_RETRIES = 3
+
+# Bytes per ranged download request, files downloaded at once, attempts per
+# chunk and seconds between progress messages.
+
+DOWNLOAD_CHUNKSIZE = 32 * 1024 * 1024
+DOWNLOAD_WORKERS = 4
+DOWNLOAD_RETRIES = 5
+PROGRESS_INTERVAL = 10
+
 # ---------------------------------------------------------------------
 #
 # ---------------------------------------------------------------------
@@ -28,6 +53,8 @@ def start_service():
     from registering google drive to allows for python access. This function 
     must be run as a script.
     '''
+    from googleapiclient.discovery import build
+    from httplib2 import Http
     from oauth2client import file, client, tools
 
     store = file.Storage('token.json')
@@ -43,39 +70,235 @@ def query_from_drive(service, query, page_token):
     '''
     pass a query to the google drive api via given service.
     '''
-    resp = (
+    request = (
         service
         .files()
         .list(
-            q="mimeType ='application/vnd.google-apps.folder' and %s" % query,
+            q="mimeType ='%s' and %s" % (FOLDER_MIMETYPE, query),
             supportsAllDrives=True,
             includeItemsFromAllDrives=True,
             spaces='drive',
             fields='nextPageToken, files(id, name, size, parents)',
             pageToken=page_token
-        ).execute()
+        )
     )
+    resp = ratelimit.call('drive', request.execute)
 
     return resp
 
 
-def get_parent_folder_id(service, name=PARENT_FOLDER_NAME):
+class FolderIndex(object):
+    '''
+    Persistent name -> ID index of the drive folders in the `root` tree.
+    The index is warmed by a single paginated crawl of all folders and is
+    re-crawled once it is older than `ttl` seconds. Lookups and creations
+    of folders are served from the index so they cost no remote calls
+    after warm-up. Folders added one at a time are written to disk every
+    `save_every` additions and on flush().
+    '''
+
+    def __init__(self, fp=FOLDER_INDEX, ttl=FOLDER_INDEX_TTL, root=PARENT_FOLDER_NAME,
+                 save_every=FOLDER_INDEX_SAVE_EVERY):
+        self.fp = fp
+        self.ttl = ttl
+        self.root = root
+        self.save_every = save_every
+        self.unsaved = 0
+        self.warmed = 0
+        # folder id -> {'name': name, 'parent': parent id, 'complete': whether
+        # every child of the folder is known to the index}
+        self.folders = {}
+        self._lock = threading.RLock()
+        self.load()
+
+    def load(self):
+        '''
+        Load the index from disk, if present.
+        '''
+        if self.fp is None or not os.path.exists(self.fp):
+            return
+        try:
+            with open(self.fp) as fh:
+                data = json.load(fh)
+        except ValueError:
+            return
+        if data.get('root', self.root) != self.root:
+            # crawled for another root folder
+            return
+        self.warmed = data.get('warmed', 0)
+        self.folders = data.get('folders', {})
+
+    def save(self):
+        '''
+        Write the index to disk atomically.
+        '''
+        if self.fp is None:
+            return
+        with self._lock:
+            tmp = self.fp + '.tmp'
+            with open(tmp, 'w') as fh:
+                json.dump({'root': self.root, 'warmed': self.warmed, 'folders': self.folders}, fh)
+            os.replace(tmp, self.fp)
+            self.unsaved = 0
+
+    def flush(self):
+        '''
+        Write the folders added since the last save, if any.
+        '''
+        with self._lock:
+            if self.unsaved:
+                self.save()
+
+    def is_stale(self):
+        return time.time() - self.warmed > self.ttl
+
+    def invalidate(self):
+        with self._lock:
+            self.warmed = 0
+            self.folders = {}
+            self.save()
+
+    def warm(self, service):
+        '''
+        Crawl every folder on drive with one paginated query and keep the
+        ones inside the `root` tree.
+        '''
+        page_token = None
+        found = {}
+        while True:
+            resp = query_from_drive(service, 'trashed = false', page_token)
+            for f in resp.get('files', []):
+                found[f.get('id')] = {
+                    'name': f.get('name'),
+                    'parent': (f.get('parents') or [None])[0],
+                    'complete': True
+                }
+            page_token = resp.get('nextPageToken', None)
+            if page_token is None:
+                break
+
+        # keep the root folders and everything below them
+        tree = {k: v for (k, v) in found.items() if v['name'] == self.root}
+        added = True
+        while added:
+            added = False
+            for k, v in found.items():
+                if k not in tree and v['parent'] in tree:
+                    tree[k] = v
+                    added = True
+
+        with self._lock:
+            self.folders = tree
+            self.warmed = time.time()
+            self.save()
+
+    def ensure(self, service):
+        '''
+        Warm the index if it has expired.
+        '''
+        with self._lock:
+            if self.is_stale():
+                self.warm(service)
+
+    def find(self, name, parent=None):
+        '''
+        ID of the folder called `name` (inside `parent` if given), or None.
+        '''
+        with self._lock:
+            for k, v in self.folders.items():
+                if v['name'] == name and (parent is None or v['parent'] == parent):
+                    return k
+        return None
+
+    def children(self, parent):
+        '''
+        Dictionary of name -> ID of the folders inside `parent`.
+        '''
+        with self._lock:
+            return {v['name']: k for (k, v) in self.folders.items() if v['parent'] == parent}
+
+    def is_complete(self, folder_id):
+        '''
+        Whether all children of `folder_id` are known to the index.
+        '''
+        with self._lock:
+            return self.folders.get(folder_id, {}).get('complete', False)
+
+    def add(self, name, folder_id, parent=None, complete=True):
+        '''
+        Record a folder; `complete` should be False for existing folders
+        found outside of a crawl, whose children are unknown.
+        '''
+        with self._lock:
+            self.folders[folder_id] = {'name': name, 'parent': parent, 'complete': complete}
+            self.unsaved += 1
+            if self.unsaved >= self.save_every:
+                self.save()
+
+    def add_many(self, names_ids, parent=None, complete=True):
+        '''
+        Record many folders inside `parent` with a single write to disk.
+        :param names_ids: dictionary of folder name -> folder id
+        '''
+        with self._lock:
+            for name, folder_id in names_ids.items():
+                self.folders[folder_id] = {'name': name, 'parent': parent, 'complete': complete}
+            self.save()
+
+
+_folder_index = None
+_folder_index_lock = threading.Lock()
+
+
+def get_folder_index(root=None):
+    '''
+    The folder index shared by every drive call in this process.
+    :param root: name of the root folder to index; the index is re-crawled
+    if it covers another root
+    '''
+    global _folder_index
+    with _folder_index_lock:
+        if _folder_index is None:
+            _folder_index = FolderIndex(root=root or PARENT_FOLDER_NAME)
+        elif root is not None and root != _folder_index.root:
+            _folder_index.root = root
+            _folder_index.invalidate()
+        return _folder_index
+
+
+def get_parent_folder_id(service, name=PARENT_FOLDER_NAME, index=None):
     '''
-    Obtain the parent folder ID from the name.
+    Obtain the parent folder ID from the name. Served from the folder index
+    when the folder is known; otherwise queries drive.
     '''
+    index = index or get_folder_index()
+    index.ensure(service)
+    folder_id = index.find(name)
+    if folder_id is not None:
+        return folder_id
+
     page_token = None
     resp = query_from_drive(service, "name='%s'" % name, page_token)
     files = resp.get('files', [])
-    matches = {f.get('name'): f.get('id') for f in files}
-    return matches[name]
+    matches = {f.get('name'): f for f in files}
+    match = matches[name]
+    index.add(name, match.get('id'), (match.get('parents') or [None])[0], complete=False)
+    return match.get('id')
 
 
-def create_folder(service, folder_name, parentID=None):
+def create_folder(service, folder_name, parentID=None, index=None):
     '''
     Create a folder in drive with `folder_name`. If parentID is given,
     create the folder in the folder with id=ParentID. Returns the id
-    of the newly created folder.
+    of the newly created folder, or of the existing folder if the
+    folder index already has one with that name and parent.
     '''
+    index = index or get_folder_index()
+    index.ensure(service)
+    existing = index.find(folder_name, parent=parentID) if parentID else index.find(folder_name)
+    if existing is not None:
+        return existing
+
     # Create a folder on Drive, returns the newely created folders ID
     body = {
         'name': folder_name,
@@ -83,18 +306,117 @@ def create_folder(service, folder_name, parentID=None):
     }
     if parentID:
         body['parents'] = [parentID]
-    root_folder = service.files().create(body=body).execute()
+    # not idempotent: only retried if the request was rejected by a rate limit
+    root_folder = ratelimit.call('drive', service.files().create(body=body).execute, idempotent=False)
+    index.add(folder_name, root_folder['id'], parentID)
     return root_folder['id']
 
 
-def get_folder_ids(service, parent_id, glims_ids=None):
+def batch_execute(service, requests, batch_size=BATCH_SIZE, retries=BATCH_RETRIES, idempotent=False):
+    '''
+    Execute many drive calls using batch requests. Items that fail inside a
+    batch are retried on their own in the next round, up to `retries` times.
+    :param requests: dictionary of key -> function returning an unexecuted
+    drive request (requests cannot be re-added to a new batch once sent)
+    :param idempotent: whether the requests are safe to send twice (e.g.
+    read-only lists); only then is a batch that fails as a whole retried
+    :returns: tuple of (key -> response, key -> last error) dictionaries
+    '''
+    responses = {}
+    errors = {}
+    pending = list(requests)
+
+    for attempt in range(retries + 1):
+        if not pending:
+            break
+        errors = {}
+
+        def callback(request_id, response, exception):
+            if exception is not None:
+                errors[request_id] = exception
+            else:
+                responses[request_id] = response
+
+        for k in range(0, len(pending), batch_size):
+            batch = service.new_batch_http_request(callback=callback)
+            chunk = pending[k:k + batch_size]
+            for key in chunk:
+                batch.add(requests[key](), request_id=str(key))
+            # items failing inside the batch are retried below
+            ratelimit.call('drive.batch', batch.execute, n=len(chunk), idempotent=idempotent)
+
+        pending = [key for key in pending if str(key) in errors]
+        if pending and attempt < retries:
+            time.sleep(2 ** attempt)
+
+    return responses, {key: errors[str(key)] for key in pending}
+
+
+def create_folders(service, folder_names, parentID=None, index=None):
+    '''
+    Create or resolve many folders inside the folder with id=parentID using
+    batched drive requests. Folders that already exist are reused.
+    :param folder_names: iterable of folder names
+    :returns: dictionary of folder name -> folder id; names that could not
+    be created after retrying are left out
+    '''
+    index = index or get_folder_index()
+    index.ensure(service)
+    folder_names = [str(f) for f in dict.fromkeys(folder_names)]
+
+    # resolve existing folders: from the index if it knows every child of
+    # the parent, otherwise with one batched name query per folder
+    if parentID and index.is_complete(parentID):
+        known = index.children(parentID)
+    else:
+        in_parent = " and '%s' in parents" % parentID if parentID else ''
+        queries = {
+            name: (lambda name=name: service.files().list(
+                q="mimeType ='%s' and name='%s' and trashed = false%s" % (FOLDER_MIMETYPE, name, in_parent),
+                spaces='drive',
+                fields='files(id, name)'))
+            for name in folder_names
+        }
+        found, _ = batch_execute(service, queries, idempotent=True)
+        known = {name: resp['files'][0]['id'] for (name, resp) in found.items() if resp.get('files')}
+        index.add_many(known, parent=parentID, complete=False)
+
+    folder_ids = {name: known[name] for name in folder_names if name in known}
+    missing = [name for name in folder_names if name not in folder_ids]
+    existing = len(folder_ids)
+
+    def create_request(name):
+        body = {'name': name, 'mimeType': FOLDER_MIMETYPE}
+        if parentID:
+            body['parents'] = [parentID]
+        return lambda: service.files().create(body=body, fields='id')
+
+    created, failed = batch_execute(service, {name: create_request(name) for name in missing})
+    created = {name: resp['id'] for (name, resp) in created.items()}
+    index.add_many(created, parent=parentID)
+    folder_ids.update(created)
+
+    print('Folders: %d existing, %d created, %d failed' % (existing, len(created), len(failed)))
+    return folder_ids
+
+
+def get_folder_ids(service, parent_id, glims_ids=None, index=None):
     '''
     Returns a dictionary of glacier id folder names, and their
-    respective IDs on google drive.
+    respective IDs on google drive. Served from the folder index when
+    `parent_id` is inside the indexed tree.
     '''
+    index = index or get_folder_index()
+    index.ensure(service)
     page_token = None
     folder_ids = {}
 
+    if index.is_complete(parent_id):
+        folder_ids = index.children(parent_id)
+        if glims_ids:
+            folder_ids = {k: v for (k, v) in folder_ids.items() if k in glims_ids}
+        return folder_ids
+
     while True:
 
         resp = query_from_drive(service, "'%s' in parents" % parent_id, page_token)
@@ -112,16 +434,175 @@ def get_folder_ids(service, parent_id, glims_ids=None):
     return folder_ids
 
 
-def download_file(service, file_name, file_id):
-    request = service.files().get_media(fileId=file_id)
-    fh = io.FileIO(file_name, 'wb')
-    downloader = MediaIoBaseDownload(fh, request)
-    done = False
-    while done is False:
-        status, done = downloader.next_chunk()
-        print("Download %d%%." % int(status.progress() * 100))
+class DownloadProgress(object):
+    '''
+    Aggregate progress and throughput of a bulk download, printed at most
+    every `interval` seconds.
+    '''
 
-    return
+    def __init__(self, n_files, total_bytes=0, interval=PROGRESS_INTERVAL):
+        self.n_files = n_files
+        self.total_bytes = total_bytes
+        self.interval = interval
+        self.files_done = 0
+        self.bytes_done = 0
+        self.started = time.time()
+        self.last_report = self.started
+        self._lock = threading.Lock()
+
+    def add(self, n_bytes=0, files=0):
+        with self._lock:
+            self.bytes_done += n_bytes
+            self.files_done += files
+            now = time.time()
+            if now - self.last_report >= self.interval or self.files_done == self.n_files:
+                self.last_report = now
+                print(self.report())
+
+    def throughput(self):
+        return self.bytes_done / max(time.time() - self.started, 1e-9)
+
+    def report(self):
+        pct = ' (%d%%)' % (100 * self.bytes_done / self.total_bytes) if self.total_bytes else ''
+        return 'Downloaded %d/%d files, %.1f MB%s, %.2f MB/s' % (
+            self.files_done, self.n_files, self.bytes_done / 1e6, pct, self.throughput() / 1e6)
+
+
+def list_files(service, folder_id):
+    '''
+    List the (non-folder) files inside a drive folder.
+    :returns: list of dictionaries with the id, name and size of each file
+    '''
+    page_token = None
+    files = []
+    while True:
+        request = (
+            service
+            .files()
+            .list(
+                q="'%s' in parents and mimeType != '%s' and trashed = false" % (folder_id, FOLDER_MIMETYPE),
+                supportsAllDrives=True,
+                includeItemsFromAllDrives=True,
+                spaces='drive',
+                fields='nextPageToken, files(id, name, size)',
+                pageToken=page_token
+            )
+        )
+        resp = ratelimit.call('drive', request.execute)
+        files.extend(resp.get('files', []))
+        page_token = resp.get('nextPageToken', None)
+        if page_token is None:
+            break
+    return files
+
+
+def trash_files(service, file_ids):
+    '''
+    Move drive files to the trash using batched requests.
+    :returns: list of the ids that could not be trashed
+    '''
+    requests = {
+        file_id: (lambda file_id=file_id: service.files().update(fileId=file_id, body={'trashed': True}, fields='id'))
+        for file_id in file_ids
+    }
+    _, failed = batch_execute(service, requests, idempotent=True)
+    return list(failed)
+
+
+def download_file(service, file_name, file_id, size=None, chunk_size=DOWNLOAD_CHUNKSIZE, progress=None):
+    '''
+    Download a drive file with ranged requests of `chunk_size` bytes. Data
+    is written to `file_name`.part and renamed when complete, so an
+    interrupted download resumes from the bytes already on disk.
+    :param size: size of the file in bytes, if known
+    :param progress: DownloadProgress to report downloaded bytes to
+    '''
+    if os.path.exists(file_name) and (size is None or os.path.getsize(file_name) == int(size)):
+        return file_name
+
+    request = service.files().get_media(fileId=file_id)
+    part = file_name + '.part'
+    offset = os.path.getsize(part) if os.path.exists(part) else 0
+    size = int(size) if size is not None else None
+
+    with open(part, 'ab') as fh:
+        while size is None or offset < size:
+            headers = {'range': 'bytes=%d-%d' % (offset, offset + chunk_size - 1)}
+            for attempt in range(DOWNLOAD_RETRIES):
+                resp, content = ratelimit.call('drive.download', request.http.request, request.uri, headers=headers)
+                if resp.status in (200, 206) or (resp.status == 416 and size is None):
+                    break
+                if attempt == DOWNLOAD_RETRIES - 1 or (resp.status < 500 and resp.status != 429):
+                    raise IOError('Download of %s failed with HTTP %d' % (file_name, resp.status))
+                time.sleep(2 ** attempt)
+
+            if resp.status == 416:
+                # asked past the end of a file of unknown size
+                break
+            if resp.status == 200:
+                # server ignored the range and sent the whole file
+                fh.seek(0)
+                fh.truncate()
+                offset = 0
+                size = len(content)
+            elif size is None and 'content-range' in resp:
+                size = int(resp['content-range'].rsplit('/', 1)[1])
+
+            fh.write(content)
+            offset += len(content)
+            if progress is not None:
+                progress.add(n_bytes=len(content))
+            if not content or resp.status == 200:
+                break
+
+    os.replace(part, file_name)
+    return file_name
+
+
+_download_state = threading.local()
+
+
+def download_files(files, dest, service=None, chunk_size=DOWNLOAD_CHUNKSIZE, workers=DOWNLOAD_WORKERS):
+    '''
+    Download many drive files concurrently, resuming partial downloads.
+    :param files: a drive folder id, or list of file ids or of dictionaries
+    with the id, name and size of each file (as from list_files)
+    :param dest: local directory to download to
+    :param service: drive service used to list a folder; each worker thread
+    starts its own service for downloading
+    :param chunk_size: bytes per ranged request
+    :param workers: number of files downloaded at once
+    :returns: dictionary of file id -> local path, or the exception raised
+    '''
+    if isinstance(files, str):
+        files = list_files(service or start_service(), files)
+    files = [f if isinstance(f, dict) else {'id': f, 'name': f} for f in files]
+    os.makedirs(dest, exist_ok=True)
+
+    total = sum(int(f['size']) for f in files) if all(f.get('size') for f in files) else 0
+    progress = DownloadProgress(len(files), total_bytes=total)
+
+    def worker(f):
+        # httplib2 is not thread safe: one service per worker thread
+        thread_service = getattr(_download_state, 'service', None)
+        if thread_service is None:
+            thread_service = _download_state.service = start_service()
+        try:
+            path = download_file(
+                thread_service, os.path.join(dest, f['name']), f['id'],
+                size=f.get('size'), chunk_size=chunk_size, progress=progress
+            )
+        except Exception as e:
+            print('Failed to download %s: %r' % (f['name'], e))
+            path = e
+        progress.add(files=1)
+        return f['id'], path
+
+    from concurrent.futures import ThreadPoolExecutor
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        results = dict(executor.map(worker, files))
+
+    return results
 
 
 def main():
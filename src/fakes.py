@@ -0,0 +1,645 @@
+import abc
+import itertools
+import random
+import re
+import threading
+import time
+
+from GlaciersGEE.tasks import OPERATION_STATES
+
+# ---------------------------------------------------------------------
+# Local stand-ins for the Google services used by the pipeline
+# ---------------------------------------------------------------------
+
+
+class FakeClock(object):
+    '''
+    Manually advanced clock; pass `clock` and `sleep` to code that takes them
+    so waiting costs no real time.
+    '''
+
+    def __init__(self, start=0.):
+        self.now = start
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+class FakeTask(object):
+    '''
+    Stand-in for an ee.batch.Task returned by ee.batch.Export.*.toDrive.
+    '''
+
+    def __init__(self, service, config):
+        self.service = service
+        self.config = config
+        self.id = None
+        self.state = 'UNSUBMITTED'
+
+    def start(self):
+        self.service.start(self)
+
+    def status(self):
+        return self.service.getTaskStatus([self.id])[0]
+
+
+class FakeTaskService(object):
+    '''
+    Stand-in for Earth Engine task submission and status (ee.batch,
+    ee.data.listOperations and ee.data.getTaskStatus). Started tasks run for `run_seconds` of clock
+    time, at most `capacity` at once, and fail with probability `fail_rate`.
+    Every call is recorded in `calls`.
+    '''
+
+    def __init__(self, run_seconds=60, capacity=None, fail_rate=0., seed=0, clock=time.time):
+        self.run_seconds = run_seconds
+        self.capacity = capacity
+        self.fail_rate = fail_rate
+        self.clock = clock
+        self.random = random.Random(seed)
+        self.tasks = {}
+        self.calls = []
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def toDrive(self, **config):
+        '''
+        Create an unstarted export task, like ee.batch.Export.image.toDrive.
+        '''
+        self.calls.append(('toDrive', config.get('fileNamePrefix')))
+        return FakeTask(self, config)
+
+    def start(self, task):
+        with self._lock:
+            self.calls.append(('start', task.config.get('fileNamePrefix')))
+            task.id = 'FAKE%06d' % next(self._ids)
+            task.state = 'READY'
+            task.submitted = self.clock()
+            task.began = None
+            task.fails = self.random.random() < self.fail_rate
+            self.tasks[task.id] = task
+
+    def _advance(self):
+        now = self.clock()
+        running = [t for t in self.tasks.values() if t.state == 'RUNNING']
+        for t in running:
+            if now - t.began >= self.run_seconds:
+                t.state = 'FAILED' if t.fails else 'COMPLETED'
+        running = sum(t.state == 'RUNNING' for t in self.tasks.values())
+        for t in sorted(self.tasks.values(), key=lambda t: t.submitted):
+            if t.state != 'READY':
+                continue
+            if self.capacity is not None and running >= self.capacity:
+                break
+            t.state = 'RUNNING'
+            t.began = now
+            running += 1
+
+    def getTaskStatus(self, task_ids):
+        '''
+        Like ee.data.getTaskStatus: status dictionaries for many tasks.
+        '''
+        with self._lock:
+            self.calls.append(('getTaskStatus', len(task_ids)))
+            self._advance()
+            out = []
+            for task_id in task_ids:
+                t = self.tasks.get(task_id)
+                if t is None:
+                    out.append({'id': task_id, 'state': 'UNKNOWN'})
+                    continue
+                status = {'id': task_id, 'state': t.state}
+                if t.state == 'FAILED':
+                    status['error_message'] = 'fake failure'
+                out.append(status)
+            return out
+
+    def listOperations(self):
+        '''
+        Like ee.data.listOperations: an operation dictionary for every task.
+        '''
+        states = {task: operation for (operation, task) in OPERATION_STATES.items()}
+        with self._lock:
+            self.calls.append(('listOperations', len(self.tasks)))
+            self._advance()
+            out = []
+            for t in self.tasks.values():
+                operation = {
+                    'name': 'projects/earthengine-legacy/operations/' + t.id,
+                    'metadata': {'state': states[t.state], 'description': t.config.get('fileNamePrefix')},
+                    'done': t.state in ('COMPLETED', 'FAILED', 'CANCELLED'),
+                }
+                if t.state == 'FAILED':
+                    operation['error'] = {'message': 'fake failure'}
+                out.append(operation)
+            return out
+
+    def cancel(self, task_id):
+        with self._lock:
+            self.tasks[task_id].state = 'CANCELLED'
+
+    def count(self, name):
+        '''
+        Number of recorded calls called `name`.
+        '''
+        return sum(1 for c in self.calls if c[0] == name)
+
+
+# ---------------------------------------------------------------------
+# Earth Engine
+# ---------------------------------------------------------------------
+
+# Synthetic Landsat archive: collection id -> (sensor, spacecraft, first, last date)
+FAKE_COLLECTIONS = {
+    'LANDSAT/LC08/C01/T1_TOA': ('LC08', 'LANDSAT_8', '2013-04-11', '2099-12-31'),
+    'LANDSAT/LE07/C01/T1_TOA': ('LE07', 'LANDSAT_7', '1999-05-28', '2099-12-31'),
+    'LANDSAT/LT05/C01/T1_TOA': ('LT05', 'LANDSAT_5', '1984-03-01', '2012-05-05'),
+}
+
+
+class CallRecorder(object):
+    '''
+    Records calls to a fake backend and sleeps `latency` seconds for every
+    call that would be a round trip to the real service.
+    '''
+
+    def __init__(self, latency=0., sleep=time.sleep):
+        self.latency = latency
+        self.sleep = sleep
+        self.calls = []
+        self._lock = threading.Lock()
+
+    def record(self, name, detail=None, round_trip=True):
+        with self._lock:
+            self.calls.append((name, detail))
+        if round_trip and self.latency:
+            self.sleep(self.latency)
+
+    def count(self, name=None):
+        return sum(1 for c in self.calls if name is None or c[0] == name)
+
+
+class _Computed(abc.ABC):
+    '''
+    Base of the fake server-side objects: values are computed locally and
+    only getInfo() counts as a round trip. `ee` is the FakeEE most recently
+    created.
+    '''
+    ee = None
+
+    @abc.abstractmethod
+    def value(self):
+        '''
+        Local value of the object, as getInfo would return it
+        '''
+
+    def getInfo(self):
+        self.ee.recorder.record('getInfo', type(self).__name__)
+        return _evaluate(self)
+
+
+def _evaluate(obj):
+    if isinstance(obj, _Computed):
+        return _evaluate(obj.value())
+    if isinstance(obj, dict):
+        return {k: _evaluate(v) for (k, v) in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return [_evaluate(v) for v in obj]
+    return obj
+
+
+class _Value(_Computed):
+    def __init__(self, value):
+        self._value = value
+
+    def value(self):
+        return self._value
+
+
+class _Dictionary(_Computed):
+    def __init__(self, values=None):
+        if isinstance(values, _Dictionary):
+            values = values.values
+        self.values = dict(values or {})
+
+    def value(self):
+        return self.values
+
+    def get(self, key):
+        return _Value(self.values.get(key))
+
+
+class _List(_Computed):
+    def __init__(self, items):
+        if isinstance(items, _List):
+            items = items.items
+        self.items = list(items)
+
+    def value(self):
+        return self.items
+
+    def get(self, index):
+        return self.items[int(_evaluate(index))]
+
+    def map(self, algorithm):
+        return _List([algorithm(item) for item in self.items])
+
+    def size(self):
+        return _Value(len(self.items))
+
+
+class _Geometry(_Computed):
+    def __init__(self, coords, *args, **kwargs):
+        if isinstance(coords, dict):
+            # GeoJSON, as ee.Geometry(geo_json)
+            coords = coords['coordinates'][0]
+        self.coords = _evaluate(coords)
+
+    def value(self):
+        return {'type': 'Polygon', 'coordinates': [self.coords]}
+
+    def bounds(self, *args, **kwargs):
+        xs = [c[0] for c in self.coords]
+        ys = [c[1] for c in self.coords]
+        x0, x1, y0, y1 = min(xs), max(xs), min(ys), max(ys)
+        return _Geometry([[x0, y0], [x1, y0], [x1, y1], [x0, y1], [x0, y0]])
+
+
+class _Image(_Computed):
+    def __init__(self, source=None, props=None, bands=None):
+        if isinstance(source, _Image):
+            props, bands = source.props, source.bands
+        elif isinstance(source, str):
+            collection_id, _, index = source.rpartition('/')
+            scene = None
+            if collection_id in FAKE_COLLECTIONS:
+                # a scene of a collection, by its system:index
+                scene = next((i for i in self.ee.archive(collection_id) if i.props['system:index'] == index), None)
+            if scene is not None:
+                props, bands = scene.props, scene.bands
+            else:
+                props = {'system:id': source, 'system:index': source.replace('/', '_')}
+        self.props = dict(props or {})
+        self.bands = bands
+
+    def value(self):
+        return {'type': 'Image', 'bands': self.bands, 'properties': self.props}
+
+    def get(self, prop):
+        return _Value(self.props.get(prop))
+
+    def set(self, *args):
+        props = dict(self.props)
+        if len(args) == 1:
+            props.update(_evaluate(args[0]))
+        else:
+            props[args[0]] = _evaluate(args[1])
+        return _Image(props=props, bands=self.bands)
+
+    def clip(self, geometry):
+        return _Image(self)
+
+    def select(self, bands, *args):
+        bands = [bands] if isinstance(bands, str) else list(bands)
+        if args and args[0] is not None:
+            # renamed, as select(selectors, names)
+            bands = list(args[0])
+        return _Image(props=self.props, bands=bands)
+
+    def reduceRegion(self, reducer, geometry=None, scale=None, **kwargs):
+        self.ee.recorder.record('reduceRegion', scale, round_trip=False)
+        return _Dictionary({b: self.props.get('_' + b) for b in (self.bands or [])})
+
+
+class _Filter(object):
+    def __init__(self, predicate):
+        self.predicate = predicate
+
+    @staticmethod
+    def lt(name, value):
+        return _Filter(lambda props: props.get(name) is not None and props.get(name) < value)
+
+    @staticmethod
+    def gt(name, value):
+        return _Filter(lambda props: props.get(name) is not None and props.get(name) > value)
+
+    @staticmethod
+    def date(start, end):
+        return _Filter(lambda props: start <= props.get('DATE_ACQUIRED', '') < end)
+
+
+class _ImageCollection(_Computed):
+    def __init__(self, source):
+        if isinstance(source, str):
+            source = self.ee.archive(source)
+        self.images = list(source)
+
+    def value(self):
+        return {'type': 'ImageCollection', 'features': [i.value() for i in self.images]}
+
+    def filterDate(self, start, end):
+        return self.filter(_Filter.date(str(start), str(end)))
+
+    def filterBounds(self, geometry):
+        return _ImageCollection(self.images)
+
+    def filter(self, flt):
+        return _ImageCollection([i for i in self.images if flt.predicate(i.props)])
+
+    def map(self, algorithm):
+        return _ImageCollection([algorithm(i) for i in self.images])
+
+    def select(self, bands, *args):
+        return _ImageCollection([i.select(bands, *args) for i in self.images])
+
+    def merge(self, other):
+        return _ImageCollection(self.images + other.images)
+
+    def median(self):
+        bands = self.images[0].bands if self.images else []
+        return _Image(props={'SPACECRAFT_ID': 'COMPOSITE', 'scenes': len(self.images)}, bands=bands)
+
+    def size(self):
+        return _Value(len(self.images))
+
+    def toList(self, count, offset=0):
+        return _List(self.images[offset:offset + int(_evaluate(count))])
+
+    def aggregate_array(self, prop):
+        return _List([i.props.get(prop) for i in self.images])
+
+
+class FakeEE(object):
+    '''
+    In-process stand-in for the subset of the `ee` module used by the
+    pipeline, over a synthetic Landsat archive of `scenes_per_year` scenes
+    per sensor. Every getInfo, task start and task status call is recorded
+    in `recorder`, with `latency` seconds of delay. Install it with
+    install_fake_ee().
+    '''
+
+    class EEException(Exception):
+        pass
+
+    def __init__(self, latency=0., scenes_per_year=12, seed=0, tasks=None, sleep=time.sleep):
+        self.recorder = CallRecorder(latency, sleep=sleep)
+        self.scenes_per_year = scenes_per_year
+        self.seed = seed
+        self.tasks = tasks or FakeTaskService(run_seconds=0)
+        self._archives = {}
+
+        ee = _Computed.ee = self
+
+        self.Image = _Image
+        self.ImageCollection = _ImageCollection
+        self.List = _List
+        self.Dictionary = _Dictionary
+        self.Filter = _Filter
+        self.Geometry = type('Geometry', (_Geometry,), {'Polygon': _Geometry, 'Rectangle': _Geometry})
+        self.Reducer = type('Reducer', (object,), {'mean': staticmethod(lambda: 'mean'), 'median': staticmethod(lambda: 'median')})
+
+        def simple_cloud_score(image):
+            return ee.Image(image).set('_cloud', image.props.get('_cloud'))
+
+        landsat = type('Landsat', (object,), {'simpleCloudScore': staticmethod(simple_cloud_score)})
+        self.Algorithms = type('Algorithms', (object,), {'Landsat': landsat})
+
+        def to_drive(**config):
+            return ee.tasks.toDrive(**config)
+
+        def start(task):
+            ee.recorder.record('startTask', task.config.get('fileNamePrefix'))
+            FakeTaskService.start(ee.tasks, task)
+
+        def get_task_status(task_ids):
+            ee.recorder.record('getTaskStatus', len(task_ids))
+            return ee.tasks.getTaskStatus(task_ids)
+
+        def list_operations(project=None):
+            ee.recorder.record('listOperations')
+            return ee.tasks.listOperations()
+
+        self.tasks.start = start
+        export = type('Export', (object,), {'image': type('image', (object,), {'toDrive': staticmethod(to_drive)})})
+        self.batch = type('batch', (object,), {'Export': export})
+        self.data = type('data', (object,), {
+            'getTaskStatus': staticmethod(get_task_status),
+            'listOperations': staticmethod(list_operations),
+        })
+
+    def Initialize(self, *args, **kwargs):
+        self.recorder.record('Initialize', round_trip=False)
+
+    def Authenticate(self, *args, **kwargs):
+        pass
+
+    def archive(self, collection_id):
+        '''
+        Synthetic scenes of a collection, each with the properties the
+        pipeline reads and a precomputed cloud score.
+        '''
+        if collection_id not in self._archives:
+            prefix, spacecraft, first, last = FAKE_COLLECTIONS[collection_id]
+            rng = random.Random('%s-%s' % (self.seed, collection_id))
+            start = time.mktime(time.strptime(first, '%Y-%m-%d'))
+            end = min(time.mktime(time.strptime(last, '%Y-%m-%d')), time.mktime(time.strptime('2020-01-01', '%Y-%m-%d')))
+            step = 365.25 * 86400 / self.scenes_per_year
+            images = []
+            t = start
+            while t < end:
+                day = time.strftime('%Y-%m-%d', time.gmtime(t))
+                cover = rng.uniform(0, 100)
+                props = {
+                    'system:index': '%s_046027_%s' % (prefix, day.replace('-', '')),
+                    'DATE_ACQUIRED': day,
+                    'SPACECRAFT_ID': spacecraft,
+                    'CLOUD_COVER': round(cover, 2),
+                    '_cloud': max(0., min(100., cover + rng.uniform(-30, 30)))
+                }
+                images.append(_Image(props=props))
+                t += step
+            self._archives[collection_id] = images
+        return self._archives[collection_id]
+
+
+def install_fake_ee(fake):
+    '''
+    Make `fake` the ee module seen by the pipeline modules, returning a
+    function that restores the real one.
+    '''
+    import sys
+
+    _Computed.ee = fake
+    previous = sys.modules.get('ee')
+    sys.modules['ee'] = fake
+    patched = []
+    for name, module in list(sys.modules.items()):
+        if name.startswith('GlaciersGEE') and hasattr(module, 'ee'):
+            patched.append((module, module.ee))
+            module.ee = fake
+
+    def restore():
+        if previous is None:
+            sys.modules.pop('ee', None)
+        else:
+            sys.modules['ee'] = previous
+        for module, ee in patched:
+            module.ee = ee
+
+    return restore
+
+
+# ---------------------------------------------------------------------
+# Drive
+# ---------------------------------------------------------------------
+
+
+class _DriveRequest(object):
+    def __init__(self, drive, name, fn, uri=None):
+        self.drive = drive
+        self.name = name
+        self.fn = fn
+        self.uri = uri
+        self.http = drive
+
+    def execute(self):
+        self.drive.recorder.record('execute', self.name)
+        return self.fn()
+
+
+class _DriveResponse(dict):
+    def __init__(self, status, headers=None):
+        super(_DriveResponse, self).__init__(headers or {})
+        self.status = status
+
+
+class _DriveBatch(object):
+    def __init__(self, drive, callback):
+        self.drive = drive
+        self.callback = callback
+        self.requests = []
+
+    def add(self, request, request_id=None, callback=None):
+        self.requests.append((request_id or str(len(self.requests)), request))
+
+    def execute(self):
+        self.drive.recorder.record('batch', len(self.requests))
+        for request_id, request in self.requests:
+            try:
+                response, error = request.fn(), None
+            except Exception as e:
+                response, error = None, e
+            self.callback(request_id, response, error)
+
+
+class FakeDrive(object):
+    '''
+    In-process stand-in for the drive v3 service: files().list / create /
+    update / get_media and batch requests over an in-memory file tree. Every
+    execute and batch is recorded in `recorder` with `latency` seconds of
+    delay; `fail_rate` makes creates fail at random.
+    '''
+
+    def __init__(self, latency=0., fail_rate=0., seed=0, sleep=time.sleep):
+        self.recorder = CallRecorder(latency, sleep=sleep)
+        self.fail_rate = fail_rate
+        self.random = random.Random(seed)
+        self.files_db = {}              # id -> {'id', 'name', 'mimeType', 'parents', 'content'}
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    # service interface
+
+    def files(self):
+        return self
+
+    def new_batch_http_request(self, callback=None):
+        return _DriveBatch(self, callback)
+
+    def list(self, q='', pageToken=None, pageSize=100, fields=None, **kwargs):
+        def run():
+            matches = [f for f in self.files_db.values() if self._match(f, q)]
+            start = int(pageToken or 0)
+            page = matches[start:start + pageSize]
+            resp = {'files': [self._public(f) for f in page]}
+            if start + pageSize < len(matches):
+                resp['nextPageToken'] = str(start + pageSize)
+            return resp
+        return _DriveRequest(self, 'list', run)
+
+    def create(self, body=None, fields=None, **kwargs):
+        def run():
+            if self.fail_rate and self.random.random() < self.fail_rate:
+                raise IOError('fake drive failure')
+            return {'id': self.add_file(body['name'], body.get('mimeType'), body.get('parents', [None])[0])}
+        return _DriveRequest(self, 'create', run)
+
+    def update(self, fileId=None, body=None, fields=None, **kwargs):
+        def run():
+            f = self.files_db[fileId]
+            f.update({k: v for (k, v) in (body or {}).items() if k in ('name', 'trashed')})
+            return {'id': fileId}
+        return _DriveRequest(self, 'update', run)
+
+    def get_media(self, fileId=None, **kwargs):
+        return _DriveRequest(self, 'get_media', lambda: self.files_db[fileId].get('content', b''), uri=fileId)
+
+    def request(self, uri, headers=None, **kwargs):
+        '''
+        Ranged download, as request.http.request of get_media.
+        '''
+        self.recorder.record('download', uri)
+        content = self.files_db[uri].get('content', b'')
+        start, end = 0, len(content) - 1
+        if headers and 'range' in headers:
+            start, end = [int(v) for v in headers['range'].split('=')[1].split('-')]
+        if start >= len(content):
+            return _DriveResponse(416), b''
+        end = min(end, len(content) - 1)
+        return _DriveResponse(206, {'content-range': 'bytes %d-%d/%d' % (start, end, len(content))}), content[start:end + 1]
+
+    # helpers
+
+    def add_file(self, name, mime_type=None, parent=None, content=None):
+        with self._lock:
+            file_id = 'F%06d' % next(self._ids)
+            self.files_db[file_id] = {
+                'id': file_id, 'name': name, 'mimeType': mime_type,
+                'parents': [parent] if parent else [], 'content': content,
+                'trashed': False
+            }
+        return file_id
+
+    def _public(self, f):
+        out = {k: f[k] for k in ('id', 'name', 'mimeType', 'parents')}
+        if f.get('content') is not None:
+            out['size'] = str(len(f['content']))
+        return out
+
+    def _match(self, f, q):
+        for clause in [c.strip() for c in q.split(' and ') if c.strip()]:
+            m = re.match(r"^mimeType\s*(!?=)\s*'(.*)'$", clause)
+            if m:
+                if (f['mimeType'] == m.group(2)) != (m.group(1) == '='):
+                    return False
+                continue
+            m = re.match(r"^name\s*=\s*'(.*)'$", clause)
+            if m:
+                if f['name'] != m.group(1):
+                    return False
+                continue
+            m = re.match(r"^'(.*)' in parents$", clause)
+            if m:
+                if m.group(1) not in f['parents']:
+                    return False
+                continue
+            m = re.match(r"^trashed\s*=\s*(true|false)$", clause)
+            if m:
+                if f['trashed'] != (m.group(1) == 'true'):
+                    return False
+                continue
+            raise ValueError('Unsupported fake drive query: %s' % clause)
+        return True
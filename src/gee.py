@@ -1,10 +1,325 @@
-import csv
-import os
-import sys
-import ee
-import pandas as pd
+import json
 from datetime import date
-from GlaciersGEE.drive import *
+from GlaciersGEE.drive import get_parent_folder_id, get_folder_index, create_folder, list_files, trash_files
+from GlaciersGEE import instrument, ratelimit
+from GlaciersGEE.manifest import STARTED, QUEUED
+from GlaciersGEE.store import append_csv
+from GlaciersGEE.cluster import member_records
+from GlaciersGEE.tiles import tile_grid, export_name, MAX_PIXELS, TILE_SUFFIX
+from GlaciersGEE.regions import region_geojson
+
+# Scene properties fetched from Earth Engine for every image, in one request
+SCENE_PROPERTIES = ['system:index', 'DATE_ACQUIRED', 'SPACECRAFT_ID', 'CLOUD_COVER', 'cloud']
+
+
+def fetch_scene_metadata(collection_lists, properties=SCENE_PROPERTIES):
+    '''
+    Fetch the wanted properties of every scene of every sensor in a single
+    batched getInfo call, instead of one call per image.
+    :param collection_lists: dictionary of sensor name -> ee.List of images
+    :param properties: image properties to retrieve
+    :returns: DataFrame with one row per scene; `position` is the index of
+    the scene in its sensor's ee.List
+    '''
+    import ee
+    import pandas as pd
+
+    def image_properties(image):
+        image = ee.Image(image)
+        return ee.List([image.get(p) for p in properties])
+
+    request = ee.Dictionary({
+        sensor: ee.List(images).map(image_properties)
+        for (sensor, images) in collection_lists.items()
+    })
+    info = ratelimit.call('ee.getInfo', request.getInfo)
+
+    rows = []
+    for sensor in collection_lists:
+        for position, values in enumerate(info.get(sensor, [])):
+            row = dict(zip(properties, values))
+            row['sensor'] = sensor
+            row['position'] = position
+            rows.append(row)
+
+    return pd.DataFrame(rows, columns=['sensor', 'position'] + list(properties))
+
+
+def scene_dates(scenes, sensor):
+    '''
+    List of acquisition dates for a sensor from the scene metadata table
+    :param scenes: output of fetch_scene_metadata
+    :param sensor: sensor name, e.g. 'L8'
+    '''
+    return scenes.loc[scenes.sensor == sensor, 'DATE_ACQUIRED'].astype(str).tolist()
+
+
+def metadata_round_trips(scenes, calls):
+    '''
+    Number of getInfo round trips the per-scene loops needed for this
+    table (one collection size per sensor, then a date, an export filename
+    and the region bounds per scene) against the round trips actually made.
+    :param scenes: output of fetch_scene_metadata
+    :param calls: getInfo calls made for the region bounds and the table
+    '''
+    legacy = 3 + 3 * len(scenes)
+    return legacy, calls
+
+
+# Cloud filtering strategies of ee_download
+CLOUD_STRATEGIES = ('region', 'tiered', 'scene')
+
+
+def cloud_filter_report(stages, scenes):
+    '''
+    Number of scenes left after each cloud filtering stage, for every
+    sensor. The metadata-only stages are counted in one batched request;
+    the count after the last stage comes from the scene table, so cloud
+    scores are not computed a second time.
+    :param stages: dictionary of sensor -> list of (stage name, collection)
+    :param scenes: output of fetch_scene_metadata
+    :returns: dictionary of sensor -> list of (stage name, scenes left)
+    '''
+    import ee
+
+    request = ee.Dictionary({
+        sensor: ee.List([col.size() for (_, col) in cols[:-1]])
+        for (sensor, cols) in stages.items()
+    })
+    sizes = ratelimit.call('ee.getInfo', request.getInfo)
+    return {
+        sensor: list(zip(
+            [name for (name, _) in cols],
+            sizes[sensor] + [int((scenes.sensor == sensor).sum())]
+        ))
+        for (sensor, cols) in stages.items()
+    }
+
+
+def print_cloud_report(report):
+    '''
+    Print how many scenes each cloud filtering stage removed
+    '''
+    for sensor, counts in report.items():
+        removed = ', '.join(
+            '%s removed %d' % (name, before - after)
+            for ((_, before), (name, after)) in zip(counts, counts[1:])
+        )
+        print('%s cloud filter: %d scenes, %s, %d kept' % (sensor, counts[0][1], removed, counts[-1][1]))
+
+
+# Landsat sensors in export order, and the bands exported for each
+SENSORS = ['L8', 'L7', 'L5']
+SENSOR_BANDS = {
+    'L8': ['B2', 'B3', 'B4', 'B5', 'B6', 'B10'],
+    'L7': ['B1', 'B2', 'B3', 'B4', 'B5', 'B6_VCID_1'],
+    'L5': ['B1', 'B2', 'B3', 'B4', 'B5', 'B6']
+}
+
+# Earth Engine collection of each sensor; scenes are exported as
+# <collection>/<system:index>
+SENSOR_COLLECTIONS = {
+    'L8': 'LANDSAT/LC08/C01/T1_TOA',
+    'L7': 'LANDSAT/LE07/C01/T1_TOA',
+    'L5': 'LANDSAT/LT05/C01/T1_TOA'
+}
+
+# Common names of the exported bands, in SENSOR_BANDS order for every sensor
+BAND_NAMES = ['blue', 'green', 'red', 'nir', 'swir1', 'thermal']
+
+# DEM exports: name -> Earth Engine asset
+DEM_ASSETS = {'SRTM': 'USGS/SRTMGL1_003', 'GMTED': 'USGS/GMTED2010'}
+
+# Composite mode: each window's scenes of every sensor, bands renamed to
+# BAND_NAMES, reduced to one median image. Windows are name -> (first month,
+# last month); a window whose first month is after its last starts the
+# year before (e.g. DJF)
+COMPOSITE = 'composite'
+COMPOSITE_WINDOWS = {
+    'year': {'year': (1, 12)},
+    'season': {'DJF': (12, 2), 'MAM': (3, 5), 'JJA': (6, 8), 'SON': (9, 11)},
+}
+
+PLAN_COLUMNS = ['name', 'sensor', 'source', 'position', 'bands', 'folder', 'fileNamePrefix', 'scale', 'region', 'tile']
+
+
+def composite_windows(scenes, begDate, endDate, windows):
+    '''
+    Composite windows overlapping begDate to endDate that hold at least one
+    scene, named <window start>_<window name> so they sort by date
+    :param scenes: output of fetch_scene_metadata
+    :param windows: dictionary of window name -> (first month, last month)
+    :returns: list of (name, start date, end date (exclusive), number of scenes)
+    '''
+    beg, end = date.fromisoformat(begDate), date.fromisoformat(endDate)
+    acquired = [str(d) for d in scenes.DATE_ACQUIRED]
+    out = []
+    for year in range(beg.year, end.year + 2):
+        for label, (first, last) in windows.items():
+            start = date(year - 1 if first > last else year, first, 1)
+            stop = date(year + (last == 12), last % 12 + 1, 1)
+            if stop <= beg or start >= end:
+                continue
+            lo, hi = max(start, beg).isoformat(), min(stop, end).isoformat()
+            n = sum(lo <= d < hi for d in acquired)
+            if n:
+                out.append(('%s_%s' % (start.isoformat(), label), lo, hi, n))
+    return sorted(out)
+
+
+def harmonise(collections):
+    '''
+    Merge the collections of several sensors into one, each image's bands
+    selected in SENSOR_BANDS order and renamed to BAND_NAMES
+    :param collections: dictionary of sensor -> ee.ImageCollection
+    '''
+    merged = None
+    for sensor in SENSORS:
+        if collections.get(sensor) is None:
+            continue
+        collection = collections[sensor].select(SENSOR_BANDS[sensor], BAND_NAMES)
+        merged = collection if merged is None else merged.merge(collection)
+    return merged
+
+
+def compile_export_plan(glac_id, scenes, bounds, dem=True, landsat=True, scale=30, max_pixels=MAX_PIXELS,
+                        composites=None, gmted=False):
+    '''
+    Resolve every client-side value of a glacier's exports once: region
+    bounds, file names, band selections and sensor tags. Scenes acquired on
+    the same date get their system:index appended so no export is lost.
+    Regions over `max_pixels` pixels at `scale` are split into a grid of
+    tiles (see tiles.tile_grid), with one export per scene per tile.
+    :param glac_id: glacier id, also the drive folder name
+    :param scenes: output of fetch_scene_metadata; not needed without landsat
+    :param bounds: coordinates of the region bounds
+    :param gmted: also export the GMTED2010 DEM
+    :param max_pixels: pixel budget of one export, None to never tile
+    :param composites: output of composite_windows; if given, landsat scenes
+    are exported as one composite per window instead of one by one, with
+    the window's 'start/end' dates as source and its scene count as position
+    :returns: DataFrame with one row per export, in export order; `tile`
+    is the tile suffix of tiled exports, otherwise None
+    '''
+    import pandas as pd
+
+    folder = str(glac_id)
+    rows = []
+    dems = [name for (name, wanted) in (('SRTM', dem), ('GMTED', gmted)) if wanted]
+    for asset in [DEM_ASSETS[name] for name in dems]:
+        rows.append([asset.replace('/', '_'), 'DEM', asset, None, None, folder, asset.replace('/', '_'), scale, bounds, None])
+
+    if landsat and composites is not None:
+        for (name, start, end, n) in composites:
+            rows.append([name, COMPOSITE, start + '/' + end, n, BAND_NAMES, folder, name, scale, bounds, None])
+    elif landsat:
+        for sensor in SENSORS:
+            sensor_scenes = scenes[scenes.sensor == sensor]
+            for position, date_acquired, index in zip(
+                    sensor_scenes.position, sensor_scenes.DATE_ACQUIRED, sensor_scenes['system:index']):
+                name = str(date_acquired)
+                rows.append([name, sensor, index, int(position), SENSOR_BANDS[sensor], folder, name, scale, bounds, None])
+
+    plan = pd.DataFrame(rows, columns=PLAN_COLUMNS)
+    dup = plan.name.duplicated(keep=False) & (plan.sensor != 'DEM')
+    plan.loc[dup, 'name'] = plan.loc[dup, 'name'] + '_' + plan.loc[dup, 'source'].astype(str)
+
+    grid = tile_grid(bounds, scale=scale, max_pixels=max_pixels)
+    if len(grid) > 1:
+        tiled = []
+        for row in plan.itertuples(index=False):
+            for (r, c, tile_bounds) in grid:
+                suffix = TILE_SUFFIX % (r, c)
+                tiled.append(row._replace(name=row.name + suffix, region=tile_bounds, tile=suffix))
+        plan = pd.DataFrame(tiled, columns=PLAN_COLUMNS)
+
+    plan['fileNamePrefix'] = plan['name']
+    return plan
+
+
+def tile_counts(plan):
+    '''
+    Number of tiles of every tiled export of a plan, by the name of the
+    mosaic they make up (see tiles.mosaic_tiles)
+    '''
+    tiled = plan[plan.tile.notnull()]
+    bases = [name[:-len(tile)] for (name, tile) in zip(tiled.name, tiled.tile)]
+    return {base: bases.count(base) for base in sorted(set(bases))}
+
+
+def run_export_plan(plan, region, export, composite=None):
+    '''
+    Submit the exports of a compiled plan; needs no getInfo calls. Scenes
+    are resolved by system:index, so an export always holds the scene its
+    name was made from.
+    :param plan: output of compile_export_plan
+    :param region: ee.Geometry to clip to
+    :param export: function taking an export name and toDrive parameters
+    :param composite: harmonised collection (see harmonise) composites are reduced from
+    '''
+    import ee
+
+    for row in plan.itertuples(index=False):
+        if row.sensor == 'DEM':
+            image = ee.Image(row.source)
+        elif row.sensor == COMPOSITE:
+            start, end = row.source.split('/')
+            image = composite.filterDate(start, end).median().select(row.bands)
+        else:
+            image = ee.Image(SENSOR_COLLECTIONS[row.sensor] + '/' + row.source).select(row.bands)
+        export(
+            row.name,
+            image=image.clip(region),
+            scale=row.scale,
+            region=row.region,
+            folder=row.folder,
+            fileNamePrefix=row.fileNamePrefix)
+
+    for sensor in plan.sensor.unique():
+        print("%d %s images sent to drive" % ((plan.sensor == sensor).sum(), sensor))
+
+
+def merge_dates(recorded, found, beg, end):
+    '''
+    Sorted dates of a refresh: the recorded dates outside the queried
+    beg to end (exclusive) range and the dates found in it, duplicates kept
+    '''
+    kept = [d for d in recorded if not beg <= d < end]
+    return sorted(kept + list(found))
+
+
+def existing_scenes(glac_id, drive_service=None, store=None, manifest=None):
+    '''
+    What an earlier run already exported for a glacier: the date lists of
+    its stored record and the exports found in its drive folder.
+    :param store: MetadataStore, or dictionary of glac_id -> record (see
+    store.read_records)
+    :returns: dictionary with 'dates' (sensor -> recorded dates), 'folder'
+    (drive folder id or None), 'names' (set of export names in the folder),
+    'files' (export name -> ids of its files) and 'latest' (latest
+    acquisition date found, or None)
+    '''
+    record = store.get(glac_id) if store is not None else None
+    dates = {s: list((record or {}).get(s + 'Dates') or []) for s in SENSORS}
+
+    folder = manifest.get(glac_id, 'folder') if manifest is not None else None
+    if folder is None and record and record.get('drivefile_id') not in (None, 'NA'):
+        folder = record['drivefile_id']
+    if folder is None and drive_service is not None:
+        try:
+            folder = get_parent_folder_id(drive_service, name=glac_id)
+        except KeyError:
+            folder = None
+
+    files = {}
+    if folder is not None and drive_service is not None:
+        for f in list_files(drive_service, folder):
+            files.setdefault(export_name(f['name']), []).append(f['id'])
+    names = set(files)
+
+    found = [d for ds in dates.values() for d in ds] + [n[:10] for n in names if n[:4].isdigit()]
+    return {'dates': dates, 'folder': folder, 'names': names, 'files': files, 'latest': max(found) if found else None}
+
 
 #Reorganize landsat download function
 def ee_download(
@@ -17,10 +332,57 @@ def ee_download(
     cloud_tol=20, 
     landsat=True, 
     dem=True,
-    gmted=True):
+    gmted=True,
+    scheduler=None,
+    manifest=None,
+    store=None,
+    cloud_strategy='region',
+    cloud_scale=30,
+    scene_cloud_max=None,
+    dry_run=False,
+    max_pixels=MAX_PIXELS,
+    refresh=False,
+    regions=None,
+    composite=None):
     '''
     Download images from GEE
+    :param scheduler: ExportScheduler to queue the exports on; exports are
+    started immediately if not given
+    :param manifest: Manifest of completed steps; steps already recorded
+    for this glacier are skipped
+    :param store: MetadataStore to put the glacier record in; appended to
+    glacierInfo.csv if not given
+    :param cloud_strategy: one of CLOUD_STRATEGIES; 'region' scores every scene
+    over the glacier region, 'tiered' first drops scenes over `scene_cloud_max`
+    scene-level CLOUD_COVER and scores only the rest, 'scene' filters on
+    CLOUD_COVER alone with no per-region scoring
+    :param cloud_scale: scale in metres of the per-region cloud score
+    :param scene_cloud_max: CLOUD_COVER threshold; defaults to twice cloud_tol
+    for 'tiered' (a cloudy scene can still be clear over the glacier) and to
+    cloud_tol for 'scene'
+    :param dry_run: compile and return the export plan without creating
+    folders, storing metadata, recording manifest steps or starting exports
+    :param max_pixels: pixel budget of one export; larger regions are exported
+    as a grid of tiles, recorded in the manifest under the 'tiles' step and
+    reassembled after download with tiles.mosaic_tiles
+    :param refresh: delta mode for a glacier exported before: only scenes
+    acquired on or after the latest date already recorded (in the stored
+    record or the drive folder, see existing_scenes) are queried, exports
+    already in the folder are skipped, the folder is reused and the date
+    lists of the record are extended
+    :param regions: RegionCache of region bounds, so the region is resolved
+    on Earth Engine once rather than on every run
+    :param composite: None to export every scene; otherwise export one median
+    composite of the scenes of all sensors per window instead, bands named
+    BAND_NAMES: 'year' or 'season' (see COMPOSITE_WINDOWS), or a dictionary of
+    window name -> [first month, last month]. With refresh, windows already
+    exported are skipped and scenes are queried from begDate.
+    :returns: the export plan (see compile_export_plan)
     '''
+    import ee
+    import pandas as pd
+
+    glac_id = str(glacierObject['glac_id'])
     # Initial earth engine connection, key much be on your computer, thus 
     # you must once in terminal run ee.Authenticate() for any new computer 
     # that you are using for implementation of this google earth engine communication
@@ -38,127 +400,222 @@ def ee_download(
         cloud = ee.Algorithms.Landsat.simpleCloudScore(image).select('cloud')
         cloudiness = cloud.reduceRegion(ee.Reducer.mean(),
                                         geometry=region,
-                                        scale=30)
+                                        scale=cloud_scale)
         image = image.set(cloudiness)
         return image
 
+    if cloud_strategy not in CLOUD_STRATEGIES:
+        raise ValueError('Unknown cloud strategy: %s' % cloud_strategy)
+    if isinstance(composite, str) and composite not in COMPOSITE_WINDOWS:
+        raise ValueError('Unknown composite windows: %s' % composite)
+    if scene_cloud_max is None:
+        scene_cloud_max = min(2 * cloud_tol, 100) if cloud_strategy == 'tiered' else cloud_tol
+
+    # sensor -> list of (stage name, collection after the stage)
+    cloudStages = {}
+
+    def cloud_filter(collection, sensor):
+        '''
+        Remove cloudy scenes from a collection with the selected strategy,
+        recording the collection after each stage for the report.
+        '''
+        if since is not None:
+            collection = collection.filterDate(since, endDate)
+        stages = [('collection', collection)]
+        if cloud_strategy in ('tiered', 'scene'):
+            collection = collection.filter(ee.Filter.lt('CLOUD_COVER', scene_cloud_max))
+            stages.append(('CLOUD_COVER', collection))
+        if cloud_strategy in ('tiered', 'region'):
+            collection = collection.map(algorithm=cloudscore).filter(ee.Filter.lt('cloud', cloud_tol))
+            stages.append(('cloud score', collection))
+        cloudStages[sensor] = stages
+        return collection
+
+    # exports a refresh makes again although an earlier run finished them
+    again = set()
+
+    def export(name, **params):
+        '''
+        Start, or queue on the scheduler, an export to drive named `name`
+        '''
+        if manifest is not None and manifest.done(glac_id, 'export', name) and name not in again:
+            return
+        if scheduler is None:
+            task = ee.batch.Export.image.toDrive(**params)
+            ratelimit.call('ee.export', task.start, idempotent=False)
+            if manifest is not None:
+                manifest.mark(glac_id, 'export', name, state=STARTED)
+        else:
+            # queued until the scheduler starts it; its listener records
+            # the export as started, then finished or failed
+            if manifest is not None:
+                manifest.mark(glac_id, 'export', name, state=QUEUED)
+            scheduler.submit(glac_id + '/' + name, lambda: ee.batch.Export.image.toDrive(**params),
+                             again=name in again)
+
+    def submitted():
+        '''
+        Record that every export of the glacier was submitted. Without a
+        scheduler nothing tracks the exports, so the glacier is done;
+        otherwise it is done once its last export finished.
+        '''
+        if manifest is None:
+            return
+        if scheduler is None:
+            manifest.mark(glac_id, 'glacier')
+        else:
+            manifest.mark(glac_id, 'submitted')
+            manifest.finish_glacier(glac_id)
+
     # Our glacier region can be found in the imported dictionary as an 
     # argument under bounding box (list of lists of coordinates).
     # We must create a gee polygon in order to use that to clip the images
-    region = ee.Geometry.Polygon(glacierObject['bbox'])
+    # The region is serialised once and its bounds, resolved on Earth
+    # Engine, are reused by every export (and, with a cache, every run)
+    serialized = region_geojson(glacierObject['bbox'])
+    region = ee.Geometry(serialized)
+    with instrument.phase('region'), instrument.counting('ee.getInfo') as region_calls:
+        compute = lambda: ratelimit.call('ee.getInfo', region.bounds().getInfo)['coordinates']
+        bounds = regions.bounds(glac_id, serialized, compute) if regions is not None else compute()
     # Dummy request to Earth engine to compute glacier object values and send to toDrive
     # Creates image collections for later batch export
 
+    # in refresh mode only scenes from the latest one already exported on
+    # are queried; that date is included, as other scenes of it may be new
+    since, existing = None, None
+    if refresh:
+        # read-only, so a dry run previews the scenes a refresh would export;
+        # without drive it only knows the recorded dates
+        with instrument.phase('refresh'):
+            existing = existing_scenes(glac_id, drive_service, store=store, manifest=manifest)
+        # a composite window spans earlier scenes too, so it is queried whole
+        since = existing['latest'] if not composite else None
+        if since is not None and since < begDate:
+            since = None
+        print("refresh: %d exports found%s, querying scenes from %s"
+              % (len(existing['names']), '' if drive_service else ' (drive not listed)', since or begDate))
+
     if gmted:
-        get_parent_folder_id(drive_service, name=str(glacierObject['glac_id']))
-        # DEM 60 degrees
-        # Create image from GEE and clip to our glacier region
-        DEM = ee.Image("USGS/GMTED2010")
-        DEM = DEM.clip(region)
-        #  export this image to drive in the glimsID folder specified in input object
-        task = ee.batch.Export.image.toDrive(
-            image = DEM.clip(region),
-            scale = 30,
-            region = region.bounds().getInfo()['coordinates'],
-            folder = str(glacierObject['glac_id']),
-            fileNamePrefix = 'USGS_GMTED2010')
-        task.start()
+        # DEM 60 degrees, exported alone to the glacier's folder; planned
+        # like every other export, so a dry run only prints it
+        with instrument.phase('export_plan'):
+            plan = compile_export_plan(glac_id, None, bounds, dem=False, landsat=False, gmted=True, max_pixels=max_pixels)
+        if dry_run:
+            print(plan.drop(columns=['region']).to_string())
+            return plan
+        with instrument.phase('export_submit'):
+            run_export_plan(plan, region, export)
         print("gmted sent to drive")
-        return 
+        submitted()
+        return plan
 
-    # Landsat 8 image collection
-    print("Getting Landsat 8 collection")
-    if date.fromisoformat(endDate) > date.fromisoformat("2013-01-01"):
-        # First filter the collection of images by date and region of glacier
-        #  Landsat 8 starts on 01-01-13
+    # Build the filtered collections; lazy, no requests are sent here
+    with instrument.phase('collections'):
+        # Landsat 8 image collection
+        print("Getting Landsat 8 collection")
+        collectionListL8 = None
+        filteredCollectionL8 = None
+        if date.fromisoformat(endDate) > date.fromisoformat("2013-01-01"):
+            # First filter the collection of images by date and region of glacier
+            #  Landsat 8 starts on 01-01-13
 
-        colL8 = ee.ImageCollection('LANDSAT/LC08/C01/T1_TOA')
-        colL8 = colL8.filterDate('2013-01-01',endDate)
-        colL8 = colL8.filterBounds(region)
-        count = colL8.size()
+            colL8 = ee.ImageCollection(SENSOR_COLLECTIONS['L8'])
+            colL8 = colL8.filterDate('2013-01-01',endDate)
+            colL8 = colL8.filterBounds(region)
+            count = colL8.size()
 
-        # Filter out cloudiest images based on tolerance set as parameter
-        # We need bands 2-7
-        withCloudiness = colL8.map(algorithm=cloudscore)
+            # Filter out cloudiest images based on tolerance set as parameter
+            # We need bands 2-7
+            filteredCollectionL8 = cloud_filter(colL8, 'L8')
 
-        filteredCollectionL8 = withCloudiness.filter(ee.Filter.lt('cloud', cloud_tol))
-        filteredCollectionL8 = filteredCollectionL8.select(['B2', 'B3', 'B4', 'B5', 'B6', 'B10'])
+            # In order to collect dates for object and pushing images to drive 
+            # make our collection a list thus we can loop over and the size of the collection
+            collectionListL8 = filteredCollectionL8.toList(colL8.size())
+            # Landsat 7 Image collection
+            # Same for the other landsats based on dates of start
 
-        # In order to collect dates for object and pushing images to drive 
-        # make our collection a list thus we can loop over and the size of the collection
-        collectionListL8 = filteredCollectionL8.toList(colL8.size())
-        collectionSizeL8 = collectionListL8.size().getInfo()
-        # Landsat 7 Image collection
-        # Same for the other landsats based on dates of start
+        print("Getting Landsat 7 collection")
+        if date.fromisoformat("1999-01-01") > date.fromisoformat(begDate):
+            colL7 = ee.ImageCollection(SENSOR_COLLECTIONS['L7'])
+            colL7 = colL7.filterDate(begDate,endDate)
+            colL7 = colL7.filterBounds(region)
+            count = colL7.size()
 
-    print("Getting Landsat 7 collection")
-    if date.fromisoformat("1999-01-01") > date.fromisoformat(begDate):
-        colL7 = ee.ImageCollection('LANDSAT/LE07/C01/T1_TOA')
-        colL7 = colL7.filterDate(begDate,endDate)
-        colL7 = colL7.filterBounds(region)
-        count = colL7.size()
 
+        else:
+            colL7 = ee.ImageCollection(SENSOR_COLLECTIONS['L7'])
+            colL7 = colL7.filterDate('1999-01-01',endDate)
+            colL7 = colL7.filterBounds(region)
+            count = colL7.size()
 
-    else:
-        colL7 = ee.ImageCollection('LANDSAT/LE07/C01/T1_TOA')
-        colL7 = colL7.filterDate('1999-01-01',endDate)
-        colL7 = colL7.filterBounds(region)
-        count = colL7.size()
-
-    withCloudiness = colL7.map(algorithm=cloudscore)
-
-    filteredCollectionL7 = withCloudiness.filter(ee.Filter.lt('cloud', cloud_tol))
-    filteredCollectionL7 = filteredCollectionL7.select(['B1', 'B2', 'B3', 'B4', 'B5', 'B6_VCID_1'])
-    collectionListL7 = filteredCollectionL7.toList(colL7.size())
-    collectionSizeL7 = filteredCollectionL7.size().getInfo()
-
-    # Landsat 5 image collection
-    print("Getting landsat 5 collection")
-    if date.fromisoformat(endDate) < date.fromisoformat('2012-05-01'):
-        colL5 = ee.ImageCollection('LANDSAT/LT05/C01/T1_TOA')\
-                .filterDate(begDate,endDate)\
-                .filterBounds(region)
-
-        count = colL5.size()
-    else:
+        filteredCollectionL7 = cloud_filter(colL7, 'L7')
+        collectionListL7 = filteredCollectionL7.toList(colL7.size())
+
+        # Landsat 5 image collection
+        print("Getting landsat 5 collection")
+        if date.fromisoformat(endDate) < date.fromisoformat('2012-05-01'):
+            colL5 = ee.ImageCollection(SENSOR_COLLECTIONS['L5'])\
+                    .filterDate(begDate,endDate)\
+                    .filterBounds(region)
 
-        colL5 = ee.ImageCollection('LANDSAT/LT05/C01/T1_TOA')\
-                .filterDate(begDate,'2012-05-01')\
-                .filterBounds(region)
+            count = colL5.size()
+        else:
 
-        count = colL5.size()
+            colL5 = ee.ImageCollection(SENSOR_COLLECTIONS['L5'])\
+                    .filterDate(begDate,'2012-05-01')\
+                    .filterBounds(region)
 
-    withCloudiness = colL5.map(algorithm=cloudscore)
+            count = colL5.size()
 
-    filteredCollectionL5 = withCloudiness.filter(ee.Filter.lt('cloud', cloud_tol))
-    filteredCollectionL5 = filteredCollectionL5.select(['B1', 'B2', 'B3', 'B4', 'B5', 'B6'])
-    collectionListL5 = filteredCollectionL5.toList(colL5.size())
-    collectionSizeL5 = filteredCollectionL5.size().getInfo()
+        filteredCollectionL5 = cloud_filter(colL5, 'L5')
+        collectionListL5 = filteredCollectionL5.toList(colL5.size())
 
     # For each image collection we need the list of dates from that image as well 
-    # as the sensor(to be added) it comes from, the following code extracts that 
-    # information and adds to glacierObject.
+    # as the sensor it comes from. All scene properties are fetched in one batched
+    # request and kept in a local table reused by the CSV row and the export loops.
     # Names of image attributes found at : https://developers.google.com/earth-engine/datasets/catalog/landsat
-    L8Dates = []
-    L7Dates = []
-    L5Dates = []
-    print("starting date collection")
-    # Loop over image collection lists made above and then get the date acquired and append to list
-    for i in range(collectionSizeL8):
-        image = ee.Image(collectionListL8.get(i)).clip(region)
-        date_acquired = image.get("DATE_ACQUIRED")
-        L8Dates.append(str(date_acquired.getInfo()))
-    print("L8 date collection complete")
-    for i in range(collectionSizeL7):
-        image = ee.Image(collectionListL7.get(i)).clip(region)
-        date_acquired = image.get("DATE_ACQUIRED")
-        L7Dates.append(str(date_acquired.getInfo()))
-    print("L7 date collection complete")
-    for i in range(collectionSizeL5):
-        image = ee.Image(collectionListL5.get(i)).clip(region)
-        date_acquired = image.get("DATE_ACQUIRED")
-        L5Dates.append(str(date_acquired.getInfo()))
-    print("l5 date collection complete")
+    collectionLists = {'L8': collectionListL8, 'L7': collectionListL7, 'L5': collectionListL5}
+    collectionLists = {k: v for (k, v) in collectionLists.items() if v is not None}
+    # the scenes found only hold for the same query and region, so a
+    # recorded table is reused only if both match
+    query = [begDate, endDate, cloud_tol, cloud_strategy, cloud_scale, scene_cloud_max, serialized]
+    if since is not None:
+        query.append(since)
+    recorded = manifest.get(glac_id, 'metadata') if manifest is not None else None
+    if recorded is not None and recorded['query'] == query:
+        scenes = pd.DataFrame(recorded['scenes'], columns=['sensor', 'position'] + SCENE_PROPERTIES)
+        print("scene metadata loaded from manifest: %d scenes" % len(scenes))
+    else:
+        print("starting scene metadata collection")
+        with instrument.phase('scene_metadata'), instrument.counting('ee.getInfo') as calls:
+            scenes = fetch_scene_metadata(collectionLists)
+            print_cloud_report(cloud_filter_report(cloudStages, scenes))
+        legacy_trips, trips = metadata_round_trips(scenes, region_calls['calls'] + calls['calls'])
+        print("scene metadata complete: %d scenes in %d request(s), %d round trips saved"
+              % (len(scenes), trips, legacy_trips - trips))
+        if manifest is not None and not dry_run:
+            records = json.loads(scenes.to_json(orient='records'))
+            manifest.mark(glac_id, 'metadata', value={'query': query, 'scenes': records})
+
+    composites = None
+    if composite:
+        windows = COMPOSITE_WINDOWS[composite] if isinstance(composite, str) else composite
+        composites = composite_windows(scenes, begDate, endDate, windows)
+        glacierObject['composites'] = [name for (name, _, _, _) in composites]
+        print("%d scenes in %d composites" % (len(scenes), len(composites)))
+
+    L8Dates = scene_dates(scenes, 'L8')
+    L7Dates = scene_dates(scenes, 'L7')
+    L5Dates = scene_dates(scenes, 'L5')
+
+    if existing is not None:
+        # a refresh extends the dates already recorded; the recorded dates
+        # the query covered again are replaced, so scenes sharing a date
+        # are neither merged nor counted twice
+        queried = (since or begDate, endDate)
+        L8Dates = merge_dates(existing['dates']['L8'], L8Dates, *queried)
+        L7Dates = merge_dates(existing['dates']['L7'], L7Dates, *queried)
+        L5Dates = merge_dates(existing['dates']['L5'], L5Dates, *queried)
 
     # Add date lists to the glacier object
     glacierObject['L8Dates'] = L8Dates
@@ -168,15 +625,47 @@ def ee_download(
     glacierObject['fileaddress'] = str(glacierObject['glac_id'])
     glacierObject['drivefile_id'] = str("NA")
 
+    # Every export of this glacier, resolved on the client
+    with instrument.phase('export_plan'):
+        plan = compile_export_plan(
+            glac_id, scenes, bounds, dem=dem, landsat=landsat, max_pixels=max_pixels, composites=composites)
+    if existing is not None:
+        skipped = plan.name.isin(existing['names'])
+        if existing['latest'] is not None:
+            # a composite window ending after the latest scene of the last
+            # run may have gained scenes since; it is exported again
+            ends = plan.source.astype(str).str.split('/').str[-1]
+            partial = (plan.sensor == COMPOSITE) & (ends > existing['latest'])
+            again.update(plan.name[partial])
+            skipped &= ~partial
+        plan = plan[~skipped].reset_index(drop=True)
+        print("refresh: %d exports already in drive, %d new" % (skipped.sum(), len(plan)))
+    tiles = tile_counts(plan)
+    if tiles:
+        print("region over %d pixels: %d exports split into %d tiles each"
+              % (max_pixels, len(tiles), max(tiles.values())))
+    if dry_run:
+        print(plan.drop(columns=['region']).to_string())
+        return plan
+    if tiles and manifest is not None:
+        manifest.mark(glac_id, 'tiles', value=tiles)
+
     # send to drive
     print("Making google drive glacier object")
-    nameforfile = str(glacierObject['glac_id']) + ".csv"
-    try:
-        parentID = get_parent_folder_id(drive_service, name=folder_name)
-    except:
-        parentID = create_folder(drive_service, folder_name)
+    folderid = manifest.get(glac_id, 'folder') if manifest is not None else None
+    if folderid is None and existing is not None:
+        folderid = existing['folder']
+    if folderid is None:
+        with instrument.phase('drive_folder'):
+            index = get_folder_index(root=folder_name)
+            try:
+                parentID = get_parent_folder_id(drive_service, name=folder_name, index=index)
+            except:
+                parentID = create_folder(drive_service, folder_name, index=index)
 
-    folderid = create_folder(drive_service, str(glacierObject['glac_id']), parentID=parentID)
+            folderid = create_folder(drive_service, str(glacierObject['glac_id']), parentID=parentID, index=index)
+        if manifest is not None:
+            manifest.mark(glac_id, 'folder', value=folderid)
 
     # Need the id of the folder because google drive does not work like a normal file system
     # operates on ID's found in metadata
@@ -184,78 +673,38 @@ def ee_download(
     print('Folder ID: %s' % folderid)
     glacierObject["drivefile_id"] = str(folderid)
 
-    print("Creating CSV")
-    if os.path.exists("glacierInfo" + ".csv"):
-        with open('glacierInfo.csv','a') as f:
-            w = csv.DictWriter(f, glacierObject.keys())
-            if f.tell() == 0:
-                w.writeheader()
-                w.writerow(glacierObject)
-            else:
-                w.writerow(glacierObject)
-
-    else:
-        csv_file = "glacierInfo" + ".csv"
-        csv_columns = ['GlimsID', 'bbox','L8Dates','L7Dates','L5Dates', 'fileaddress', 'drivefile_id']
-        with open(csv_file, "w") as f:
-            writer = csv.writer(f)
-            writer.writerow(glacierObject)
+    print("Storing glacier metadata")
+    # a cluster (see cluster.cluster_lookup) stores one record per member glacier
+    records = member_records(glacierObject) if 'members' in glacierObject else [glacierObject]
+    with instrument.phase('store_metadata'):
+        if manifest is not None and manifest.done(glac_id, 'csv') and not refresh:
+            print("glacier metadata already stored")
+        elif store is not None:
+            # committed in batches by the store's writer, which records the
+            # step in the manifest once the record is committed
+            for record in records:
+                store.put(record)
+        else:
+            for record in records:
+                append_csv(record)
+            if manifest is not None:
+                manifest.mark(glac_id, 'csv')
 
     print("glacier object uploaded to google drive")
 
-    # Now is the part behind the GEE server
-    # First the DEM
-    if dem:
-        # DEM 30 degrees
-        # Create image from GEE and clip to our glacier region
-        DEM = ee.Image("USGS/SRTMGL1_003")
-        DEM = DEM.clip(region)
-        #  export this image to drive in the glimsID folder specified in input object
-        task = ee.batch.Export.image.toDrive(
-            image = DEM.clip(region),
-            scale = 30,
-            region = region.bounds().getInfo()['coordinates'],
-            folder = str(glacierObject['glac_id']),
-            fileNamePrefix = 'USGS_SRTMGL1_003')
-        task.start()
-        print("dem sent to drive")
-    if landsat == True:
-        # We already created the image collections previously and now in a for loop we
-        # batch export the images from the collections with the date as the name
-        # similarly for each of the three landsat collections
-        for i in range(collectionSizeL8):
-            image = ee.Image(collectionListL8.get(i)).clip(region)
-            filename = image.get("DATE_ACQUIRED")
-            task = ee.batch.Export.image.toDrive(
-                image=ee.Image(collectionListL8.get(i)).clip(region),
-                scale=30,
-                region=region.bounds().getInfo()['coordinates'], 
-                folder=str(glacierObject['glac_id']),
-                fileNamePrefix=str(filename.getInfo()))
-            task.start()
-        print(collectionSizeL8)
-        print("L8 images sent to drive")
-        for i in range(collectionSizeL7):
-            image = ee.Image(collectionListL7.get(i)).clip(region)
-            filename = image.get("DATE_ACQUIRED")
-            task = ee.batch.Export.image.toDrive(
-                image=ee.Image(collectionListL7.get(i)).clip(region),
-                scale=30,
-                region=region.bounds().getInfo()['coordinates'],
-                folder=str(glacierObject['glac_id']),
-                fileNamePrefix=str(filename.getInfo()))
-            task.start()
-        print(collectionSizeL7)
-        print("L7 images sent to drive")
-        for i in range(collectionSizeL5):
-            image = ee.Image(collectionListL5.get(i)).clip(region)
-            filename = image.get("DATE_ACQUIRED")
-            task = ee.batch.Export.image.toDrive(
-                image=ee.Image(collectionListL5.get(i)).clip(region),
-                scale=30,
-                region=region.bounds().getInfo()['coordinates'],
-                folder=str(glacierObject['glac_id']),
-                fileNamePrefix=str(filename.getInfo()))
-            task.start()
-        print(collectionSizeL5)
-        print("L5 images sent to drive")    
\ No newline at end of file
+    # the files of the windows exported again are trashed, so the folder
+    # does not end up with two files of the same name
+    stale = [file_id for name in sorted(again) for file_id in existing['files'].get(name, [])] if again else []
+    if stale:
+        with instrument.phase('refresh'):
+            failed = trash_files(drive_service, stale)
+        print("refresh: %d outdated files trashed, %d failed" % (len(stale) - len(failed), len(failed)))
+
+    # Now is the part behind the GEE server: the DEM then the landsat scenes
+    with instrument.phase('export_submit'):
+        harmonised = None
+        if composites is not None:
+            harmonised = harmonise({'L8': filteredCollectionL8, 'L7': filteredCollectionL7, 'L5': filteredCollectionL5})
+        run_export_plan(plan, region, export, composite=harmonised)
+    submitted()
+    return plan
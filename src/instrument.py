@@ -0,0 +1,178 @@
+import csv
+import functools
+import json
+import threading
+import time
+from contextlib import contextmanager
+
+# Lightweight per-phase, per-glacier timing and remote call counts. Off by
+# default; phase() and count() return immediately while disabled.
+
+ENABLED = False
+
+_lock = threading.Lock()
+_local = threading.local()
+_stats = {}             # (glacier, phase) -> {'calls', 'seconds', remote call name -> count}
+
+REPORT_FIELDS = ['glacier', 'phase', 'calls', 'seconds']
+
+# ---------------------------------------------------------------------
+#
+# ---------------------------------------------------------------------
+
+
+def enable(on=True):
+    '''
+    Turn instrumentation on or off.
+    '''
+    global ENABLED
+    ENABLED = on
+
+
+def reset():
+    with _lock:
+        _stats.clear()
+
+
+def _entry(glacier, name):
+    key = (glacier, name)
+    entry = _stats.get(key)
+    if entry is None:
+        entry = _stats[key] = {'calls': 0, 'seconds': 0.}
+    return entry
+
+
+def _stack():
+    stack = getattr(_local, 'stack', None)
+    if stack is None:
+        stack = _local.stack = []
+    return stack
+
+
+@contextmanager
+def _noop():
+    yield
+
+
+@contextmanager
+def _phase(name):
+    stack = _stack()
+    stack.append(name)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        stack.pop()
+        with _lock:
+            entry = _entry(getattr(_local, 'glacier', None), name)
+            entry['calls'] += 1
+            entry['seconds'] += elapsed
+
+
+def phase(name):
+    '''
+    Context manager timing a pipeline phase; remote calls counted inside it
+    are attributed to it (the innermost phase when nested).
+    '''
+    if not ENABLED:
+        return _noop()
+    return _phase(name)
+
+
+@contextmanager
+def glacier(glac_id):
+    '''
+    Attribute the phases run inside the block, on this thread, to a glacier.
+    '''
+    previous = getattr(_local, 'glacier', None)
+    _local.glacier = str(glac_id)
+    try:
+        with phase('glacier'):
+            yield
+    finally:
+        _local.glacier = previous
+
+
+@contextmanager
+def counting(remote):
+    '''
+    Count the remote calls of kind `remote` made on this thread inside the
+    block, whether or not instrumentation is enabled. Yields a dictionary
+    whose 'calls' holds the count so far.
+    '''
+    counter = {'remote': remote, 'calls': 0}
+    counters = getattr(_local, 'counters', None)
+    if counters is None:
+        counters = _local.counters = []
+    counters.append(counter)
+    try:
+        yield counter
+    finally:
+        counters.remove(counter)
+
+
+def count(remote, n=1):
+    '''
+    Count `n` remote calls of kind `remote` (e.g. 'ee.getInfo') against the
+    current phase.
+    '''
+    for counter in getattr(_local, 'counters', ()):
+        if counter['remote'] == remote:
+            counter['calls'] += n
+    if not ENABLED:
+        return
+    stack = _stack()
+    name = stack[-1] if stack else 'other'
+    with _lock:
+        entry = _entry(getattr(_local, 'glacier', None), name)
+        entry[remote] = entry.get(remote, 0) + n
+
+
+def timed(name):
+    '''
+    Decorator running the whole function as phase `name`.
+    '''
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not ENABLED:
+                return func(*args, **kwargs)
+            with _phase(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def report():
+    '''
+    List of one record per (glacier, phase) with its call count, total
+    seconds and remote call counts; glacier is None for run-level phases.
+    '''
+    with _lock:
+        rows = []
+        for (glac_id, name), entry in sorted(_stats.items(), key=lambda kv: (str(kv[0][0]), kv[0][1])):
+            row = {'glacier': glac_id, 'phase': name}
+            row.update(entry)
+            row['seconds'] = round(row['seconds'], 6)
+            rows.append(row)
+        return rows
+
+
+def write_report(fp):
+    '''
+    Write the report as json, or as csv if `fp` ends with .csv.
+    '''
+    rows = report()
+    if fp.endswith('.csv'):
+        fields = list(REPORT_FIELDS)
+        for row in rows:
+            fields.extend(k for k in row if k not in fields)
+        with open(fp, 'w', newline='') as f:
+            w = csv.DictWriter(f, fields)
+            w.writeheader()
+            w.writerows(rows)
+    else:
+        with open(fp, 'w') as f:
+            json.dump(rows, f, indent=2)
+    return fp
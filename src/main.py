@@ -1,8 +1,21 @@
-from GlaciersGEE.query import *
-from GlaciersGEE.gee import *
-from GlaciersGEE.drive import *
-import ee
-from tenacity import retry, wait_exponential
+from GlaciersGEE.query import load_train_set, build_lookup, id_query, SIMPLIFY_TOLERANCE
+from GlaciersGEE.gee import ee_download
+from GlaciersGEE.drive import start_service, get_parent_folder_id, get_folder_index, create_folder, create_folders
+from GlaciersGEE.tasks import ExportScheduler, MAX_RUNNING, TASK_STATE
+from GlaciersGEE.manifest import Manifest, MANIFEST
+from GlaciersGEE.store import MetadataStore, read_records, GLACIER_STORE, GLACIER_CSV
+from GlaciersGEE.cluster import cluster_lookup, write_clusters, CLUSTERS
+from GlaciersGEE.regions import RegionCache, REGIONS
+from GlaciersGEE import instrument, ratelimit
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+# Default number of glaciers processed at once when run_pipeline(pool=True)
+DEFAULT_WORKERS = 4
+
+# Per-thread state for pool workers
+_worker_state = threading.local()
 
 def authenticate():
 	# Earth Engine authentication
@@ -18,16 +31,31 @@ def authenticate():
 
 	return service
 
+def worker_service():
+	'''
+	Drive service for the calling worker thread. The underlying httplib2
+	connection is not thread safe, so each worker builds its own handle
+	on first use and reuses it for every glacier it processes.
+	'''
+	service = getattr(_worker_state, 'drive_service', None)
+	if service is None:
+		service = start_service()
+		_worker_state.drive_service = service
+	return service
+
 def prep_joined(glimsid_list, datadir):
 	'''
 	Gets a subset of joined to prepare for querying
 	:param glimsid_list: list of GLIMS IDs to query
 	:param datadir: data directory
 	'''
-	joined = load_train_set(datadir + 'joined/joined.shp')
-	return joined[joined.glac_id.isin(glimsid_list)]
+	# the id filter is applied while reading the columnar cache of joined.shp
+	joined = load_train_set(datadir + 'joined/joined.shp', glac_ids=glimsid_list)
+	missing = set(glimsid_list) - set(joined.glac_id)
+	if missing:
+		print('%d glaciers not in the training set: %s' % (len(missing), ', '.join(sorted(missing))))
+	return joined
 
-@retry(wait=wait_exponential(multiplier=1, min=2, max=20))
 def single_glacier(
 	glims_id, 
 	subset,
@@ -38,30 +66,120 @@ def single_glacier(
     cloud_tol=20, 
     landsat=True, 
     dem=True,
-	gmted=True):
+	gmted=True,
+	scheduler=None,
+	manifest=None,
+	store=None,
+	**ee_kwargs):
 	'''
 	Queries a dictionary of glacier data, requests data
-	from GEE
+	from GEE. Each Earth Engine and Drive call is rate limited and retried
+	on its own (see ratelimit.call); a glacier that still fails is reported,
+	and a rerun with the manifest resumes it from its last completed step.
 	:param glims_id: GLIMS ID to query
-	:param subset: subset training set from prep_joined
+	:param subset: subset training set from prep_joined, or its lookup from build_lookup
+	:param scheduler: ExportScheduler to queue exports on
+	:param manifest: Manifest of completed steps, so retries only redo unfinished steps
+	:param store: MetadataStore for the glacier records
+	:param ee_kwargs: further keyword arguments of ee_download
 	'''
+	if manifest is not None and manifest.glacier_complete(glims_id) and not ee_kwargs.get('refresh'):
+		print('Glacier', glims_id, 'already done')
+		return
 	print('Beginning glacier', glims_id)
 	queried = id_query(glims_id, subset)
-	ee_download(glims_id, queried, drive_service, folder_name)
+	ee_download(
+		glims_id, queried, drive_service, folder_name,
+		begDate=begDate, endDate=endDate, cloud_tol=cloud_tol, landsat=landsat, dem=dem, gmted=gmted,
+		scheduler=scheduler, manifest=manifest, store=store, **ee_kwargs)
 	# sends init req to GEE for metadata
 	# creates drive location, adds metadata
 	# sends request to GEE
 
-def run_pipeline(glims_id_input, datadir, folder_name, delim=None, ee_params=None, pool=False):
+def run_glacier(glims_id, subset, drive_service, folder_name, scheduler=None, manifest=None, store=None, ee_params=None,
+	regions=None):
+	'''
+	Runs a single glacier, returning the error instead of raising so
+	one failing glacier does not stop the rest of the list
+	:param ee_params: dictionary of keyword arguments for single_glacier/ee_download
+	:param regions: RegionCache of region bounds
+	:returns: None on success, otherwise the exception raised
+	'''
+	try:
+		with instrument.glacier(glims_id):
+			# a dry run compiles export plans only and never touches drive
+			if drive_service is None and not (ee_params or {}).get('dry_run'):
+				drive_service = worker_service()
+			single_glacier(
+				glims_id, subset, drive_service, folder_name,
+				scheduler=scheduler, manifest=manifest, store=store, regions=regions, **(ee_params or {}))
+	except Exception as e:
+		print('Glacier', glims_id, 'failed:', repr(e))
+		return e
+	return None
+
+def load_ee_params(ee_params):
+	'''
+	Earth Engine parameters for ee_download, given as a dictionary or the
+	filepath of a json file holding one
+	'''
+	if not ee_params:
+		return {}
+	if isinstance(ee_params, str):
+		with open(ee_params) as fh:
+			return json.load(fh)
+	return dict(ee_params)
+
+def run_pipeline(glims_id_input, datadir, folder_name, delim=None, ee_params=None, pool=False, max_exports=None,
+	manifest_fp=MANIFEST, store_fp=GLACIER_STORE, report_fp=None, cluster=False, rates=None,
+	regions_fp=REGIONS, simplify=SIMPLIFY_TOLERANCE):
 	'''
 	Runs the data extraction pipeline
 	:param glims_id_input: GLIMS IDs to pass through pipeline; either python list or text filepath
 	:param datadir: data directory
 	:param delim: delimiter to split on if glims_id_input is a text file
-	:param ee_params: file containing custom parameters for Earth Engine collection
+	:param ee_params: custom parameters for Earth Engine collection (keyword arguments of
+	ee_download, e.g. begDate, cloud_tol, gmted); a dictionary or json filepath. With
+	dry_run set, export plans are compiled without authenticating to or creating anything on drive,
+	and no manifest, metadata store, region cache or cluster mapping is opened or written.
+	With refresh set, glaciers already done are run again, exporting only the scenes newer than
+	those already in their drive folder (see gee.existing_scenes)
+	:param pool: False to run glaciers one at a time; True or a number of
+	workers to run glaciers concurrently in a thread pool (True uses DEFAULT_WORKERS)
+	:param max_exports: maximum number of Earth Engine exports in flight, default tasks.MAX_RUNNING
+	:param manifest_fp: filepath of the checkpoint manifest; a rerun skips the steps recorded
+	in it. None to disable.
+	:param store_fp: filepath of the glacier metadata store, exported to glacierInfo.csv at the end
+	(dry runs only read it, for a refresh); a new store first imports the rows earlier runs appended to glacierInfo.csv
+	:param report_fp: if given, time every pipeline phase per glacier, count the Earth Engine
+	and Drive calls made in each, and write the report to this filepath (.json or .csv)
+	:param cluster: export nearby glaciers together, one task per scene per cluster region
+	(see cluster.cluster_lookup); True for the default grid, or a dictionary of cluster_lookup
+	arguments. The cluster -> glacier bounds mapping is written to clusters.json for cutting
+	the glaciers back out of the downloaded rasters.
+	:param rates: dictionary of budget name ('ee', 'ee.export', 'drive') -> (requests per
+	second, burst) shared by all workers, overriding ratelimit.RATES
+	:param regions_fp: filepath of the cache of glacier regions and their bounds, reused across
+	runs so each region is resolved on Earth Engine once. None to disable.
+	:param simplify: tolerance in degrees the outlines stored in the glacier records are
+	simplified to (see query.simplify_outlines); 0 or None keeps the full outlines. Export
+	regions are bounding boxes of the full outlines and do not change with it
+	:returns: dictionary of GLIMS ID -> None if it succeeded, else the exception raised
 	'''
+	if report_fp:
+		instrument.enable()
+		instrument.reset()
+
+	ee_params = load_ee_params(ee_params)
+	if rates:
+		ratelimit.configure(**rates)
+	dry_run = ee_params.get('dry_run', False)
+
 	# authenticate first
-	drive_service = authenticate()
+	drive_service = None
+	if not dry_run:
+		with instrument.phase('authenticate'):
+			drive_service = authenticate()
 
 	if delim:
 		# read in list from text file
@@ -70,8 +188,91 @@ def run_pipeline(glims_id_input, datadir, folder_name, delim=None, ee_params=Non
 	else:
 		ids_list = glims_id_input
 
-	train_set = prep_joined(ids_list, datadir)
-	# run glaciers one at a time
-	for glims_id in ids_list:
-			single_glacier(glims_id, train_set, drive_service, folder_name)
+	# glacier lookup built once per run; queries are dictionary hits
+	with instrument.phase('prep_joined'):
+		joined = prep_joined(ids_list, datadir)
+	train_set = build_lookup(joined, tolerance=simplify)
+
+	if cluster:
+		# clustered glaciers are replaced by their cluster; ids that are not
+		# in the lookup stay in the list so they are reported as failures
+		missing = [k for k in ids_list if k not in train_set]
+		train_set, clusters = cluster_lookup(train_set, **(cluster if isinstance(cluster, dict) else {}))
+		if not dry_run:
+			write_clusters(clusters, CLUSTERS)
+		ids_list = list(train_set) + missing
+		print('%d glaciers in %d clusters, %d exported alone' % (
+			sum(len(c['members']) for c in clusters.values()), len(clusters), len(ids_list) - len(clusters)))
+
+	# create every glacier's drive folder up front in batched requests
+	if not dry_run:
+		with instrument.phase('drive_folders'):
+			# the folder index covers the tree under this run's root folder
+			index = get_folder_index(root=folder_name)
+			try:
+				parentID = get_parent_folder_id(drive_service, name=folder_name, index=index)
+			except KeyError:
+				parentID = create_folder(drive_service, folder_name, index=index)
+			create_folders(drive_service, [str(k) for k in train_set], parentID=parentID, index=index)
+
+	# a dry run only prints the export plans: nothing is recorded on disk
+	if dry_run:
+		manifest_fp, regions_fp = None, None
+	manifest = Manifest(manifest_fp) if manifest_fp else None
+	listener = manifest.export_listener if manifest else None
+	scheduler = ExportScheduler(
+		max_running=max_exports or MAX_RUNNING, listener=listener, state_fp=None if dry_run else TASK_STATE)
+	on_commit = (lambda ids: [manifest.mark(i, 'csv') for i in ids]) if manifest else None
+	if dry_run:
+		# a refresh previews its new scenes from the records of earlier runs
+		store = read_records(store_fp) if store_fp and ee_params.get('refresh') else None
+	else:
+		store = MetadataStore(store_fp, on_commit=on_commit) if store_fp else None
+	regions = RegionCache(regions_fp) if regions_fp else None
+	results = {}
+
+	if not pool:
+		# run glaciers one at a time
+		for glims_id in ids_list:
+			results[glims_id] = run_glacier(
+				glims_id, train_set, drive_service, folder_name, scheduler, manifest, store, ee_params, regions)
+	else:
+		# run glaciers concurrently; each worker thread starts its own drive service
+		workers = DEFAULT_WORKERS if pool is True else int(pool)
+		with ThreadPoolExecutor(max_workers=workers) as executor:
+			futures = {
+				executor.submit(
+					run_glacier, glims_id, train_set, None, folder_name, scheduler, manifest, store, ee_params, regions
+				): glims_id
+				for glims_id in ids_list
+			}
+			for future in as_completed(futures):
+				results[futures[future]] = future.result()
+
+	failed = [k for (k, v) in results.items() if v is not None]
+	print('Finished %d glaciers, %d failed' % (len(results), len(failed)))
+	if failed:
+		print('Failed glaciers:', ', '.join(failed))
+
+	if regions is not None:
+		regions.close()
+	if not dry_run:
+		get_folder_index().flush()
+
+	# commit the remaining glacier records and export them as csv
+	if store is not None and not dry_run:
+		with instrument.phase('store_export'):
+			store.close()
+			store.to_csv(GLACIER_CSV)
+
+	# wait for the remaining exports
+	with instrument.phase('export_wait'):
+		scheduler.wait()
+	stats = scheduler.stats()
+	print('Exports: %d completed, %d failed, %.1f tasks/min' % (stats['completed'], stats['failed'], stats['tasks_per_min']))
+
+	if report_fp:
+		print('Timing report written to', instrument.write_report(report_fp))
+		instrument.enable(False)
 
+	return results
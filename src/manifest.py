@@ -0,0 +1,139 @@
+import json
+import sqlite3
+import threading
+import time
+
+# Checkpoint database of completed pipeline steps
+
+MANIFEST = 'manifest.db'
+
+# Step states
+
+DONE = 'done'
+QUEUED = 'queued'
+STARTED = 'started'
+FINISHED = 'finished'
+FAILED = 'failed'
+
+# ---------------------------------------------------------------------
+#
+# ---------------------------------------------------------------------
+
+
+class Manifest(object):
+    '''
+    Crash-safe record (SQLite) of the pipeline steps completed for each
+    glacier and scene: scene metadata fetched, folder created, csv row
+    written, each export queued, started or finished. Every record is
+    committed immediately, so reruns and retries can skip work that is
+    already done. A glacier is only done once all of its exports finished.
+    '''
+
+    def __init__(self, fp=MANIFEST):
+        self.fp = fp
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(fp, check_same_thread=False)
+        if fp != ':memory:':
+            self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS steps ('
+            'glac_id TEXT NOT NULL, step TEXT NOT NULL, item TEXT NOT NULL DEFAULT \'\', '
+            'state TEXT NOT NULL, value TEXT, updated REAL, '
+            'PRIMARY KEY (glac_id, step, item))'
+        )
+        self.conn.commit()
+
+    def mark(self, glac_id, step, item='', state=DONE, value=None):
+        '''
+        Record a step as `state`, with an optional json-serialisable value.
+        '''
+        with self._lock:
+            self.conn.execute(
+                'INSERT OR REPLACE INTO steps VALUES (?, ?, ?, ?, ?, ?)',
+                (str(glac_id), step, str(item), state, json.dumps(value), time.time())
+            )
+            self.conn.commit()
+
+    def state(self, glac_id, step, item=''):
+        '''
+        State of a step, or None if it was never recorded.
+        '''
+        with self._lock:
+            row = self.conn.execute(
+                'SELECT state FROM steps WHERE glac_id = ? AND step = ? AND item = ?',
+                (str(glac_id), step, str(item))
+            ).fetchone()
+        return row[0] if row else None
+
+    def get(self, glac_id, step, item=''):
+        '''
+        Value stored with a step, or None.
+        '''
+        with self._lock:
+            row = self.conn.execute(
+                'SELECT value FROM steps WHERE glac_id = ? AND step = ? AND item = ?',
+                (str(glac_id), step, str(item))
+            ).fetchone()
+        return json.loads(row[0]) if row and row[0] is not None else None
+
+    def done(self, glac_id, step, item=''):
+        '''
+        Whether a step has been completed (or, for exports, started);
+        exports queued but not started are not done.
+        '''
+        return self.state(glac_id, step, item) in (DONE, STARTED, FINISHED)
+
+    def items(self, glac_id, step):
+        '''
+        Dictionary of item -> state of the recorded items of a step.
+        '''
+        with self._lock:
+            rows = self.conn.execute(
+                'SELECT item, state FROM steps WHERE glac_id = ? AND step = ?',
+                (str(glac_id), step)
+            ).fetchall()
+        return dict(rows)
+
+    def glacier_complete(self, glac_id):
+        '''
+        Whether every step of a glacier ran and none of its exports failed
+        or is still waiting to be started.
+        '''
+        if not self.done(glac_id, 'glacier'):
+            return False
+        states = set(self.items(glac_id, 'export').values())
+        return FAILED not in states and QUEUED not in states
+
+    def finish_glacier(self, glac_id):
+        '''
+        Mark a glacier done if all of its exports were submitted (the
+        'submitted' step) and every one of them has finished.
+        :returns: whether the glacier is done
+        '''
+        if not self.done(glac_id, 'submitted'):
+            return False
+        if set(self.items(glac_id, 'export').values()) - {FINISHED}:
+            return False
+        self.mark(glac_id, 'glacier')
+        return True
+
+    def export_listener(self, key, state):
+        '''
+        Listener for ExportScheduler state changes; records exports as
+        queued, started, finished or failed, and the glacier as done once
+        its last export finished. Keys are 'glacier id/export name'.
+        '''
+        glac_id, _, name = key.partition('/')
+        if state == 'QUEUED':
+            self.mark(glac_id, 'export', name, state=QUEUED)
+        elif state == 'READY':
+            self.mark(glac_id, 'export', name, state=STARTED)
+        elif state == 'COMPLETED':
+            self.mark(glac_id, 'export', name, state=FINISHED)
+            self.finish_glacier(glac_id)
+        elif state in ('FAILED', 'CANCELLED', 'UNKNOWN'):
+            self.mark(glac_id, 'export', name, state=FAILED)
+
+    def close(self):
+        with self._lock:
+            self.conn.close()
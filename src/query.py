@@ -1,10 +1,111 @@
-import pandas as pd
-import numpy as np
-import geopandas as gpd
-import fiona
-from shapely.geometry import Point
+import json
 import os
 
+from GlaciersGEE import instrument
+
+# pandas, numpy, geopandas, fiona and shapely are imported by the functions
+# that use them, so importing the package (and the CLI) stays fast
+
+# Shapefile components that make up a source's signature, and the columnar
+# cache kept next to a training set shapefile with its source signature
+SHP_PARTS = ('.shp', '.dbf', '.shx', '.prj')
+TRAIN_CACHE = '.feather'
+TRAIN_CACHE_META = '.feather.json'
+
+# WGMS columns kept, with the dtype they are read as, the glacier class kept
+# (5, valley glacier), rows per chunk and the default cache file name
+WGMS_DTYPES = {
+    'POLITICAL_UNIT': 'str', 'NAME': 'str', 'WGMS_ID': 'int64', 'LATITUDE': 'float64',
+    'LONGITUDE': 'float64', 'PRIM_CLASSIFIC': 'float64', 'GLIMS_ID': 'str'
+}
+WGMS_CLASS = 5
+WGMS_CHUNKSIZE = 100000
+WGMS_CACHE = 'wgms.feather'
+
+# Tolerance in degrees (about 10 m) outlines are simplified to; well under a
+# Landsat pixel, while GLIMS outlines can have thousands of vertices. Only the
+# stored outline (the 'coords' of a glacier record) is simplified: exports are
+# clipped to the scaled bounding box, which is taken from the full outline.
+SIMPLIFY_TOLERANCE = 1e-4
+
+def write_columnar(gdf, fp):
+    '''
+    Write a GeoDataFrame to a columnar (feather) cache, with geometry stored
+    as WKB so that it can be read back without parsing a shapefile
+    :param gdf: GeoDataFrame to write
+    :param fp: filepath of the .feather cache
+    '''
+    import pandas as pd
+
+    df = pd.DataFrame(gdf.drop(columns='geometry'))
+    df['geometry'] = [g.wkb if g is not None else None for g in gdf.geometry]
+    df.reset_index(drop=True).to_feather(fp)
+
+
+def read_columnar(fp, columns=None, where=None):
+    '''
+    Read a GeoDataFrame written by write_columnar
+    :param fp: filepath of the .feather cache
+    :param columns: columns to read, geometry is always included
+    :param where: dictionary of column -> wanted values; rows are filtered on
+    the memory-mapped table, before any conversion to pandas or geometry
+    '''
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.feather as feather
+    import geopandas as gpd
+    from shapely import wkb
+
+    where = where or {}
+    read = None
+    if columns is not None:
+        columns = [c for c in columns if c != 'geometry'] + ['geometry']
+        read = columns + [c for c in where if c not in columns]
+    table = feather.read_table(fp, columns=read, memory_map=True)
+    for col, values in where.items():
+        values = pa.array(list(values)).cast(table.schema.field(col).type)
+        table = table.filter(pc.is_in(table[col], value_set=values))
+    if columns is not None:
+        table = table.select(columns)
+
+    df = table.to_pandas()
+    geometry = [wkb.loads(g) if g is not None else None for g in df.pop('geometry')]
+    return gpd.GeoDataFrame(df, geometry=geometry, crs={'init': 'epsg:4326'})
+
+
+def stream_features(fp, cols, key, chunksize=50000):
+    '''
+    Stream a shapefile with fiona, keeping only `cols` and the most recent
+    feature for every value of `key` (keep-last). Only one row per key is
+    held in memory, regardless of the size of the file. Geometries are
+    converted to shapely as they are read, so no nested GeoJSON mapping is
+    kept.
+
+    :param fp: filepath of the shapefile
+    :param cols: property columns to keep
+    :param key: property to de-duplicate on
+    :param chunksize: number of features between progress messages
+    :returns: dictionary of key -> (properties, shapely geometry or None)
+    '''
+    import fiona
+    from shapely.geometry import shape
+
+    rows = {}
+    with fiona.open(fp) as src:
+        for k, feature in enumerate(src, start=1):
+            props = feature['properties']
+            row = {c: props[c] for c in cols}
+            # remove before inserting so the kept row takes the position
+            # of the last occurrence, as drop_duplicates(keep='last') does
+            rows.pop(row[key], None)
+            geometry = feature['geometry']
+            rows[row[key]] = (row, shape(geometry) if geometry else None)
+            if k % chunksize == 0:
+                print('Read %d features' % k)
+    return rows
+
+
+@instrument.timed('open_glims_shp')
 def open_glims_shp(poly_fp, cols, pt_fp=None, outp=None, chunksize=50000):
     '''
     Open glims shapefile, keeping only most recent observations
@@ -12,107 +113,279 @@ def open_glims_shp(poly_fp, cols, pt_fp=None, outp=None, chunksize=50000):
     :param poly_fp: filepath to glims_polygons.shp
     :param pt_fp: filepath to glims_points.shp
     :param cols: columns to keep
-    :param outp: output filepath folder
-    :param chunksize: chunksize for reading in shapefile in fiona
+    :param outp: output filepath folder; writes glims_polys.shp and the
+    columnar cache glims_polys.feather
+    :param chunksize: number of features between progress messages
     '''
+    import pandas as pd
+    import geopandas as gpd
 
-    # Read in polygon file
-    file = fiona.open(poly_fp)
-    
-    def reader(file, cols, chunksize):
-        ''' 
-        Read in shapefile, keeping only columns in usecols 
-
-        :param cols: columns to keep
-        :param r: portions of file to open
-        '''
-        out = []
-        for k, feature in enumerate(file):
-            if (k + 1) % chunksize:
-                f = {k: feature[k] for k in ['geometry']}
-                f['properties'] = {k: feature['properties'][k] for k in cols}
-                out.append(f)
-            else:
-                yield gpd.GeoDataFrame.from_features(out).drop_duplicates('glac_id', keep='last')
-                out = []
-                
-    counter = 1
-    for chunk in reader(file, cols, chunksize):
-        try:
-            glims = glims.append(chunk, ignore_index=True)
-        except NameError:
-            glims = chunk
-        print('Finished chunk', counter)
-        counter += 1
-    
-    glims = glims.drop(columns=['anlys_time'])
+    # Read in polygon file, projecting columns and de-duplicating while reading
+    cols = list(cols)
+    if 'glac_id' not in cols:
+        cols.append('glac_id')
+    rows = stream_features(poly_fp, cols, 'glac_id', chunksize=chunksize)
+
+    # build the frame once
+    data = pd.DataFrame([r for (r, _) in rows.values()], columns=cols)
+    geometry = [g for (_, g) in rows.values()]
+    del rows
+    glims = gpd.GeoDataFrame(data, geometry=geometry)
+    print('Read %d glaciers' % len(glims))
+
+    glims = glims.drop(columns=['anlys_time'], errors='ignore')
     glims.crs = {'init' :'epsg:4326'}
 
     # Read in point file and merge
 
-    pts =  gpd.read_file(pt_fp)
-    pts['x'] = pts.geometry.x
-    pts['y'] = pts.geometry.y
-    pts_tomerge = pts[['glacier_id', 'x', 'y']].rename(columns={'glacier_id': 'glac_id'})
-    glims = glims.merge(pts_tomerge).drop_duplicates('glac_id', keep='last')
+    if pt_fp:
+        pts = stream_features(pt_fp, ['glacier_id'], 'glacier_id', chunksize=chunksize)
+        pts_tomerge = pd.DataFrame(
+            [(k, g.x, g.y) for (k, (_, g)) in pts.items()],
+            columns=['glac_id', 'x', 'y']
+        )
+        del pts
+        glims = glims.merge(pts_tomerge)
 
     if outp:
-        os.mkdir(outp)
+        os.makedirs(outp, exist_ok=True)
         glims.to_file(outp + '/glims_polys.shp')
-    
+        write_columnar(glims, outp + '/glims_polys.feather')
+
     return glims
 
+@instrument.timed('read_glims_gdf')
 def read_glims_gdf(fp, cols=None, pt_fp=None, outp=None):
     '''
     Read in the glims shapefile
-    :param fp: filepath of either glims_gdf.shp or glims_polygons.shp
+    :param fp: filepath of either glims_gdf.shp, glims_polys.feather or glims_polygons.shp
     :param outp: output filepath folder of glims_gdf.shp if fp == glims_polygons.shp
     '''
+    import geopandas as gpd
+
     if outp:                                        
         glims_gdf = open_glims_shp(fp, cols, pt_fp=pt_fp, outp=outp)       # opens the raw shp file
+    elif fp.endswith('.feather'):
+        glims_gdf = read_columnar(fp, columns=cols)              # reads in columnar cache
     else:
         glims_gdf = gpd.read_file(fp)                            # reads in cleaned shp file
         glims_gdf.crs = {'init' :'epsg:4326'}
     
     return glims_gdf
 
-def read_wgms_gdf(*filepaths, gdf_fp=None, outp=None):
+def read_wgms_csv(fp, chunksize=WGMS_CHUNKSIZE, wgms_ids=None):
+    '''
+    Read the wanted columns of a wgms csv with fixed dtypes, in chunks,
+    dropping rows of other glacier classes from each chunk as it is read
+    :param wgms_ids: if given, also drop rows whose WGMS_ID is not in it
     '''
-    Read in the wgms file as a GeoDataFrame
+    import pandas as pd
+
+    chunks = pd.read_csv(
+        fp, encoding='latin1', usecols=lambda c: c in WGMS_DTYPES,
+        dtype=WGMS_DTYPES, chunksize=chunksize
+    )
+    kept = []
+    for chunk in chunks:
+        if 'PRIM_CLASSIFIC' in chunk.columns:
+            chunk = chunk[chunk.PRIM_CLASSIFIC == WGMS_CLASS]
+            chunk = chunk.astype({'PRIM_CLASSIFIC': 'int64'})
+        if wgms_ids is not None and 'WGMS_ID' in chunk.columns:
+            chunk = chunk[chunk.WGMS_ID.isin(wgms_ids)]
+        kept.append(chunk)
+    return pd.concat(kept, ignore_index=True)
+
+
+@instrument.timed('read_wgms_gdf')
+def read_wgms_gdf(*filepaths, gdf_fp=None, outp=None, cache=True, cache_fp=None, chunksize=WGMS_CHUNKSIZE):
+    '''
+    Read in the wgms file as a GeoDataFrame. The result is cached as
+    wgms.feather next to the first csv, and rebuilt when any csv changes.
     :param filepaths: filepaths of wanted wgms datasets
     :param gdf_fp: filepath to wgms.shp, allows for direct opening of shapefile
     :param outp: output filepath folder of wgms_gdf
+    :param cache: read and write the columnar cache
+    :param cache_fp: filepath of the cache, default wgms.feather beside the first csv
+    :param chunksize: csv rows read at a time
     '''
+    import geopandas as gpd
+
     if gdf_fp:
         wgms_gdf = gpd.read_file(gdf_fp)
         wgms_gdf.crs = {'init' :'epsg:4326'}
         return wgms_gdf
 
-    wanted_cols = 'POLITICAL_UNIT NAME WGMS_ID LATITUDE LONGITUDE PRIM_CLASSIFIC GLIMS_ID'.split()
-
-    for f in filepaths:
-        df = pd.read_csv(f, encoding='latin1')
-        df = df[df.columns[df.columns.isin(wanted_cols)]]
-        try:
-            wgms = wgms.merge(df)
-        except NameError:
-            wgms = df
-
-    # keep only valley, wanted cols
-    wgms = wgms[wgms.PRIM_CLASSIFIC == 5].reset_index(drop=True)
+    cache_fp = cache_fp or os.path.join(os.path.dirname(filepaths[0]), WGMS_CACHE)
+    signature = {'files': [source_signature(f) for f in filepaths], 'class': WGMS_CLASS}
+    if cache and cached_signature(cache_fp) == signature:
+        wgms_gdf = read_columnar(cache_fp)
+    else:
+        # filtering each file before the merge keeps the same rows as
+        # filtering after it, since the merge is an inner join; later files
+        # only keep the WGMS_IDs left in the merge so far
+        wgms = None
+        for f in filepaths:
+            ids = wgms.WGMS_ID.unique() if wgms is not None and 'WGMS_ID' in wgms.columns else None
+            df = read_wgms_csv(f, chunksize=chunksize, wgms_ids=ids)
+            wgms = df if wgms is None else wgms.merge(df)
 
-    geometry = [Point(xy) for xy in zip(wgms['LONGITUDE'], wgms['LATITUDE'])]
-    crs = {'init': 'epsg:4326'}
+        geometry = gpd.points_from_xy(wgms['LONGITUDE'], wgms['LATITUDE'])
+        crs = {'init': 'epsg:4326'}
 
-    wgms_gdf = gpd.GeoDataFrame(wgms, crs=crs, geometry=geometry).drop(columns=['LONGITUDE', 'LATITUDE'])
+        wgms_gdf = gpd.GeoDataFrame(wgms, crs=crs, geometry=geometry).drop(columns=['LONGITUDE', 'LATITUDE'])
+        if cache:
+            write_cache(wgms_gdf, cache_fp, signature)
 
     if outp:
-        os.mkdir(outp)
+        os.makedirs(outp, exist_ok=True)
         wgms_gdf.to_file(outp + '/wgms.shp')
 
     return wgms_gdf
 
-def sjoin(glims_gdf=None, wgms_gdf=None, glims_fp=None, wgms_fps=None, outp=None):
+def strtree_pairs(polys, points):
+    '''
+    Find intersecting (polygon, point) pairs using a packed R-tree (STRtree)
+    built over the points as a candidate prefilter
+    :param polys: sequence of polygons
+    :param points: sequence of points
+    :returns: sorted list of (polygon position, point position) pairs
+    '''
+    import numpy as np
+    import shapely
+    from shapely.strtree import STRtree
+    from shapely.prepared import prep
+
+    points = list(points)
+    if not points:
+        return []
+    tree = STRtree(points)
+
+    if int(shapely.__version__.split('.')[0]) < 2:
+        # shapely < 2: query one polygon at a time; the tree returns the
+        # geometries themselves instead of positions
+        positions = {id(p): j for (j, p) in enumerate(points)}
+        pairs = []
+        for i, poly in enumerate(polys):
+            if poly is None:
+                continue
+            hits = tree.query(poly)
+            if len(hits) == 0:
+                continue
+            prepared = prep(poly)
+            for hit in hits:
+                j = positions[id(hit)]
+                if prepared.intersects(points[j]):
+                    pairs.append((i, j))
+        return sorted(pairs)
+
+    # shapely >= 2: bulk query of every polygon against the tree
+    left, right = tree.query(np.asarray(polys, dtype=object), predicate='intersects')
+    pairs = list(zip(left.tolist(), right.tolist()))
+    return sorted(pairs)
+
+
+def _join_partition(glims_part, wgms_part, part_fp=None):
+    '''
+    Join one spatial partition of glims to its candidate wgms points, in the
+    same layout as gpd.sjoin. Written to `part_fp` if given.
+    '''
+    import pandas as pd
+
+    pairs = strtree_pairs(glims_part.geometry.values, wgms_part.geometry.values)
+    left = glims_part.iloc[[i for (i, _) in pairs]]
+    right = pd.DataFrame(wgms_part.drop(columns='geometry')).iloc[[j for (_, j) in pairs]]
+
+    overlap = (set(left.columns) & set(right.columns)) - {'geometry'}
+    left = left.rename(columns={c: c + '_left' for c in overlap})
+    right = right.rename(columns={c: c + '_right' for c in overlap})
+
+    joined = left.copy()
+    joined['index_right'] = right.index.values
+    for c in right.columns:
+        joined[c] = right[c].values
+
+    if part_fp:
+        joined.index.name = 'index'
+        joined = joined.reset_index()
+        write_columnar(joined, part_fp)
+        return part_fp
+    return joined
+
+
+def sjoin_partitioned(glims_gdf, wgms_gdf, n_partitions=None, workers=None, outp=None):
+    '''
+    Spatial join of glims polygons and wgms points split into longitude
+    strips of equal glacier count, joined across a process pool. Each
+    partition only receives the wgms points inside its bounds, and is
+    joined with an STRtree prefilter.
+    :param n_partitions: number of spatial partitions, default 4 per worker
+    :param workers: number of processes, default number of cpus; 1 runs in process
+    :param outp: folder to stream partition results to, otherwise kept in memory
+    :returns: joined GeoDataFrame, all matching pairs as with gpd.sjoin
+    '''
+    from concurrent.futures import ProcessPoolExecutor
+    import numpy as np
+    import pandas as pd
+    import geopandas as gpd
+
+    workers = workers or os.cpu_count() or 1
+    n_partitions = n_partitions or 4 * workers
+
+    bounds = glims_gdf.bounds
+    order = np.argsort(bounds.minx.values, kind='mergesort')
+    pt_x = wgms_gdf.geometry.x.values
+    pt_y = wgms_gdf.geometry.y.values
+
+    parts_dir = None
+    if outp:
+        parts_dir = os.path.join(outp, 'parts')
+        os.makedirs(parts_dir, exist_ok=True)
+
+    jobs = []
+    for k, idx in enumerate(np.array_split(order, n_partitions)):
+        if len(idx) == 0:
+            continue
+        b = bounds.iloc[idx]
+        inside = (
+            (pt_x >= b.minx.min()) & (pt_x <= b.maxx.max()) &
+            (pt_y >= b.miny.min()) & (pt_y <= b.maxy.max())
+        )
+        part_fp = os.path.join(parts_dir, 'part_%04d.feather' % k) if parts_dir else None
+        jobs.append((glims_gdf.iloc[idx], wgms_gdf[inside], part_fp))
+
+    if workers == 1:
+        results = [_join_partition(*job) for job in jobs]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(_join_partition, *zip(*jobs)))
+
+    if parts_dir:
+        results = [read_columnar(fp).set_index('index') for fp in results]
+
+    joined = pd.concat(results) if results else glims_gdf.iloc[:0]
+    joined = gpd.GeoDataFrame(joined, crs=glims_gdf.crs)
+    # same row order as gpd.sjoin: by glims index, then wgms index
+    joined['_left'] = joined.index
+    joined = joined.sort_values(['_left', 'index_right'], kind='mergesort').drop(columns='_left')
+    joined.index.name = glims_gdf.index.name
+    return joined
+
+
+def gpd_sjoin(glims_gdf, wgms_gdf):
+    '''
+    gpd.sjoin on intersects, with the keyword of the installed geopandas
+    (`op` before 0.10, `predicate` since)
+    '''
+    import inspect
+    import geopandas as gpd
+
+    if 'predicate' in inspect.signature(gpd.sjoin).parameters:
+        return gpd.sjoin(glims_gdf, wgms_gdf, predicate='intersects')
+    return gpd.sjoin(glims_gdf, wgms_gdf, op='intersects')
+
+@instrument.timed('sjoin')
+def sjoin(glims_gdf=None, wgms_gdf=None, glims_fp=None, wgms_fps=None, outp=None,
+          engine='geopandas', workers=None):
     '''
     Spatially join glims and wgms datasets
     :param glims_gdf: glims_gdf output from read_glims_gdf()
@@ -120,46 +393,198 @@ def sjoin(glims_gdf=None, wgms_gdf=None, glims_fp=None, wgms_fps=None, outp=None
     :param glims_fp: filepath of glims_gdf
     :param wgms_fp: list of filepaths for wgms_gdf (wA and wAA)
     :param outp: output filepath of joined.shp
+    :param engine: 'geopandas' for a single gpd.sjoin call, or 'strtree'
+    for the partitioned, parallel join in sjoin_partitioned, which only
+    pays off with many cpus and an older geopandas. Both give the same
+    result: glaciers over several wgms points keep the lowest wgms index.
+    :param workers: number of processes for the 'strtree' engine
     '''
+    import numpy as np
+
     # If input are filepaths not df objects
     if glims_fp:
         glims_gdf = read_glims_gdf(glims_fp)
         wgms_gdf = read_wgms_gdf(*wgms_fps)
 
-    joined = gpd.sjoin(glims_gdf, wgms_gdf, op='intersects')
+    if engine == 'strtree':
+        joined = sjoin_partitioned(glims_gdf, wgms_gdf, workers=workers, outp=outp)
+    elif engine == 'geopandas':
+        joined = gpd_sjoin(glims_gdf, wgms_gdf)
+    else:
+        raise ValueError('Unknown sjoin engine: %s' % engine)
 
     if outp:
-        os.mkdir(outp)
+        os.makedirs(outp, exist_ok=True)
         joined.to_file(outp + '/joined.shp')
-    
-    return joined.drop_duplicates('glac_id')
 
-def load_train_set(fp):
+    # the pairs of every engine in the same order, so the same wgms point is kept
+    order = np.lexsort((joined.index_right.values, joined.index.values))
+    return joined.iloc[order].drop_duplicates('glac_id')
+
+def source_signature(fp, digest=False):
+    '''
+    Signature of a shapefile (all of its SHP_PARTS) or any other file: the
+    size and mtime of each part, or a sha1 of their contents if `digest`.
+    '''
+    import hashlib
+
+    base, ext = os.path.splitext(fp)
+    parts = [base + p for p in SHP_PARTS] if ext.lower() == '.shp' else [fp]
+    signature = {}
+    for part in parts:
+        if not os.path.exists(part):
+            continue
+        if digest:
+            sha = hashlib.sha1()
+            with open(part, 'rb') as fh:
+                for block in iter(lambda: fh.read(1 << 20), b''):
+                    sha.update(block)
+            signature[os.path.basename(part)] = sha.hexdigest()
+        else:
+            stat = os.stat(part)
+            signature[os.path.basename(part)] = [stat.st_size, stat.st_mtime]
+    return signature
+
+
+def cached_signature(cache_fp):
+    '''
+    Source signature recorded with a columnar cache, or None if the cache
+    or its signature is missing
+    '''
+    meta_fp = os.path.splitext(cache_fp)[0] + TRAIN_CACHE_META
+    if not (os.path.exists(cache_fp) and os.path.exists(meta_fp)):
+        return None
+    with open(meta_fp) as fh:
+        return json.load(fh).get('source')
+
+
+def write_cache(gdf, cache_fp, signature):
+    '''
+    Write a columnar cache with the signature of its source. Failures are
+    reported, not raised, since the data itself was read.
     '''
-    Load in training set for querying
+    meta_fp = os.path.splitext(cache_fp)[0] + TRAIN_CACHE_META
+    try:
+        # the old signature goes first, so a partly written cache is never used
+        if os.path.exists(meta_fp):
+            os.remove(meta_fp)
+        write_columnar(gdf, cache_fp)
+        tmp = meta_fp + '.tmp'
+        with open(tmp, 'w') as fh:
+            json.dump({'source': signature}, fh)
+        os.replace(tmp, meta_fp)
+    except Exception as e:
+        print('Could not write cache %s: %r' % (cache_fp, e))
+
+
+@instrument.timed('load_train_set')
+def load_train_set(fp, glac_ids=None, columns=None, cache=True, digest=False):
+    '''
+    Load in training set for querying. The shapefile is read once and kept
+    in a columnar cache next to it (joined.feather), which is rebuilt when
+    the shapefile changes; the glac_id filter and column selection are
+    applied while reading the cache, so small id lists load quickly.
     :param fp: filepath of joined.shp
+    :param glac_ids: glacier ids to load, default all
+    :param columns: columns to load, default all; geometry is always included
+    :param cache: read and write the columnar cache
+    :param digest: detect changes to the shapefile by content hash rather
+    than size and modification time
+    :raises IOError: if neither the shapefile nor a cache of it can be read
     '''
+    import geopandas as gpd
+
+    cache_fp = os.path.splitext(fp)[0] + TRAIN_CACHE
+    where = {'glac_id': glac_ids} if glac_ids is not None else None
+    source_exists = os.path.exists(fp)
+    if not source_exists and not (cache and os.path.exists(cache_fp)):
+        raise IOError('Training set not found: %s' % fp)
+
+    signature = source_signature(fp, digest=digest) if source_exists else None
+    cached = cached_signature(cache_fp) if cache else None
+    if cached is not None:
+        if signature is None or cached == signature:
+            if signature is None:
+                print('Training set %s not found, using its cache %s' % (fp, cache_fp))
+            return read_columnar(cache_fp, columns=columns, where=where)
+        print('Training set %s changed, rebuilding its cache' % fp)
+
     try:
-        return gpd.read_file(fp)
-    except:
-        # incomplete
-        # glims_gdf = read_glims_gdf()                # load glims gdf
-        # wgms_gdf = read_wgms_gdf()                  # load wgms gdf
-        # joined = sjoin(glims_gdf, wgms_gdf)         # spatial join
-        # os.mkdir('../data/joined')
-        # joined.to_file(fp)
-        # return joined
-        return
-
-def id_query(glims_id, subset, scale_fact=1.1):
+        joined = gpd.read_file(fp)
+    except Exception as e:
+        raise IOError('Could not read training set %s: %r' % (fp, e))
+
+    if cache:
+        write_cache(joined, cache_fp, signature)
+
+    if glac_ids is not None:
+        joined = joined[joined.glac_id.isin(list(glac_ids))]
+    if columns is not None:
+        joined = joined[[c for c in columns if c != 'geometry'] + ['geometry']]
+    return joined
+
+def simplify_outlines(geometry, tolerance=SIMPLIFY_TOLERANCE):
+    '''
+    Simplify every outline of a GeoSeries in one vectorized call, keeping
+    them valid polygons; a falsy tolerance returns them unchanged. This
+    shrinks the stored glacier records, not the export regions, which are
+    bounding boxes
+    '''
+    if not tolerance:
+        return geometry
+    return geometry.simplify(tolerance, preserve_topology=True)
+
+@instrument.timed('build_lookup')
+def build_lookup(subset, scale_fact=1.1, tolerance=SIMPLIFY_TOLERANCE):
+    '''
+    Precompute the id_query output of every glacier in one pass, so each
+    query is a dictionary lookup rather than a scan of the subset
+    :param subset: subset of joined GeoDataFrame
+    :param scalefact: factor to scale bounding boxes by, default 10%
+    :param tolerance: outline simplification tolerance in degrees, see simplify_outlines;
+    bounding boxes are always those of the full outlines
+    :returns: dictionary of glac_id -> glacier dictionary
+    '''
+    subset = subset.drop_duplicates('glac_id', keep='first')
+    outlines = simplify_outlines(subset.geometry, tolerance)
+
+    # bounding boxes scaled about their centres, in envelope coordinate order
+    b = subset.geometry.bounds
+    cx, cy = (b.minx.values + b.maxx.values) / 2, (b.miny.values + b.maxy.values) / 2
+    hx, hy = (b.maxx.values - b.minx.values) * scale_fact / 2, (b.maxy.values - b.miny.values) * scale_fact / 2
+    x0, x1, y0, y1 = (cx - hx).tolist(), (cx + hx).tolist(), (cy - hy).tolist(), (cy + hy).tolist()
+
+    to_drop = ['geometry', 'GLIMS_ID', 'WGMS_ID']
+    records = subset.drop(columns=to_drop).to_dict('records')
+
+    lookup = {}
+    for k, (dct, geom) in enumerate(zip(records, outlines)):
+        dct['coords'] = list(geom.exterior.coords)
+        dct['bbox'] = [(x0[k], y0[k]), (x1[k], y0[k]), (x1[k], y1[k]), (x0[k], y1[k]), (x0[k], y0[k])]
+        lookup[dct['glac_id']] = dct
+
+    return lookup
+
+@instrument.timed('id_query')
+def id_query(glims_id, subset, scale_fact=1.1, tolerance=SIMPLIFY_TOLERANCE):
     '''
     Query info from given ID
     :param id: glims ID to query
-    :param subset: subset of joined GeoDataFrame
+    :param subset: subset of joined GeoDataFrame, or its lookup from build_lookup
     :param scalefact: factor to scale bounding box by, default 10%
+    :param tolerance: outline simplification tolerance in degrees (not
+    applied to lookups, which build_lookup already simplified)
     '''
+    import numpy as np
+
+    if isinstance(subset, dict):
+        dct = dict(subset[glims_id])
+        dct['coords'] = list(dct['coords'])
+        dct['bbox'] = list(dct['bbox'])
+        return dct
+
     subs = subset[subset.glac_id == glims_id]
-    coords = list(zip(*np.asarray(subs.geometry.squeeze().exterior.coords.xy)))
+    coords = list(zip(*np.asarray(simplify_outlines(subs.geometry, tolerance).squeeze().exterior.coords.xy)))
     bbox = list(zip(*np.asarray(subs.envelope.scale(xfact=scale_fact, yfact=scale_fact).squeeze().exterior.coords.xy)))
     to_drop = ['geometry', 'GLIMS_ID', 'WGMS_ID']
     dct = dict(subs.drop(columns=to_drop).squeeze())
@@ -0,0 +1,192 @@
+import random
+import threading
+import time
+
+from GlaciersGEE import instrument
+
+# Token bucket budgets shared by every worker: requests per second and burst
+# size. EE requests cover getInfo and task status calls; Drive covers every
+# Drive API request (each request of a batch counts).
+
+RATES = {
+    'ee': (10., 20),
+    'ee.export': (5., 10),
+    'drive': (10., 20),
+}
+
+# Remote call kinds (as counted by instrument) and the budget they draw on
+BUCKETS = {
+    'ee.getInfo': 'ee',
+    'ee.task_status': 'ee',
+    'ee.export': 'ee.export',
+    'drive': 'drive',
+    'drive.batch': 'drive',
+    'drive.download': 'drive',
+}
+
+# Attempts per call and backoff bounds in seconds
+MAX_ATTEMPTS = 5
+BACKOFF = 1.
+MAX_BACKOFF = 60.
+
+# HTTP statuses and error messages of transient failures
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+RATE_LIMIT_REASONS = ('ratelimitexceeded', 'userratelimitexceeded', 'quota', 'too many')
+TRANSIENT_MESSAGES = ('internal error', 'service unavailable', 'backend error', 'deadline', 'timed out', 'try again')
+
+# ---------------------------------------------------------------------
+#
+# ---------------------------------------------------------------------
+
+
+class TokenBucket(object):
+    '''
+    Thread-safe token bucket refilled at `rate` tokens per second up to
+    `capacity`. acquire() blocks until enough tokens are available;
+    penalize() empties the bucket for a while so that every caller backs
+    off together after the service reports a rate limit.
+    '''
+
+    def __init__(self, rate, capacity, clock=time.monotonic, sleep=time.sleep):
+        self.rate = float(rate)
+        self.capacity = float(capacity)
+        self.clock = clock
+        self.sleep = sleep
+        self.tokens = float(capacity)
+        self.updated = clock()
+        self.blocked_until = 0.
+        self.waited = 0.
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self, n=1):
+        '''
+        Take `n` tokens, waiting for them if needed; more than `capacity`
+        tokens are taken in capacity-sized steps
+        :returns: seconds waited
+        '''
+        n = float(n)
+        waited = 0.
+        while n > self.capacity:
+            waited += self._take(self.capacity)
+            n -= self.capacity
+        return waited + self._take(n)
+
+    def _take(self, n):
+        waited = 0.
+        while True:
+            with self._lock:
+                now = self.clock()
+                self._refill(now)
+                if now >= self.blocked_until and self.tokens >= n:
+                    self.tokens -= n
+                    self.waited += waited
+                    return waited
+                delay = max(self.blocked_until - now, (n - self.tokens) / self.rate)
+            self.sleep(delay)
+            waited += delay
+
+    def penalize(self, seconds):
+        '''
+        Grant no tokens for the next `seconds`
+        '''
+        with self._lock:
+            now = self.clock()
+            self._refill(now)
+            self.tokens = 0.
+            self.blocked_until = max(self.blocked_until, now + seconds)
+
+
+_buckets = {}
+_buckets_lock = threading.Lock()
+
+
+def configure(**rates):
+    '''
+    Set the budget of some buckets, e.g. configure(drive=(5, 10)); existing
+    buckets are replaced.
+    '''
+    with _buckets_lock:
+        for name, (rate, capacity) in rates.items():
+            RATES[name] = (rate, capacity)
+            _buckets.pop(name, None)
+
+
+def bucket(kind):
+    '''
+    Shared bucket of a budget ('ee', 'ee.export', 'drive') or call kind
+    '''
+    name = BUCKETS.get(kind, kind)
+    with _buckets_lock:
+        b = _buckets.get(name)
+        if b is None:
+            b = _buckets[name] = TokenBucket(*RATES[name])
+        return b
+
+
+def _status(exc):
+    resp = getattr(exc, 'resp', None)
+    status = getattr(resp, 'status', None) or getattr(exc, 'status_code', None)
+    try:
+        return int(status)
+    except (TypeError, ValueError):
+        return None
+
+
+def is_rate_limited(exc):
+    '''
+    Whether an error reports a quota or rate limit; the request was
+    rejected, so retrying it is always safe
+    '''
+    if _status(exc) == 429:
+        return True
+    message = str(exc).lower()
+    compact = message.replace(' ', '')
+    return any(reason in message or reason in compact for reason in RATE_LIMIT_REASONS)
+
+
+def is_transient(exc):
+    '''
+    Whether an error is worth retrying: rate limits, server errors,
+    timeouts and dropped connections
+    '''
+    if is_rate_limited(exc):
+        return True
+    if _status(exc) in RETRY_STATUSES:
+        return True
+    if isinstance(exc, (ConnectionError, TimeoutError)) or type(exc).__name__ in ('timeout', 'ServerNotFoundError'):
+        return True
+    message = str(exc).lower()
+    return any(m in message for m in TRANSIENT_MESSAGES)
+
+
+def call(kind, fn, *args, n=1, idempotent=True, attempts=MAX_ATTEMPTS, **kwargs):
+    '''
+    Make a remote call within the shared budget of its kind, retrying
+    transient failures with exponential backoff and jitter.
+    :param kind: call kind, see BUCKETS; counted with instrument.count
+    :param n: tokens the call uses, e.g. the number of requests in a batch
+    :param idempotent: if False only rate limit errors, which mean the
+    request was not carried out, are retried
+    :param attempts: maximum number of attempts
+    '''
+    b = bucket(kind)
+    for attempt in range(1, attempts + 1):
+        b.acquire(n)
+        instrument.count(kind)
+        try:
+            return fn(*args, **kwargs)
+        except Exception as e:
+            retry = is_rate_limited(e) or (idempotent and is_transient(e))
+            if not retry or attempt == attempts:
+                raise
+            delay = min(MAX_BACKOFF, BACKOFF * 2 ** (attempt - 1)) * (0.5 + random.random() / 2)
+            if is_rate_limited(e):
+                # every worker drawing on this budget waits, not only this one
+                b.penalize(delay)
+            print('%s call failed (%r), attempt %d of %d, retrying in %.1fs' % (kind, e, attempt, attempts, delay))
+            b.sleep(delay)
+
@@ -0,0 +1,93 @@
+import json
+import sqlite3
+import threading
+import time
+
+# Earth Engine regions of the glaciers, serialised once as GeoJSON, and the
+# bounds Earth Engine computed for them, kept across runs
+
+REGIONS = 'regions.db'
+
+# ---------------------------------------------------------------------
+#
+# ---------------------------------------------------------------------
+
+
+def region_geojson(bbox):
+    '''
+    GeoJSON polygon of a bbox ring as returned by id_query, ready for
+    ee.Geometry; geodesic like ee.Geometry.Polygon without a projection
+    '''
+    return {
+        'type': 'Polygon',
+        'coordinates': [[[float(x), float(y)] for (x, y) in bbox]],
+        'geodesic': True,
+    }
+
+
+class RegionCache(object):
+    '''
+    Cache (SQLite) of each glacier's serialised region and its bounds as
+    returned by region.bounds().getInfo(). Entries are kept in memory once
+    read, so exports and retries of a glacier reuse them, and in the
+    database for later runs. An entry is only used while the region it was
+    computed for is unchanged.
+    '''
+
+    def __init__(self, fp=REGIONS):
+        self.fp = fp
+        self._lock = threading.Lock()
+        self._memo = {}
+        self.conn = sqlite3.connect(fp, check_same_thread=False)
+        if fp != ':memory:':
+            self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS regions ('
+            'glac_id TEXT PRIMARY KEY, region TEXT NOT NULL, bounds TEXT NOT NULL, updated REAL)'
+        )
+        self.conn.commit()
+
+    def get(self, glac_id, region):
+        '''
+        Cached bounds of a glacier's region, or None if there are none for
+        this region.
+        '''
+        serialized = json.dumps(region, sort_keys=True)
+        with self._lock:
+            entry = self._memo.get(str(glac_id))
+            if entry is None:
+                row = self.conn.execute(
+                    'SELECT region, bounds FROM regions WHERE glac_id = ?', (str(glac_id),)
+                ).fetchone()
+                if row is None:
+                    return None
+                entry = self._memo[str(glac_id)] = (row[0], json.loads(row[1]))
+        return entry[1] if entry[0] == serialized else None
+
+    def put(self, glac_id, region, bounds):
+        '''
+        Store the bounds of a glacier's region.
+        '''
+        serialized = json.dumps(region, sort_keys=True)
+        with self._lock:
+            self._memo[str(glac_id)] = (serialized, bounds)
+            self.conn.execute(
+                'INSERT OR REPLACE INTO regions VALUES (?, ?, ?, ?)',
+                (str(glac_id), serialized, json.dumps(bounds), time.time())
+            )
+            self.conn.commit()
+
+    def bounds(self, glac_id, region, compute):
+        '''
+        Bounds of a glacier's region from the cache, or from `compute()`
+        (then cached) if there are none.
+        '''
+        bounds = self.get(glac_id, region)
+        if bounds is None:
+            bounds = compute()
+            self.put(glac_id, region, bounds)
+        return bounds
+
+    def close(self):
+        with self._lock:
+            self.conn.close()
@@ -0,0 +1,226 @@
+import ast
+import csv
+import json
+import os
+import queue
+import sqlite3
+import threading
+import time
+from urllib.request import pathname2url
+
+# Glacier metadata database, and the csv it can be exported to
+
+GLACIER_STORE = 'glacierInfo.db'
+GLACIER_CSV = 'glacierInfo.csv'
+
+# Records committed per transaction, and seconds a partial batch may wait
+
+BATCH_SIZE = 100
+FLUSH_INTERVAL = 5.
+
+_STOP = object()
+
+# ---------------------------------------------------------------------
+#
+# ---------------------------------------------------------------------
+
+
+def _to_json(value):
+    '''
+    json default for numpy scalars and other values in glacier records
+    '''
+    if hasattr(value, 'item'):
+        return value.item()
+    return str(value)
+
+
+def dumps_record(record):
+    return json.dumps(record, default=_to_json)
+
+
+def _from_csv(value):
+    '''
+    Value of a csv cell written by append_csv: lists and dictionaries were
+    written as their repr
+    '''
+    if value[:1] in ('[', '{'):
+        try:
+            return ast.literal_eval(value)
+        except (ValueError, SyntaxError):
+            pass
+    return value
+
+
+def read_csv_records(fp=GLACIER_CSV):
+    '''
+    Glacier records of a csv written by append_csv or MetadataStore.to_csv
+    '''
+    with open(fp, newline='') as f:
+        for row in csv.DictReader(f):
+            if row.get('glac_id'):
+                yield {k: _from_csv(v) for (k, v) in row.items() if k is not None}
+
+
+def read_records(fp=GLACIER_STORE, import_csv=GLACIER_CSV):
+    '''
+    Glacier records of earlier runs by glac_id, read without writing
+    anything: from the store if it exists, otherwise from the csv
+    '''
+    if fp and os.path.exists(fp):
+        # immutable creates no lock or shared-memory files, but ignores a
+        # write-ahead log left by an interrupted run, which read-only mode reads
+        mode = 'mode=ro' if os.path.exists(fp + '-wal') else 'immutable=1'
+        conn = sqlite3.connect('file:%s?%s' % (pathname2url(os.path.abspath(fp)), mode), uri=True)
+        try:
+            return {k: json.loads(r) for (k, r) in conn.execute('SELECT glac_id, record FROM glaciers')}
+        finally:
+            conn.close()
+    if import_csv and os.path.exists(import_csv):
+        return {str(r['glac_id']): r for r in read_csv_records(import_csv)}
+    return {}
+
+
+def append_csv(record, fp=GLACIER_CSV):
+    '''
+    Append one glacier record to a csv, writing the header if the file
+    is new or empty.
+    '''
+    with open(fp, 'a', newline='') as f:
+        w = csv.DictWriter(f, list(record.keys()))
+        if f.tell() == 0:
+            w.writeheader()
+        w.writerow(record)
+
+
+class MetadataStore(object):
+    '''
+    Glacier metadata store (SQLite) with a single writer thread. Any number
+    of workers put() records; the writer commits them in batches of up to
+    `batch_size`, or after `flush_interval` seconds, and calls
+    `on_commit(glac_ids)` after each commit. Records are keyed by glac_id;
+    a later record for the same glacier replaces the earlier one. A new
+    store imports the records of `import_csv` (glacierInfo.csv appended to
+    by earlier runs), if it exists.
+    '''
+
+    def __init__(self, fp=GLACIER_STORE, batch_size=BATCH_SIZE, flush_interval=FLUSH_INTERVAL, on_commit=None,
+                 import_csv=GLACIER_CSV):
+        self.fp = fp
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.on_commit = on_commit
+        self.committed = 0
+        self.queue = queue.Queue()
+        self._local = threading.local()
+
+        conn = sqlite3.connect(fp)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute(
+            'CREATE TABLE IF NOT EXISTS glaciers ('
+            'glac_id TEXT PRIMARY KEY, record TEXT NOT NULL, updated REAL)'
+        )
+        conn.commit()
+        empty = conn.execute('SELECT COUNT(*) FROM glaciers').fetchone()[0] == 0
+        if empty and import_csv and os.path.exists(import_csv):
+            rows = [(str(r['glac_id']), dumps_record(r), time.time()) for r in read_csv_records(import_csv)]
+            conn.executemany('INSERT OR REPLACE INTO glaciers VALUES (?, ?, ?)', rows)
+            conn.commit()
+            print('Imported %d glacier records from %s' % (len(rows), import_csv))
+        conn.close()
+
+        self.writer = threading.Thread(target=self._write_loop, name='MetadataStore-writer')
+        self.writer.daemon = True
+        self.writer.start()
+
+    def put(self, record):
+        '''
+        Queue a glacier record (dictionary with a glac_id) for writing.
+        '''
+        self.queue.put((str(record['glac_id']), dumps_record(record)))
+
+    def flush(self):
+        '''
+        Block until every queued record has been committed.
+        '''
+        self.queue.join()
+
+    def close(self):
+        '''
+        Commit the queued records and stop the writer.
+        '''
+        self.queue.put(_STOP)
+        self.writer.join()
+
+    def _write_loop(self):
+        conn = sqlite3.connect(self.fp)
+        stop = False
+        while not stop:
+            batch = [self.queue.get()]
+            deadline = time.time() + self.flush_interval
+            while len(batch) < self.batch_size and batch[-1] is not _STOP:
+                try:
+                    batch.append(self.queue.get(timeout=max(deadline - time.time(), 0)))
+                except queue.Empty:
+                    break
+
+            stop = batch[-1] is _STOP
+            rows = [(k, r, time.time()) for (k, r) in (b for b in batch if b is not _STOP)]
+            try:
+                if rows:
+                    conn.executemany('INSERT OR REPLACE INTO glaciers VALUES (?, ?, ?)', rows)
+                    conn.commit()
+                    self.committed += len(rows)
+                    if self.on_commit is not None:
+                        self.on_commit([k for (k, _, _) in rows])
+            except Exception as e:
+                print('Failed to store %d glacier records: %r' % (len(rows), e))
+            finally:
+                for _ in batch:
+                    self.queue.task_done()
+        conn.close()
+
+    def _reader(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._local.conn = sqlite3.connect(self.fp)
+        return conn
+
+    def get(self, glac_id):
+        '''
+        Committed record of a glacier, or None.
+        '''
+        row = self._reader().execute(
+            'SELECT record FROM glaciers WHERE glac_id = ?', (str(glac_id),)
+        ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def __contains__(self, glac_id):
+        return self.get(glac_id) is not None
+
+    def records(self):
+        '''
+        Iterate over every committed record.
+        '''
+        for (record,) in self._reader().execute('SELECT record FROM glaciers ORDER BY rowid'):
+            yield json.loads(record)
+
+    def to_csv(self, fp=GLACIER_CSV):
+        '''
+        Export every committed record to a csv, with one header covering
+        the fields of all records. Nothing is written if there are none.
+        :returns: the filepath, or None if there were no records
+        '''
+        fields = []
+        for record in self.records():
+            fields.extend(k for k in record if k not in fields)
+        if not fields:
+            return None
+
+        tmp = fp + '.tmp'
+        with open(tmp, 'w', newline='') as f:
+            w = csv.DictWriter(f, fields)
+            w.writeheader()
+            for record in self.records():
+                w.writerow(record)
+        os.replace(tmp, fp)
+        return fp
@@ -0,0 +1,302 @@
+import json
+import os
+import threading
+import time
+
+from GlaciersGEE import ratelimit
+
+# Earth Engine task states; UNKNOWN is a task Earth Engine no longer lists
+
+ACTIVE_STATES = ('READY', 'RUNNING', 'CANCEL_REQUESTED')
+RETRY_STATES = ('FAILED', 'CANCELLED', 'UNKNOWN')
+DONE_STATE = 'COMPLETED'
+
+# Earth Engine operation states and the task states they stand for
+
+OPERATION_STATES = {
+    'PENDING': 'READY',
+    'RUNNING': 'RUNNING',
+    'CANCELLING': 'CANCEL_REQUESTED',
+    'SUCCEEDED': 'COMPLETED',
+    'FAILED': 'FAILED',
+    'CANCELLED': 'CANCELLED',
+}
+
+# Scheduler defaults: exports kept in flight, seconds between status polls
+# (doubling up to the max while nothing changes) and submissions per export.
+
+MAX_RUNNING = 20
+POLL_INTERVAL = 10
+MAX_POLL_INTERVAL = 120
+MAX_ATTEMPTS = 3
+
+TASK_STATE = 'tasks.json'
+
+# ---------------------------------------------------------------------
+#
+# ---------------------------------------------------------------------
+
+
+def operation_status(operation):
+    '''
+    Task status dictionary (id, state, error_message) of an Earth Engine
+    operation, as ee.data.getTaskStatus returned them
+    '''
+    metadata = operation.get('metadata', {})
+    status = {
+        'id': operation['name'].rsplit('/', 1)[-1],
+        'state': OPERATION_STATES.get(metadata.get('state'), 'UNKNOWN'),
+    }
+    if operation.get('done') and 'error' in operation:
+        status['error_message'] = operation['error'].get('message')
+    return status
+
+
+def match_operations(task_ids, operations):
+    '''
+    Status of each task in a listing of operations, in task_ids order;
+    tasks that are not listed are UNKNOWN
+    '''
+    wanted = set(task_ids)
+    found = {}
+    for operation in operations:
+        status = operation_status(operation)
+        if status['id'] in wanted:
+            found[status['id']] = status
+    return [found.get(task_id, {'id': task_id, 'state': 'UNKNOWN'}) for task_id in task_ids]
+
+
+def ee_task_status(task_ids):
+    '''
+    Status of many Earth Engine tasks from one paginated listing of the
+    user's operations; ee.data.getTaskStatus is deprecated and sends one
+    request per task.
+    '''
+    import ee
+    return match_operations(task_ids, ee.data.listOperations())
+
+
+class ExportScheduler(object):
+    '''
+    Keeps at most `max_running` Earth Engine exports in flight. Exports are
+    queued with submit() and started as slots free up; the status of every
+    task is polled in one listing, with backoff; failed, cancelled or lost
+    (UNKNOWN) exports are resubmitted up to `max_attempts` times, and the IDs
+    and states of started tasks are persisted to `state_fp` so completed
+    exports are not resubmitted by later runs.
+    `listener(key, state)` is called when an export is queued ('QUEUED'),
+    once its task has been started ('READY'), and when it completes or
+    fails for good.
+    '''
+
+    def __init__(
+        self,
+        max_running=MAX_RUNNING,
+        poll_interval=POLL_INTERVAL,
+        max_poll_interval=MAX_POLL_INTERVAL,
+        max_attempts=MAX_ATTEMPTS,
+        state_fp=TASK_STATE,
+        status_fn=ee_task_status,
+        sleep=time.sleep,
+        clock=time.time,
+        listener=None):
+
+        self.max_running = max_running
+        self.poll_interval = poll_interval
+        self.max_poll_interval = max_poll_interval
+        self.max_attempts = max_attempts
+        self.state_fp = state_fp
+        self.status_fn = status_fn
+        self.sleep = sleep
+        self.clock = clock
+        self.listener = listener
+
+        self.tasks = {}                 # key -> {'id', 'state', 'attempts', 'updated'}
+        self.pending = []               # keys waiting for a free slot
+        self.active = set()             # keys of exports in flight
+        self.factories = {}             # key -> function returning an unstarted task
+        self.started = clock()
+        self.completed = 0
+        self.last_poll = 0
+        self.interval = poll_interval
+        self._lock = threading.RLock()
+        self.load()
+
+    def load(self):
+        '''
+        Load persisted task states, if present.
+        '''
+        if self.state_fp is None or not os.path.exists(self.state_fp):
+            return
+        try:
+            with open(self.state_fp) as fh:
+                tasks = json.load(fh)
+        except ValueError:
+            tasks = {}
+        # exports never started are queued again by whoever submits them
+        self.tasks = {k: v for (k, v) in tasks.items() if v.get('id')}
+        self.active = {k for (k, v) in self.tasks.items() if v['state'] in ACTIVE_STATES and v.get('id')}
+
+    def save(self):
+        if self.state_fp is None:
+            return
+        tmp = self.state_fp + '.tmp'
+        with open(tmp, 'w') as fh:
+            json.dump({k: v for (k, v) in self.tasks.items() if v.get('id')}, fh)
+        os.replace(tmp, self.state_fp)
+
+    def running(self):
+        return list(self.active)
+
+    def submit(self, key, make_task, again=False):
+        '''
+        Queue an export. Exports already completed, queued, or still active
+        from a previous run are not submitted again.
+        :param key: unique name of the export, e.g. glacier id/file name
+        :param make_task: function returning an unstarted ee.batch task
+        :param again: submit an export completed by a previous run again
+        :returns: False if the export was skipped
+        '''
+        with self._lock:
+            state = self.tasks.get(key, {}).get('state')
+            if key in self.factories:
+                return False
+            if state == DONE_STATE and not again:
+                self._notify(key, DONE_STATE)
+                return False
+            self.factories[key] = make_task
+            if key in self.active:
+                # in flight from a previous run; poll() tracks it and can
+                # resubmit it with this factory if it fails
+                self._notify(key, 'READY')
+                return False
+            self.tasks[key] = {'id': None, 'state': 'QUEUED', 'attempts': 0, 'updated': self.clock()}
+            self.pending.append(key)
+            self._notify(key, 'QUEUED')
+        self.pump()
+        return True
+
+    def pump(self):
+        '''
+        Poll if the poll interval has elapsed, then start queued exports
+        while there are free slots.
+        '''
+        with self._lock:
+            if self.active and self.clock() - self.last_poll >= self.interval:
+                self.poll()
+            free = self.max_running - len(self.active)
+            started = 0
+            while started < free and self.pending:
+                self._start(self.pending.pop(0))
+                started += 1
+            if started:
+                self.save()
+
+    def _start(self, key):
+        entry = self.tasks[key]
+        try:
+            task = self.factories[key]()
+            # not idempotent: only retried here if rejected by a rate limit
+            ratelimit.call('ee.export', task.start, idempotent=False)
+        except Exception as e:
+            # the export is requeued or reported as failed; the error is not
+            # raised to whichever submit() or wait() happened to pump
+            entry.update({'attempts': entry['attempts'] + 1, 'error': repr(e), 'updated': self.clock()})
+            if entry['attempts'] < self.max_attempts:
+                print('Export %s failed to start (%r), requeued' % (key, e))
+                self.pending.append(key)
+            else:
+                print('Export %s failed to start (%r)' % (key, e))
+                entry['state'] = 'FAILED'
+                self.factories.pop(key, None)
+                self._notify(key, 'FAILED')
+            return
+        entry.update({'id': task.id, 'state': 'READY', 'attempts': entry['attempts'] + 1, 'updated': self.clock()})
+        self.active.add(key)
+        self._notify(key, 'READY')
+
+    def poll(self):
+        '''
+        Update the state of every active export with one status call,
+        resubmitting failed, cancelled or lost exports.
+        :returns: number of exports whose state changed
+        '''
+        with self._lock:
+            self.last_poll = self.clock()
+            ids = {self.tasks[k]['id']: k for k in self.running()}
+            statuses = ratelimit.call('ee.task_status', self.status_fn, list(ids))
+
+            changed = 0
+            for status in statuses:
+                key = ids.get(status.get('id'))
+                if key is None:
+                    continue
+                entry = self.tasks[key]
+                state = status.get('state', entry['state'])
+                if state == entry['state']:
+                    continue
+                changed += 1
+                entry['state'] = state
+                entry['updated'] = self.clock()
+                if state not in ACTIVE_STATES:
+                    self.active.discard(key)
+                if state == DONE_STATE:
+                    self.completed += 1
+                    self.factories.pop(key, None)
+                    self._notify(key, state)
+                elif state in RETRY_STATES:
+                    entry['error'] = status.get('error_message')
+                    if entry['attempts'] < self.max_attempts and key in self.factories:
+                        print('Resubmitting export', key, '(%s)' % state)
+                        self.pending.append(key)
+                        entry['state'] = 'QUEUED'
+                        self._notify(key, 'QUEUED')
+                    else:
+                        self.factories.pop(key, None)
+                        self._notify(key, state)
+
+            # back off while nothing changes
+            self.interval = self.poll_interval if changed else min(self.interval * 2, self.max_poll_interval)
+            self.save()
+            return changed
+
+    def _notify(self, key, state):
+        if self.listener is not None:
+            self.listener(key, state)
+
+    def wait(self, timeout=None):
+        '''
+        Block until every queued export has finished or failed for good.
+        :param timeout: seconds to wait at most
+        :returns: True if all exports finished
+        '''
+        start = self.clock()
+        while True:
+            with self._lock:
+                self.pump()
+                if not self.pending and not self.active:
+                    return True
+            if timeout is not None and self.clock() - start > timeout:
+                return False
+            self.sleep(self.interval)
+
+    def failed(self):
+        '''
+        Exports that failed after all attempts.
+        '''
+        return {k: v.get('error') for (k, v) in self.tasks.items() if v['state'] in RETRY_STATES}
+
+    def stats(self):
+        '''
+        Throughput numbers of this scheduler.
+        '''
+        with self._lock:
+            minutes = max(self.clock() - self.started, 1e-9) / 60.
+            return {
+                'completed': self.completed,
+                'running': len(self.active),
+                'queued': len(self.pending),
+                'queue_depth': len(self.pending) + len(self.active),
+                'failed': len(self.failed()),
+                'tasks_per_min': self.completed / minutes
+            }
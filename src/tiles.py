@@ -0,0 +1,147 @@
+import math
+import os
+import re
+from collections import defaultdict
+
+# Regions over MAX_PIXELS pixels at the export scale are exported as a grid
+# of tiles, each of at most MAX_PIXELS pixels
+
+MAX_PIXELS = 25e6
+
+# Metres per degree of latitude, and of longitude at the equator
+M_PER_DEG_LAT = 110574.
+M_PER_DEG_LON = 111320.
+
+# Tile exports are named <export name>_tile_r<row>c<col>; Earth Engine itself
+# splits large files into <name>-<y offset>-<x offset>
+TILE_SUFFIX = '_tile_r%dc%d'
+_TILE_NAME = re.compile(r'^(?P<base>.+?)(?:_tile_r(?P<row>\d+)c(?P<col>\d+)|-(?P<y>\d{10})-(?P<x>\d{10}))\.tiff?$', re.IGNORECASE)
+
+# ---------------------------------------------------------------------
+#
+# ---------------------------------------------------------------------
+
+
+def region_bounds(bounds):
+    '''
+    (minx, miny, maxx, maxy) of region bounds coordinates, as returned by
+    region.bounds().getInfo()['coordinates']
+    '''
+    ring = bounds[0]
+    xs = [p[0] for p in ring]
+    ys = [p[1] for p in ring]
+    return min(xs), min(ys), max(xs), max(ys)
+
+
+def region_pixels(bounds, scale=30):
+    '''
+    Estimated pixel count of an export of the region at `scale` metres
+    :returns: tuple of (pixels across, pixels down)
+    '''
+    x0, y0, x1, y1 = region_bounds(bounds)
+    lat = math.radians((y0 + y1) / 2)
+    width = (x1 - x0) * M_PER_DEG_LON * math.cos(lat) / scale
+    height = (y1 - y0) * M_PER_DEG_LAT / scale
+    return width, height
+
+
+def tile_grid(bounds, scale=30, max_pixels=MAX_PIXELS):
+    '''
+    Split region bounds into a grid of tiles of at most `max_pixels` pixels.
+    :returns: list of (row, col, tile bounds coordinates); a single tile
+    (0, 0, bounds) if the region is within the budget
+    '''
+    width, height = region_pixels(bounds, scale)
+    if max_pixels is None or width * height <= max_pixels:
+        return [(0, 0, bounds)]
+
+    side = math.sqrt(max_pixels)
+    cols = int(math.ceil(width / side))
+    rows = int(math.ceil(height / side))
+    x0, y0, x1, y1 = region_bounds(bounds)
+    dx, dy = (x1 - x0) / cols, (y1 - y0) / rows
+
+    tiles = []
+    for r in range(rows):
+        # row 0 is the northernmost, as in the rasters
+        top = y1 - r * dy
+        bottom = y1 - (r + 1) * dy if r < rows - 1 else y0
+        for c in range(cols):
+            left = x0 + c * dx
+            right = x0 + (c + 1) * dx if c < cols - 1 else x1
+            ring = [[left, bottom], [right, bottom], [right, top], [left, top], [left, bottom]]
+            tiles.append((r, c, [ring]))
+    return tiles
+
+
+def export_name(file_name):
+    '''
+    Name of the export a drive file was written by: the file name without
+    its extension or the shard suffix Earth Engine adds to large files
+    '''
+    match = _TILE_NAME.match(file_name)
+    if match and match.group('y') is not None:
+        return match.group('base')
+    return os.path.splitext(file_name)[0]
+
+
+def is_tile(name):
+    '''
+    Whether a file name is a tile of a larger export
+    '''
+    return _TILE_NAME.match(name) is not None
+
+
+def group_tiles(folder):
+    '''
+    Tile files of a folder grouped by the export they belong to
+    :returns: dictionary of export name -> sorted list of tile file names
+    '''
+    groups = defaultdict(list)
+    for name in sorted(os.listdir(folder)):
+        match = _TILE_NAME.match(name)
+        if match:
+            groups[match.group('base')].append(name)
+    return dict(groups)
+
+
+def mosaic_tiles(folder, expected=None, remove=False):
+    '''
+    Reassemble the downloaded tiles of every tiled export in a folder into
+    <export name>.tif. Needs rasterio.
+    :param expected: dictionary of export name -> number of tiles (e.g. the
+    'tiles' step of the manifest); exports with missing tiles are skipped
+    :param remove: delete the tiles once their mosaic is written
+    :returns: dictionary of export name -> mosaic filepath, or None if skipped
+    '''
+    import rasterio
+    from rasterio.merge import merge
+
+    results = {}
+    for base, names in group_tiles(folder).items():
+        if expected is not None and base in expected and len(names) < expected[base]:
+            print('%s: %d of %d tiles downloaded, not mosaicked' % (base, len(names), expected[base]))
+            results[base] = None
+            continue
+
+        sources = [rasterio.open(os.path.join(folder, name)) for name in names]
+        try:
+            data, transform = merge(sources)
+            profile = sources[0].profile.copy()
+            descriptions = sources[0].descriptions
+        finally:
+            for src in sources:
+                src.close()
+        profile.update(height=data.shape[1], width=data.shape[2], transform=transform)
+
+        out = os.path.join(folder, base + '.tif')
+        tmp = out + '.tmp'
+        with rasterio.open(tmp, 'w', **dict(profile, driver='GTiff')) as dst:
+            dst.write(data)
+            dst.descriptions = descriptions
+        os.replace(tmp, out)
+        if remove:
+            for name in names:
+                os.remove(os.path.join(folder, name))
+        results[base] = out
+    return results
@@ -0,0 +1,46 @@
+
+import numpy as np
+import pytest
+
+from GlaciersGEE.cluster import cut_glacier
+
+rasterio = pytest.importorskip('rasterio')
+
+
+def write_raster(fp, crs, transform, shape):
+    data = np.arange(shape[0] * shape[1], dtype='uint16').reshape((1,) + shape)
+    profile = dict(driver='GTiff', width=shape[1], height=shape[0], count=1, dtype='uint16',
+                   crs=crs, transform=transform)
+    with rasterio.open(fp, 'w', **profile) as dst:
+        dst.write(data)
+
+
+def test_cut_glacier_from_projected_raster(tmp_path):
+    from rasterio.transform import from_origin
+    from rasterio.warp import transform_bounds
+
+    # a UTM 32N cluster raster, as Landsat exports are, 30 m pixels
+    src_fp = str(tmp_path / 'cluster.tif')
+    write_raster(src_fp, 'EPSG:32632', from_origin(500000, 5100000, 30, 30), (200, 200))
+
+    # a glacier's lon/lat bounds inside the raster
+    bounds = transform_bounds('EPSG:32632', 'EPSG:4326', 501500, 5095500, 503000, 5097000)
+    dst_fp = cut_glacier(src_fp, bounds, str(tmp_path / 'glacier.tif'))
+
+    with rasterio.open(dst_fp) as dst:
+        assert dst.crs == rasterio.crs.CRS.from_epsg(32632)
+        assert 45 <= dst.width <= 55 and 45 <= dst.height <= 55
+        left, bottom, right, top = dst.bounds
+        assert abs(left - 501500) <= 60 and abs(top - 5097000) <= 60
+
+
+def test_cut_glacier_from_lonlat_raster(tmp_path):
+    from rasterio.transform import from_origin
+
+    src_fp = str(tmp_path / 'cluster.tif')
+    write_raster(src_fp, 'EPSG:4326', from_origin(10, 47, 0.01, 0.01), (100, 100))
+
+    dst_fp = cut_glacier(src_fp, (10.2, 46.5, 10.3, 46.6), str(tmp_path / 'glacier.tif'))
+    with rasterio.open(dst_fp) as dst:
+        assert (dst.width, dst.height) == (10, 10)
+        assert dst.read(1)[0, 0] == 40 * 100 + 20
@@ -0,0 +1,87 @@
+
+import json
+
+from GlaciersGEE.drive import FolderIndex, FOLDER_MIMETYPE, download_file
+from GlaciersGEE.fakes import FakeDrive
+
+
+def make_tree(drive, root='glaciers', glaciers=('G1', 'G2')):
+    root_id = drive.add_file(root, FOLDER_MIMETYPE)
+    drive.add_file('elsewhere', FOLDER_MIMETYPE)
+    return root_id, {name: drive.add_file(name, FOLDER_MIMETYPE, root_id) for name in glaciers}
+
+
+def test_folder_index_is_recrawled_once_stale(tmp_path):
+    drive = FakeDrive()
+    root_id, ids = make_tree(drive)
+    index = FolderIndex(fp=str(tmp_path / 'index.json'), ttl=60)
+
+    index.ensure(drive)
+    crawls = drive.recorder.count('execute')
+    assert index.children(root_id) == ids
+    assert index.find('elsewhere') is None
+
+    # fresh: served from the index
+    index.ensure(drive)
+    assert drive.recorder.count('execute') == crawls
+
+    # stale: crawled again, picking up the new folder
+    new_id = drive.add_file('G3', FOLDER_MIMETYPE, root_id)
+    index.warmed -= 61
+    index.ensure(drive)
+    assert drive.recorder.count('execute') > crawls
+    assert index.find('G3', parent=root_id) == new_id
+
+
+def test_folder_index_batches_saves(tmp_path):
+    fp = str(tmp_path / 'index.json')
+    index = FolderIndex(fp=fp, save_every=3)
+    index.save()
+
+    index.add('G1', 'id1', 'root')
+    index.add('G2', 'id2', 'root')
+    with open(fp) as fh:
+        assert json.load(fh)['folders'] == {}
+
+    # the third addition writes the batch, flush() writes the rest
+    index.add('G3', 'id3', 'root')
+    assert len(FolderIndex(fp=fp).folders) == 3
+    index.add('G4', 'id4', 'root')
+    index.flush()
+    assert FolderIndex(fp=fp).children('root') == {'G1': 'id1', 'G2': 'id2', 'G3': 'id3', 'G4': 'id4'}
+
+    # an index saved for another root folder is not loaded
+    assert FolderIndex(fp=fp, root='other').folders == {}
+
+
+def test_download_resumes_from_partial_file(tmp_path):
+    drive = FakeDrive()
+    content = bytes(range(256)) * 40
+    file_id = drive.add_file('scene.tif', 'image/tiff', content=content)
+    dst = str(tmp_path / 'scene.tif')
+
+    # an interrupted download left its first 3000 bytes
+    with open(dst + '.part', 'wb') as fh:
+        fh.write(content[:3000])
+
+    download_file(drive, dst, file_id, size=len(content), chunk_size=1000)
+    with open(dst, 'rb') as fh:
+        assert fh.read() == content
+    assert not (tmp_path / 'scene.tif.part').exists()
+    # only the missing bytes were requested: 3000-10239 in 1000 byte ranges
+    assert drive.recorder.count('download') == 8
+
+    # a complete file is not downloaded again
+    download_file(drive, dst, file_id, size=len(content), chunk_size=1000)
+    assert drive.recorder.count('download') == 8
+
+
+def test_download_of_unknown_size(tmp_path):
+    drive = FakeDrive()
+    content = b'x' * 2500
+    file_id = drive.add_file('scene.tif', 'image/tiff', content=content)
+    dst = str(tmp_path / 'scene.tif')
+
+    download_file(drive, dst, file_id, chunk_size=1000)
+    with open(dst, 'rb') as fh:
+        assert fh.read() == content
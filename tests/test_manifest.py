@@ -0,0 +1,62 @@
+
+from GlaciersGEE.manifest import Manifest, DONE, QUEUED, STARTED, FINISHED, FAILED
+
+
+def test_steps_persist_across_reopening(tmp_path):
+    fp = str(tmp_path / 'manifest.db')
+    manifest = Manifest(fp)
+    manifest.mark('G1', 'folder', value='folder-id')
+    manifest.mark('G1', 'csv')
+    manifest.close()
+
+    manifest = Manifest(fp)
+    assert manifest.get('G1', 'folder') == 'folder-id'
+    assert manifest.state('G1', 'csv') == DONE
+    assert manifest.state('G1', 'metadata') is None
+    assert not manifest.done('G2', 'csv')
+    manifest.close()
+
+
+def test_export_states_follow_the_scheduler():
+    manifest = Manifest(':memory:')
+    listen = manifest.export_listener
+
+    listen('G1/a', 'QUEUED')
+    assert manifest.state('G1', 'export', 'a') == QUEUED
+    assert not manifest.done('G1', 'export', 'a')
+
+    listen('G1/a', 'READY')
+    assert manifest.state('G1', 'export', 'a') == STARTED
+    assert manifest.done('G1', 'export', 'a')
+
+    listen('G1/b', 'QUEUED')
+    listen('G1/b', 'UNKNOWN')
+    assert manifest.state('G1', 'export', 'b') == FAILED
+
+    # resubmitted, then finished
+    listen('G1/b', 'QUEUED')
+    listen('G1/b', 'READY')
+    listen('G1/b', 'COMPLETED')
+    assert manifest.items('G1', 'export') == {'a': STARTED, 'b': FINISHED}
+    manifest.close()
+
+
+def test_glacier_is_complete_once_every_export_finished():
+    manifest = Manifest(':memory:')
+    for name in ('a', 'b'):
+        manifest.export_listener('G1/' + name, 'QUEUED')
+        manifest.export_listener('G1/' + name, 'READY')
+
+    # exports finishing before every export was submitted do not complete it
+    manifest.export_listener('G1/a', 'COMPLETED')
+    assert not manifest.glacier_complete('G1')
+
+    manifest.mark('G1', 'submitted')
+    assert not manifest.finish_glacier('G1')
+    manifest.export_listener('G1/b', 'COMPLETED')
+    assert manifest.glacier_complete('G1')
+
+    # a failed export makes it incomplete again, so a rerun retries it
+    manifest.export_listener('G1/b', 'FAILED')
+    assert not manifest.glacier_complete('G1')
+    manifest.close()
@@ -0,0 +1,77 @@
+
+import functools
+
+import pytest
+
+gpd = pytest.importorskip('geopandas')
+
+from GlaciersGEE import drive, fakes, ratelimit
+from GlaciersGEE import main as pipeline
+
+EE_PARAMS = {'gmted': False, 'begDate': '2014-01-01', 'endDate': '2016-01-01'}
+
+
+def joined_frame(n):
+    from shapely.geometry import box
+
+    ids = ['G%06dE%05dN' % (k, k) for k in range(n)]
+    return gpd.GeoDataFrame(
+        {'glac_id': ids, 'glac_name': ids, 'GLIMS_ID': ids, 'WGMS_ID': range(n)},
+        geometry=[box(7 + k, 46, 7.02 + k, 46.02) for k in range(n)], crs='epsg:4326')
+
+
+@pytest.fixture
+def fake_services(tmp_path, monkeypatch):
+    '''
+    Earth Engine and Drive fakes behind run_pipeline, run in tmp_path
+    '''
+    fake_ee = fakes.FakeEE(scenes_per_year=4)
+    fake_drive = fakes.FakeDrive()
+    restore = fakes.install_fake_ee(fake_ee)
+    joined = joined_frame(4)
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(drive, '_folder_index', None)
+    monkeypatch.setattr(pipeline, 'start_service', lambda: fake_drive)
+    monkeypatch.setattr(pipeline, 'prep_joined', lambda ids, datadir: joined[joined.glac_id.isin(ids)])
+    monkeypatch.setattr(pipeline, 'ExportScheduler', functools.partial(
+        pipeline.ExportScheduler, poll_interval=0.01, max_poll_interval=0.02))
+    rates = dict(ratelimit.RATES)
+    yield fake_ee, fake_drive, list(joined.glac_id)
+    ratelimit.configure(**rates)
+    restore()
+
+
+def run(ids, **kwargs):
+    return pipeline.run_pipeline(
+        ids, '', 'glaciers', ee_params=EE_PARAMS, rates={name: (1e6, 1e6) for name in ratelimit.RATES}, **kwargs)
+
+
+def test_pool_runs_every_glacier_once(fake_services):
+    fake_ee, fake_drive, ids = fake_services
+
+    results = run(ids + ['MISSING'], pool=3)
+    assert sorted(k for (k, v) in results.items() if v is None) == sorted(ids)
+    assert isinstance(results['MISSING'], Exception)
+
+    # one folder and one export per scene for each glacier, none twice
+    folders = [f['name'] for f in fake_drive.files_db.values() if f['mimeType'] == drive.FOLDER_MIMETYPE]
+    assert sorted(folders) == sorted(['glaciers'] + ids)
+    names = [(t.config['folder'], t.config['fileNamePrefix']) for t in fake_ee.tasks.tasks.values()]
+    assert len(names) == len(set(names))
+    assert set(folder for (folder, _) in names) == set(ids)
+
+
+def test_pool_exports_what_a_serial_run_exports(fake_services, tmp_path, monkeypatch):
+    fake_ee, _, ids = fake_services
+
+    run(ids, pool=3)
+    pooled = sorted((t.config['folder'], t.config['fileNamePrefix']) for t in fake_ee.tasks.tasks.values())
+
+    fake_ee.tasks.tasks.clear()
+    serial_dir = tmp_path / 'serial'
+    serial_dir.mkdir()
+    monkeypatch.chdir(serial_dir)
+    monkeypatch.setattr(drive, '_folder_index', None)
+    run(ids, pool=False)
+    serial = sorted((t.config['folder'], t.config['fileNamePrefix']) for t in fake_ee.tasks.tasks.values())
+    assert pooled == serial
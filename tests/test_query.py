@@ -0,0 +1,74 @@
+
+import os
+
+import pytest
+
+gpd = pytest.importorskip('geopandas')
+pytest.importorskip('pyarrow')
+
+from GlaciersGEE.query import load_train_set, read_columnar, sjoin, TRAIN_CACHE
+
+
+def write_joined(fp, areas):
+    from shapely.geometry import box
+
+    gdf = gpd.GeoDataFrame(
+        {'glac_id': ['G%d' % k for k in range(len(areas))], 'area': areas, 'name': 'x'},
+        geometry=[box(k, 0, k + 1, 1) for k in range(len(areas))], crs='epsg:4326')
+    gdf.to_file(fp)
+
+
+def test_train_set_cache_is_filtered_and_rebuilt(tmp_path):
+    fp = str(tmp_path / 'joined.shp')
+    cache_fp = str(tmp_path / 'joined') + TRAIN_CACHE
+    write_joined(fp, [1., 2., 3.])
+
+    full = load_train_set(fp)
+    assert os.path.exists(cache_fp)
+    assert sorted(full.glac_id) == ['G0', 'G1', 'G2']
+
+    # ids and columns are selected while reading the cache
+    subset = read_columnar(cache_fp, columns=['glac_id'], where={'glac_id': ['G2', 'G0']})
+    assert sorted(subset.glac_id) == ['G0', 'G2']
+    assert list(subset.columns) == ['glac_id', 'geometry']
+    bounds = dict(zip(subset.glac_id, (g.bounds for g in subset.geometry)))
+    assert bounds['G2'] == (2., 0., 3., 1.)
+
+    # a changed shapefile invalidates the cache
+    write_joined(fp, [5., 6.])
+    os.utime(fp, (os.path.getatime(fp), os.path.getmtime(fp) + 10))
+    changed = load_train_set(fp, glac_ids=['G1'])
+    assert list(changed['area']) == [6.]
+    assert len(read_columnar(cache_fp)) == 2
+
+    # without the shapefile the cache is used
+    for ext in ('.shp', '.shx', '.dbf', '.prj', '.cpg'):
+        if os.path.exists(str(tmp_path / 'joined') + ext):
+            os.remove(str(tmp_path / 'joined') + ext)
+    assert sorted(load_train_set(fp).glac_id) == ['G0', 'G1']
+
+
+def test_sjoin_engines_agree():
+    from shapely.geometry import Point, box
+
+    # strips of glaciers, spread so the strtree engine makes several partitions
+    glims = gpd.GeoDataFrame(
+        {'glac_id': ['G%d' % k for k in range(12)]},
+        geometry=[box(10 * k, 0, 10 * k + 2, 2) for k in range(12)], crs='epsg:4326')
+    points = [(10 * k + 1, 1) for k in range(0, 12, 2)]
+    # G4 holds two wgms points, G1 one on its edge, the last point no glacier
+    points += [(41.5, 1.5), (12, 1), (5, 5)]
+    wgms = gpd.GeoDataFrame(
+        {'WGMS_ID': range(len(points)), 'NAME': ['W%d' % k for k in range(len(points))]},
+        geometry=[Point(p) for p in points], crs='epsg:4326')
+
+    expected = sjoin(glims, wgms, engine='geopandas')
+    result = sjoin(glims, wgms, engine='strtree', workers=1)
+
+    assert sorted(expected.glac_id) == ['G0', 'G1', 'G10', 'G2', 'G4', 'G6', 'G8']
+    # glaciers over several points keep the lowest wgms index
+    assert expected.set_index('glac_id').loc['G4', 'WGMS_ID'] == 2
+    assert sorted(expected.columns) == sorted(result.columns)
+    result = result[list(expected.columns)]
+    assert expected.drop(columns='geometry').equals(result.drop(columns='geometry'))
+    assert expected.geometry.geom_equals(result.geometry).all()
@@ -0,0 +1,48 @@
+
+import os
+
+from GlaciersGEE.store import MetadataStore, append_csv, read_csv_records
+
+
+def test_records_are_committed_in_batches(tmp_path):
+    commits = []
+    store = MetadataStore(str(tmp_path / 'glaciers.db'), batch_size=3, flush_interval=60,
+                          on_commit=commits.append, import_csv=None)
+    for k in range(7):
+        store.put({'glac_id': 'G%d' % k, 'area': k})
+    # a later record of a glacier replaces the earlier one
+    store.put({'glac_id': 'G0', 'area': 10})
+    store.close()
+
+    assert [len(c) for c in commits] == [3, 3, 2]
+    assert store.committed == 8
+    assert store.get('G0') == {'glac_id': 'G0', 'area': 10}
+    assert len(list(store.records())) == 7
+
+
+def test_new_store_imports_earlier_csv_rows(tmp_path):
+    csv_fp = str(tmp_path / 'glacierInfo.csv')
+    append_csv({'glac_id': 'OLD', 'L8Dates': ['2013-04-01', '2013-04-01'], 'area': '1.5'}, csv_fp)
+
+    db_fp = str(tmp_path / 'glaciers.db')
+    store = MetadataStore(db_fp, import_csv=csv_fp)
+    store.put({'glac_id': 'NEW', 'L8Dates': ['2014-01-01'], 'area': 2.})
+    store.close()
+    assert store.get('OLD')['L8Dates'] == ['2013-04-01', '2013-04-01']
+
+    # the csv keeps the old row next to the new one
+    store.to_csv(csv_fp)
+    assert [r['glac_id'] for r in read_csv_records(csv_fp)] == ['OLD', 'NEW']
+
+    # the store is no longer empty, so the csv is not imported again
+    append_csv({'glac_id': 'EXTRA', 'L8Dates': [], 'area': '3'}, csv_fp)
+    again = MetadataStore(db_fp, import_csv=csv_fp)
+    again.close()
+    assert 'EXTRA' not in again
+
+
+def test_empty_store_writes_no_csv(tmp_path):
+    store = MetadataStore(str(tmp_path / 'glaciers.db'), import_csv=None)
+    store.close()
+    assert store.to_csv(str(tmp_path / 'glacierInfo.csv')) is None
+    assert not os.path.exists(str(tmp_path / 'glacierInfo.csv'))
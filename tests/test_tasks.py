@@ -0,0 +1,191 @@
+
+import pytest
+
+from GlaciersGEE import ratelimit
+from GlaciersGEE.fakes import FakeClock, FakeTaskService
+from GlaciersGEE.manifest import Manifest, QUEUED, STARTED, FINISHED
+from GlaciersGEE.tasks import ExportScheduler, match_operations
+
+
+@pytest.fixture(autouse=True)
+def no_rate_limits():
+    # the fake service has no quotas; keep the buckets from sleeping
+    rates = dict(ratelimit.RATES)
+    ratelimit.configure(**{name: (1e6, 1e6) for name in rates})
+    yield
+    ratelimit.configure(**rates)
+
+
+def make_scheduler(service, clock, **kwargs):
+    kwargs.setdefault('state_fp', None)
+    return ExportScheduler(
+        status_fn=lambda ids: match_operations(ids, service.listOperations()),
+        sleep=clock.sleep, clock=clock, poll_interval=5, max_poll_interval=20, **kwargs)
+
+
+def submit(scheduler, service, names):
+    for name in names:
+        scheduler.submit(name, lambda name=name: service.toDrive(fileNamePrefix=name))
+
+
+def test_bounded_concurrency_and_completion():
+    clock = FakeClock()
+    service = FakeTaskService(run_seconds=30, clock=clock)
+    events = []
+    scheduler = make_scheduler(service, clock, max_running=5, listener=lambda k, s: events.append((k, s)))
+
+    submit(scheduler, service, ['g/%d' % k for k in range(30)])
+    assert len(scheduler.running()) == 5
+    assert scheduler.stats()['queue_depth'] == 30
+
+    assert scheduler.wait()
+    assert scheduler.stats()['completed'] == 30
+    assert service.count('start') == 30
+    assert sorted(k for (k, s) in events if s == 'COMPLETED') == sorted('g/%d' % k for k in range(30))
+    # every poll is one listing, whatever the number of tasks in flight
+    assert 0 < service.count('listOperations') < 30
+    assert service.count('getTaskStatus') == 0
+
+
+def test_failed_exports_are_resubmitted_then_reported():
+    clock = FakeClock()
+    service = FakeTaskService(run_seconds=10, fail_rate=1., clock=clock)
+    events = []
+    scheduler = make_scheduler(service, clock, max_attempts=3, listener=lambda k, s: events.append((k, s)))
+
+    submit(scheduler, service, ['g/a'])
+    assert scheduler.wait()
+    assert service.count('start') == 3
+    assert scheduler.failed() == {'g/a': 'fake failure'}
+    assert events[-1] == ('g/a', 'FAILED')
+
+
+class RejectedStart(object):
+    '''
+    Task whose start() raises the first `failures` times it is called
+    '''
+
+    def __init__(self, service, name, failures):
+        self.task = service.toDrive(fileNamePrefix=name)
+        self.failures = failures
+
+    def __call__(self):
+        return self
+
+    def start(self):
+        if self.failures:
+            self.failures -= 1
+            raise ValueError('rejected')
+        self.task.start()
+
+    @property
+    def id(self):
+        return self.task.id
+
+
+def test_failed_starts_are_requeued():
+    clock = FakeClock()
+    service = FakeTaskService(run_seconds=10, clock=clock)
+    scheduler = make_scheduler(service, clock)
+
+    scheduler.submit('g/a', RejectedStart(service, 'g/a', failures=1))
+    submit(scheduler, service, ['g/b'])
+    assert scheduler.wait()
+    assert scheduler.tasks['g/a']['state'] == 'COMPLETED'
+    assert scheduler.tasks['g/a']['attempts'] == 2
+    assert scheduler.stats()['completed'] == 2
+
+
+def test_failed_starts_are_reported_not_raised():
+    clock = FakeClock()
+    service = FakeTaskService(run_seconds=10, clock=clock)
+    events = []
+    scheduler = make_scheduler(service, clock, max_attempts=2, listener=lambda k, s: events.append((k, s)))
+
+    # the error stays with its export, not with the next submit or wait
+    scheduler.submit('g/a', RejectedStart(service, 'g/a', failures=5))
+    submit(scheduler, service, ['g/b'])
+    assert scheduler.wait()
+    assert ('g/a', 'FAILED') in events
+    assert 'rejected' in scheduler.failed()['g/a']
+    assert scheduler.tasks['g/b']['state'] == 'COMPLETED'
+
+
+def test_unknown_tasks_are_resubmitted():
+    clock = FakeClock()
+    service = FakeTaskService(run_seconds=10, clock=clock)
+    scheduler = make_scheduler(service, clock)
+
+    submit(scheduler, service, ['g/a'])
+    # Earth Engine no longer lists the task
+    service.tasks.clear()
+    assert scheduler.wait()
+    assert service.count('start') == 2
+    assert scheduler.tasks['g/a']['state'] == 'COMPLETED'
+
+
+def test_completed_exports_are_not_resubmitted(tmp_path):
+    clock = FakeClock()
+    service = FakeTaskService(run_seconds=10, clock=clock)
+    state_fp = str(tmp_path / 'tasks.json')
+
+    scheduler = make_scheduler(service, clock, state_fp=state_fp)
+    submit(scheduler, service, ['g/a', 'g/b'])
+    assert scheduler.wait()
+
+    events = []
+    later = make_scheduler(service, clock, state_fp=state_fp, listener=lambda k, s: events.append((k, s)))
+    submit(later, service, ['g/a', 'g/b', 'g/c'])
+    assert later.wait()
+    assert service.count('start') == 3
+    assert ('g/a', 'COMPLETED') in events
+
+
+def test_completed_exports_can_be_submitted_again(tmp_path):
+    clock = FakeClock()
+    service = FakeTaskService(run_seconds=10, clock=clock)
+    state_fp = str(tmp_path / 'tasks.json')
+
+    scheduler = make_scheduler(service, clock, state_fp=state_fp)
+    submit(scheduler, service, ['g/a'])
+    assert scheduler.wait()
+
+    later = make_scheduler(service, clock, state_fp=state_fp)
+    assert later.submit('g/a', lambda: service.toDrive(fileNamePrefix='g/a'), again=True)
+    assert later.wait()
+    assert service.count('start') == 2
+
+
+def test_unstarted_exports_are_not_persisted(tmp_path):
+    clock = FakeClock()
+    service = FakeTaskService(run_seconds=10, clock=clock)
+    state_fp = str(tmp_path / 'tasks.json')
+
+    scheduler = make_scheduler(service, clock, max_running=1, state_fp=state_fp)
+    submit(scheduler, service, ['g/a', 'g/b'])
+    scheduler.save()
+
+    later = make_scheduler(service, clock, state_fp=state_fp)
+    assert set(later.tasks) == {'g/a'}
+
+
+def test_interrupted_run_keeps_queued_exports_in_the_manifest(tmp_path):
+    clock = FakeClock()
+    service = FakeTaskService(run_seconds=10, clock=clock)
+    manifest = Manifest(str(tmp_path / 'manifest.db'))
+    scheduler = make_scheduler(service, clock, max_running=2, listener=manifest.export_listener)
+
+    names = ['e%d' % k for k in range(6)]
+    submit(scheduler, service, ['g/' + name for name in names])
+    manifest.mark('g', 'submitted')
+
+    # interrupted before any export finished: only the started ones are done
+    states = manifest.items('g', 'export')
+    assert sorted(states.values()) == [QUEUED] * 4 + [STARTED] * 2
+    assert not manifest.done('g', 'export', names[-1])
+    assert not manifest.finish_glacier('g')
+
+    assert scheduler.wait()
+    assert set(manifest.items('g', 'export').values()) == {FINISHED}
+    assert manifest.glacier_complete('g')
+    manifest.close()